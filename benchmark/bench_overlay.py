@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Measures write-heavy workloads on an overlayfs mount with each overlayfs option.
+# The layers are created in a temporary directory, which should be on the disk
+# the container upper layers are on (not a tmpfs), every run gets a new upper
+# layer. Needs root.
+#
+#   sudo benchmark/bench_overlay.py --directory /var/tmp --files 2000
+
+import argparse
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from furnace.utils import OverlayOptions, OverlayfsMountContext
+
+OPTION_SETS = {
+    "default": OverlayOptions(),
+    "volatile": OverlayOptions(volatile=True),
+    "metacopy=on": OverlayOptions(metacopy=True),
+    "index=off": OverlayOptions(index=False),
+    "noatime": OverlayOptions(noatime=True, nodiratime=True),
+    "fast_scratch": OverlayOptions.fast_scratch(),
+}
+
+LOWER_FILE_SIZE = 256 * 1024
+
+
+def create_small_files(mounted, count):
+    # e.g. unpacking an archive or a build, with fsync like package managers do
+    directory = mounted.joinpath('new')
+    directory.mkdir()
+    for i in range(count):
+        fd = os.open(str(directory.joinpath(str(i))), os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, b'x' * 4096)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def chmod_lower_files(mounted, count):
+    # metadata changes copy up the lower files
+    for i in range(count):
+        os.chmod(str(mounted.joinpath('lower', str(i))), 0o600)
+
+
+def append_lower_files(mounted, count):
+    # copies up the data of the lower files
+    for i in range(count):
+        with open(str(mounted.joinpath('lower', str(i))), 'ab') as f:
+            f.write(b'x')
+
+
+def read_lower_files(mounted, count):
+    for i in range(count):
+        mounted.joinpath('lower', str(i)).read_bytes()
+
+
+WORKLOADS = {
+    "create+fsync": create_small_files,
+    "chmod": chmod_lower_files,
+    "append": append_lower_files,
+    "read": read_lower_files,
+}
+
+
+def measure(directory, lower, options, workload, count, iterations):
+    durations = []
+    for _ in range(iterations):
+        with tempfile.TemporaryDirectory(prefix='furnace-bench-', dir=str(directory)) as layers:
+            layers = Path(layers)
+            upper, work, mounted = layers.joinpath('upper'), layers.joinpath('work'), layers.joinpath('mounted')
+            for path in (upper, work, mounted):
+                path.mkdir()
+            with OverlayfsMountContext([lower], upper, work, mounted, options):
+                start_time = time.monotonic()
+                workload(mounted, count)
+                # the writes reach the disk at umount or later without volatile, include a sync
+                os.sync()
+                durations.append(time.monotonic() - start_time)
+    return statistics.median(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure write-heavy workloads with overlayfs options")
+    parser.add_argument('--directory', default='/var/tmp', help="where the layers are created")
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--iterations', type=int, default=3)
+    parser.add_argument('--options', nargs='+', default=list(OPTION_SETS), choices=list(OPTION_SETS))
+    args = parser.parse_args()
+
+    lower = Path(tempfile.mkdtemp(prefix='furnace-bench-lower-', dir=args.directory))
+    try:
+        lower.joinpath('lower').mkdir()
+        for i in range(args.files):
+            lower.joinpath('lower', str(i)).write_bytes(os.urandom(LOWER_FILE_SIZE))
+        os.sync()
+
+        print("{:<14} {}".format("options", "  ".join("{:>14}".format(name) for name in WORKLOADS)))
+        for name in args.options:
+            latencies = [
+                measure(args.directory, lower, OPTION_SETS[name], workload, args.files, args.iterations)
+                for workload in WORKLOADS.values()
+            ]
+            print("{:<14} {}".format(name, "  ".join(
+                "{:>11.1f} ms".format(latency * 1000) for latency in latencies)))
+    finally:
+        shutil.rmtree(str(lower))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+# Measures the latency of the first command in a freshly started container on a
+# cold page cache, with and without prewarming. First the command is run once
+# with access recording to get the profile of the rootfs. Before every start,
+# the files of the profile are evicted from the page cache (or with --drop-caches,
+# the whole page cache is dropped). Needs root.
+#
+#   sudo benchmark/bench_prewarm.py /path/to/rootfs -- /usr/bin/gcc --version
+
+import argparse
+import os
+import statistics
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from furnace.context import ContainerContext
+from furnace.prewarm import PrewarmProfileStore
+
+
+def evict(root_dir, profile, drop_caches):
+    if drop_caches:
+        os.sync()
+        Path('/proc/sys/vm/drop_caches').write_text('3\n')
+        return
+    for path, _ in profile.files:
+        try:
+            fd = os.open(str(root_dir.joinpath(path)), os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def measure(root_dir, command, store, prewarm_enabled):
+    # Returns (startup time, latency of the first command, latency of the second command)
+    start_time = time.monotonic()
+    with ContainerContext(root_dir, prewarm_profiles=store if prewarm_enabled else None) as container:
+        startup_time = time.monotonic() - start_time
+        latencies = []
+        for _ in range(2):
+            start_time = time.monotonic()
+            container.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            latencies.append(time.monotonic() - start_time)
+    return (startup_time, *latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the effect of prewarming on the first command in a container")
+    parser.add_argument('root_dir', help="rootfs to start the containers in")
+    parser.add_argument('command', nargs='+', help="command to run in the container")
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--drop-caches', action='store_true', help="drop the whole page cache of the host")
+    args = parser.parse_args()
+    root_dir = Path(args.root_dir).resolve()
+
+    with tempfile.TemporaryDirectory(prefix='furnace-bench-') as profile_dir:
+        store = PrewarmProfileStore(profile_dir)
+        with ContainerContext(root_dir, prewarm_profiles=store, record_access_profile=True) as container:
+            container.run(args.command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        profile = container.access_profile
+        print("Profile: {} files, {:.1f} MiB".format(len(profile.files), profile.total_bytes / 1024 / 1024))
+
+        results = {False: [], True: []}
+        for _ in range(args.iterations):
+            for prewarm_enabled in (False, True):
+                evict(root_dir, profile, args.drop_caches)
+                results[prewarm_enabled].append(measure(root_dir, args.command, store, prewarm_enabled))
+
+    print("{:<12} {:>14} {:>16} {:>17}".format("", "startup", "first command", "second command"))
+    for prewarm_enabled, name in ((False, "cold"), (True, "prewarmed")):
+        columns = zip(*results[prewarm_enabled])
+        print("{:<12} {}".format(name, " ".join(
+            "{:>13.1f} ms".format(statistics.median(durations) * 1000) for durations in columns)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Measures how the latency of mounting and unmounting a tmpfs on the host grows
+# with the number of running containers, for each mount propagation mode. The
+# tmpfs is mounted in the /tmp of the rootfs (a mount there is propagated into
+# every container unless the mode is private), next to the rootfs, and on the
+# host's root filesystem, where the sources of most bind mounts are. Needs root.
+#
+#   sudo benchmark/bench_propagation.py /path/to/rootfs --containers 0 50 100 200
+
+import argparse
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from furnace.config import MOUNT_PROPAGATION_MODES
+from furnace.context import ContainerContext
+from furnace.libc import mount, umount2
+
+MOUNT_TARGETS = {
+    "inside rootfs": lambda root_dir: root_dir.joinpath('tmp'),
+    "next to rootfs": lambda root_dir: root_dir.parent,
+    "host root": lambda root_dir: Path('/var/tmp'),
+}
+
+
+def measure_mount_latency(directory, iterations):
+    durations = []
+    with tempfile.TemporaryDirectory(prefix='furnace-bench-', dir=str(directory)) as target:
+        target = Path(target)
+        for _ in range(iterations):
+            start_time = time.monotonic()
+            mount(Path('tmpfs'), target, 'tmpfs', 0, None)
+            umount2(target, 0)
+            durations.append(time.monotonic() - start_time)
+    return statistics.median(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure host mount latency with running containers")
+    parser.add_argument('root_dir', help="rootfs to start the containers in")
+    parser.add_argument('--containers', type=int, nargs='+', default=[0, 25, 50, 100])
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--modes', nargs='+', default=MOUNT_PROPAGATION_MODES, choices=MOUNT_PROPAGATION_MODES)
+    args = parser.parse_args()
+    root_dir = Path(args.root_dir).resolve()
+
+    print("{:<14} {:>10}  {}".format("mode", "containers", "  ".join(
+        "{:>20}".format(target) for target in MOUNT_TARGETS)))
+    for mode in args.modes:
+        containers = []
+        try:
+            for count in sorted(args.containers):
+                while len(containers) < count:
+                    container = ContainerContext(root_dir, read_only_root=True, mount_propagation=mode)
+                    container.__enter__()
+                    containers.append(container)
+                latencies = [
+                    measure_mount_latency(directory(root_dir), args.iterations)
+                    for directory in MOUNT_TARGETS.values()
+                ]
+                print("{:<14} {:>10}  {}".format(mode, count, "  ".join(
+                    "{:>17.3f} ms".format(latency * 1000) for latency in latencies)))
+        finally:
+            for container in containers:
+                container.__exit__(None, None, None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Measures container startup and teardown time for each ContainerSpec preset,
+# and breaks the startup down into the steps done by PID1. With --template, the
+# containers are also cloned from a ContainerTemplate. Containers on the root of
+# the host (root_dir=None) are measured too. Needs root.
+#
+#   sudo benchmark/bench_startup.py /path/to/rootfs --iterations 50
+
+import argparse
+import statistics
+import time
+from collections import defaultdict
+
+from furnace.config import ContainerSpec
+from furnace.context import ContainerContext
+from furnace.template import ContainerTemplate
+
+PRESETS = {
+    "minimal": ContainerSpec.minimal,
+    "default": ContainerSpec.default,
+    "full": ContainerSpec.full,
+}
+
+
+def measure(root_dir, spec, iterations, **context_kwargs):
+    totals = defaultdict(list)
+    for _ in range(iterations):
+        container = ContainerContext(root_dir, spec=spec, **context_kwargs)
+        start_time = time.monotonic()
+        container.__enter__()
+        startup_time = time.monotonic() - start_time
+        totals['total startup'].append(startup_time)
+        for step, duration in container.startup_timings.items():
+            totals[step].append(duration)
+        totals['fork, exec and other'].append(startup_time - sum(container.startup_timings.values()))
+        start_time = time.monotonic()
+        container.__exit__(None, None, None)
+        totals['teardown'].append(time.monotonic() - start_time)
+    return totals
+
+
+def print_results(name, totals):
+    print("{}:".format(name))
+    for step, durations in totals.items():
+        print("    {:<28} median {:8.3f} ms   max {:8.3f} ms".format(
+            step, statistics.median(durations) * 1000, max(durations) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure container startup time for each ContainerSpec preset")
+    parser.add_argument('root_dir', help="rootfs to start the containers in")
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--isolate-networking', action='store_true')
+    parser.add_argument('--template', action='store_true', help="also measure containers cloned from a template")
+    args = parser.parse_args()
+    for name, preset in PRESETS.items():
+        totals = measure(args.root_dir, preset(), args.iterations, isolate_networking=args.isolate_networking)
+        print_results(name, totals)
+        if args.template:
+            with ContainerTemplate(args.root_dir, spec=preset(), isolate_networking=args.isolate_networking) as template:
+                totals = measure(args.root_dir, preset(), args.iterations, isolate_networking=args.isolate_networking,
+                                 template=template)
+            print_results("{} (from template)".format(name), totals)
+    totals = measure(None, ContainerSpec.host_root(), args.iterations, isolate_networking=args.isolate_networking)
+    print_results("host root", totals)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Starts and stops a lot of containers concurrently, with failures injected
+# during the startup and while the containers run, and checks that nothing
+# leaks: open fds, mounts, zombies and namespaces of the host are sampled
+# during the run, and the soak fails if they grow. Warnings logged by furnace
+# (e.g. a umount that had to fall back to MNT_DETACH) fail it too. Needs root.
+#
+#   sudo benchmark/soak.py /path/to/rootfs --containers 20000 --workers 16 --report soak.csv
+
+import argparse
+import csv
+import logging
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from furnace.config import BindMount
+from furnace.context import ContainerContext
+from furnace.supervisor import Supervisor
+
+RESOURCES = ('fds', 'mounts', 'zombies', 'namespaces', 'rss_kb')
+
+
+class InjectedFailure(Exception):
+    pass
+
+
+class WarningCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(self.format(record))
+
+
+def count_zombie_children():
+    # the zombies of containers would be children of this process
+    own_pid = os.getpid()
+    zombies = 0
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as f:
+                # the command name may contain spaces, the fields after it are fixed
+                fields = f.read().rpartition(')')[2].split()
+        except OSError:
+            continue
+        if fields[0] == 'Z' and int(fields[1]) == own_pid:
+            zombies += 1
+    return zombies
+
+
+def count_namespaces():
+    # Namespaces that are alive because of a process of the host, including the
+    # ones pinned by bind mounts (e.g. /run/netns) through the mount table
+    inodes = set()
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        ns_dir = '/proc/{}/ns'.format(entry)
+        try:
+            for ns_name in os.listdir(ns_dir):
+                inodes.add(os.readlink(os.path.join(ns_dir, ns_name)))
+        except OSError:
+            continue
+    with open('/proc/self/mountinfo') as f:
+        for line in f:
+            fields = line.split(' ')
+            if fields[3].startswith(('net:', 'mnt:', 'uts:', 'ipc:', 'pid:', 'cgroup:')):
+                inodes.add(fields[3])
+    return len(inodes)
+
+
+def get_rss_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def take_sample():
+    with open('/proc/self/mountinfo') as f:
+        mounts = sum(1 for _ in f)
+    return {
+        'fds': len(os.listdir('/proc/self/fd')),
+        'mounts': mounts,
+        'zombies': count_zombie_children(),
+        'namespaces': count_namespaces(),
+        'rss_kb': get_rss_kb(),
+    }
+
+
+class Soak:
+    def __init__(self, root_dir, args):
+        self.root_dir = Path(root_dir)
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.random_lock = threading.Lock()
+        self.supervisor = Supervisor()
+        self.lock = threading.Lock()
+        # (finish time, startup seconds, teardown seconds)
+        self.latencies = []
+        self.samples = []
+        self.outcomes = {'ok': 0, 'failed startup': 0, 'failed run': 0, 'killed': 0}
+        self.unexpected_errors = []
+        self.stop_sampling = threading.Event()
+
+    def choose_failure(self):
+        with self.random_lock:
+            value = self.random.random()
+        if value < self.args.failure_rate:
+            return 'failed startup'
+        if value < self.args.failure_rate * 2:
+            return 'failed run'
+        if value < self.args.failure_rate * 3:
+            return 'killed'
+        return 'ok'
+
+    def run_one(self, index):
+        failure = self.choose_failure()
+        bind_mounts = []
+        if failure == 'failed startup':
+            # PID1 fails in the middle of its startup, after creating its namespaces
+            bind_mounts.append(BindMount(Path('/nonexistent-furnace-soak-source'), Path('soak'), False))
+        start_time = time.monotonic()
+        try:
+            container = ContainerContext(
+                self.root_dir, isolate_networking=True, bind_mounts=bind_mounts, supervisor=self.supervisor)
+            with container:
+                startup_time = time.monotonic() - start_time
+                if failure == 'killed':
+                    os.kill(container.pid1.pid, 9)
+                else:
+                    container.run(['/bin/true'], check=True)
+                if failure == 'failed run':
+                    raise InjectedFailure()
+                teardown_start = time.monotonic()
+            teardown_time = time.monotonic() - teardown_start
+        except InjectedFailure:
+            pass
+        except RuntimeError:
+            if failure != 'failed startup':
+                raise
+        else:
+            with self.lock:
+                self.latencies.append((time.monotonic(), startup_time, teardown_time))
+        with self.lock:
+            self.outcomes[failure] += 1
+
+    def run_one_safely(self, index):
+        try:
+            self.run_one(index)
+        except Exception as e:
+            with self.lock:
+                self.unexpected_errors.append("Container #{}: {!r}".format(index, e))
+
+    def sample_loop(self, start_time):
+        while not self.stop_sampling.wait(self.args.sample_interval):
+            self.record_sample(start_time)
+
+    def record_sample(self, start_time):
+        sample = take_sample()
+        sample['time'] = time.monotonic() - start_time
+        with self.lock:
+            sample['done'] = sum(self.outcomes.values())
+        self.samples.append(sample)
+
+    def run(self):
+        start_time = time.monotonic()
+        with self.supervisor:
+            # a few containers first, so that lazily created things (e.g. the shared host
+            # namespace fd) are part of the baseline
+            for index in range(self.args.workers):
+                self.run_one_safely(index)
+            self.record_sample(start_time)
+            sampler = threading.Thread(name='soak-sampler', target=self.sample_loop, args=(start_time,), daemon=True)
+            sampler.start()
+            with ThreadPoolExecutor(max_workers=self.args.workers) as executor:
+                list(executor.map(self.run_one_safely, range(self.args.workers, self.args.containers)))
+            self.stop_sampling.set()
+            sampler.join()
+        self.record_sample(start_time)
+        return start_time
+
+    def check_growth(self):
+        baseline, final = self.samples[0], self.samples[-1]
+        problems = []
+        for resource in ('fds', 'mounts', 'zombies', 'namespaces'):
+            if final[resource] > baseline[resource]:
+                problems.append("{} grew from {} to {}".format(resource, baseline[resource], final[resource]))
+        rss_limit = baseline['rss_kb'] * (1 + self.args.rss_growth)
+        if final['rss_kb'] > rss_limit:
+            problems.append("RSS grew from {} kB to {} kB".format(baseline['rss_kb'], final['rss_kb']))
+        return problems
+
+    def latency_report(self, start_time):
+        # Startup and teardown latency in time windows, to show slowdowns caused by leaks
+        windows = []
+        if not self.latencies:
+            return windows
+        window_count = max(1, min(self.args.windows, len(self.latencies)))
+        latencies = sorted(self.latencies)
+        window_size = -(-len(latencies) // window_count)
+        for window_start in range(0, len(latencies), window_size):
+            window = latencies[window_start:window_start + window_size]
+            startups = sorted(latency[1] for latency in window)
+            windows.append({
+                'time': window[-1][0] - start_time,
+                'containers': len(window),
+                'startup_median_ms': statistics.median(startups) * 1000,
+                'startup_p99_ms': startups[int(len(startups) * 0.99)] * 1000 if len(startups) > 1 else startups[0] * 1000,
+                'teardown_median_ms': statistics.median(latency[2] for latency in window) * 1000,
+            })
+        return windows
+
+
+def print_table(rows, columns):
+    print("  ".join("{:>18}".format(column) for column in columns))
+    for row in rows:
+        print("  ".join("{:>18.1f}".format(row[column]) if isinstance(row[column], float) else "{:>18}".format(row[column])
+                        for column in columns))
+
+
+def write_csv(path, rows, columns):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Start and stop containers in a loop and check for leaks")
+    parser.add_argument('root_dir', help="rootfs to start the containers in")
+    parser.add_argument('--containers', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--failure-rate', type=float, default=0.05,
+                        help="probability of each kind of injected failure")
+    parser.add_argument('--sample-interval', type=float, default=5.0, help="seconds between resource samples")
+    parser.add_argument('--rss-growth', type=float, default=0.2, help="allowed relative RSS growth")
+    parser.add_argument('--windows', type=int, default=10, help="number of time windows in the latency report")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--report', help="write the latency report to this CSV file")
+    parser.add_argument('--samples', help="write the resource samples to this CSV file")
+    parser.add_argument('--verbose', action='store_true', help="do not hide the stderr of the containers")
+    args = parser.parse_args()
+
+    warnings = WarningCounter()
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('furnace').addHandler(warnings)
+    if not args.verbose:
+        # PID1s failing their startup print their traceback to stderr, that is expected here
+        with open(os.devnull, 'w') as devnull:
+            os.dup2(devnull.fileno(), sys.stderr.fileno())
+    soak = Soak(args.root_dir, args)
+    start_time = soak.run()
+
+    print("Outcomes: {}".format(", ".join("{} {}".format(count, outcome) for outcome, count in soak.outcomes.items())))
+    print("\nResources over time:")
+    print_table(soak.samples, ('time', 'done') + RESOURCES)
+    report = soak.latency_report(start_time)
+    print("\nLatency over time:")
+    report_columns = ('time', 'containers', 'startup_median_ms', 'startup_p99_ms', 'teardown_median_ms')
+    print_table(report, report_columns)
+    if args.report:
+        write_csv(args.report, report, report_columns)
+    if args.samples:
+        write_csv(args.samples, soak.samples, ('time', 'done') + RESOURCES)
+
+    problems = soak.check_growth() + soak.unexpected_errors
+    # the containers killed on purpose are reported by the supervisor, that is not a problem
+    problems += [record for record in warnings.records if 'exited unexpectedly' not in record]
+    if problems:
+        print("\nFAILED:")
+        for problem in problems:
+            print("    {}".format(problem))
+        sys.exit(1)
+    print("\nNo leaks detected")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import threading
+import uuid
+from collections import namedtuple
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+CacheStats = namedtuple('CacheStats', ['hits', 'misses', 'hit_rate', 'entries', 'size', 'evictions'])
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def hash_fileobj(f, digest=None):
+    digest = digest or hashlib.sha256()
+    for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+        digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_file(path: Path, digest=None):
+    with path.open('rb') as f:
+        return hash_fileobj(f, digest)
+
+
+def unescape_mountinfo(field):
+    # mountinfo escapes spaces, tabs, newlines and backslashes as octal sequences
+    return field.encode('utf-8').decode('unicode_escape')
+
+
+def get_mount_info(path: Path):
+    # Returns (fstype, superblock options) of the mount at path, or None if it is not a mountpoint
+    result = None
+    with open('/proc/self/mountinfo') as f:
+        for line in f:
+            fields, _, fs_fields = line.rstrip('\n').partition(' - ')
+            fields = fields.split(' ')
+            fs_fields = fs_fields.split(' ')
+            if Path(unescape_mountinfo(fields[4])) == path:
+                # the last one wins, as later mounts hide the earlier ones
+                result = fs_fields[0], fs_fields[2]
+    return result
+
+
+def stat_identity(path: Path):
+    st = path.stat()
+    return [str(path), st.st_dev, st.st_ino, st.st_mtime_ns]
+
+
+def is_overlay(root_dir: Path) -> bool:
+    mount_info = get_mount_info(Path(root_dir).resolve())
+    return mount_info is not None and mount_info[0] == 'overlay'
+
+
+def rootfs_fingerprint(root_dir: Path) -> str:
+    # A cheap identity of a rootfs. For an overlayfs, this is the identity of the
+    # lower layers (which are expected to be immutable) and the names of everything
+    # in the upper layer, with the modification time and size of the files. Directory
+    # modification times are left out, as starting a container changes them.
+    # For anything else, it is only the identity of the root directory itself (without
+    # its modification time, as that changes with every start), which is much weaker:
+    # it does not change when the files in it do, so it is not enough for a RunCache.
+    root_dir = Path(root_dir).resolve()
+    mount_info = get_mount_info(root_dir)
+    if mount_info is not None and mount_info[0] == 'overlay':
+        options = dict(option.partition('=')[::2] for option in mount_info[1].split(','))
+        lower_dirs = [Path(lower) for lower in options.get('lowerdir', '').split(':') if lower]
+        identity = {'lower': [stat_identity(lower) for lower in lower_dirs], 'upper': []}
+        if options.get('upperdir'):
+            upper_dir = Path(options['upperdir'])
+            for dirpath, dirnames, filenames in os.walk(str(upper_dir)):
+                dirnames.sort()
+                relative_dir = Path(dirpath).relative_to(upper_dir)
+                identity['upper'].append([str(relative_dir)])
+                for name in sorted(filenames):
+                    st = os.lstat(os.path.join(dirpath, name))
+                    identity['upper'].append([str(relative_dir.joinpath(name)), st.st_mtime_ns, st.st_size])
+    else:
+        identity = {'root': stat_identity(root_dir)[:3]}
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class RunCache:
+    # An on-disk store of command results, keyed by everything that determines the
+    # result of a deterministic command. Every entry is a directory with a meta.json
+    # (return code, stdout, stderr, output paths) and the content of the output files.
+    # When the total size exceeds max_size, the least recently used entries are removed.
+    def __init__(self, directory, *, max_size=1024 * 1024 * 1024):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> size in bytes, loaded from the disk once
+        self.entry_sizes = {}
+        for entry in self.directory.iterdir():
+            meta_path = entry.joinpath('meta.json')
+            if meta_path.is_file():
+                self.entry_sizes[entry.name] = json.loads(meta_path.read_text())['size']
+
+    @classmethod
+    def make_key(cls, fingerprint, args, env, cwd, input_hashes):
+        # like subprocess, env and cwd can be str, bytes (or Path) too
+        if env is not None:
+            env = {os.fsdecode(name): os.fsdecode(value) for name, value in env.items()}
+        key_data = json.dumps({
+            'rootfs': fingerprint,
+            'args': [os.fsdecode(arg) for arg in args],
+            'env': env,
+            'cwd': os.fsdecode(cwd) if cwd is not None else None,
+            'inputs': input_hashes,
+        }, sort_keys=True)
+        return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        # Returns the meta data and the directory of the entry, or None on a miss
+        entry = self.directory.joinpath(key)
+        try:
+            meta = json.loads(entry.joinpath('meta.json').read_text())
+            # the modification time of the entry is used for the LRU eviction
+            os.utime(str(entry))
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        meta['stdout'] = base64.b64decode(meta['stdout'])
+        meta['stderr'] = base64.b64decode(meta['stderr'])
+        return meta, entry
+
+    def put(self, key, returncode, stdout, stderr, outputs):
+        # outputs is a list of (path in the container, binary file object) pairs
+        temp_entry = self.directory.joinpath('.tmp-{}'.format(uuid.uuid4().hex))
+        temp_entry.mkdir()
+        try:
+            size = len(stdout or b'') + len(stderr or b'')
+            stored_outputs = []
+            for index, (container_path, f) in enumerate(outputs):
+                st = os.fstat(f.fileno())
+                if not stat.S_ISREG(st.st_mode):
+                    raise ValueError("Output {} is not a regular file".format(container_path))
+                with temp_entry.joinpath(str(index)).open('wb') as stored:
+                    shutil.copyfileobj(f, stored, HASH_BLOCK_SIZE)
+                stored_outputs.append([str(container_path), st.st_mode & 0o7777])
+                size += st.st_size
+            temp_entry.joinpath('meta.json').write_text(json.dumps({
+                'returncode': returncode,
+                'stdout': base64.b64encode(stdout or b'').decode('ascii'),
+                'stderr': base64.b64encode(stderr or b'').decode('ascii'),
+                'outputs': stored_outputs,
+                'size': size,
+            }))
+            try:
+                temp_entry.rename(self.directory.joinpath(key))
+            except OSError:
+                # an other process stored the same result in the meantime
+                shutil.rmtree(str(temp_entry))
+                return
+        except BaseException:
+            shutil.rmtree(str(temp_entry), ignore_errors=True)
+            raise
+        with self.lock:
+            self.entry_sizes[key] = size
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            total_size = sum(self.entry_sizes.values())
+            if total_size <= self.max_size:
+                return
+            entries = []
+            for key in self.entry_sizes:
+                try:
+                    entries.append((self.directory.joinpath(key).stat().st_mtime, key))
+                except FileNotFoundError:
+                    entries.append((0, key))
+            for _, key in sorted(entries):
+                if total_size <= self.max_size:
+                    break
+                total_size -= self.entry_sizes.pop(key)
+                shutil.rmtree(str(self.directory.joinpath(key)), ignore_errors=True)
+                self.evictions += 1
+
+    def stats(self) -> CacheStats:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return CacheStats(
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=self.hits / lookups if lookups else 0.0,
+                entries=len(self.entry_sizes),
+                size=sum(self.entry_sizes.values()),
+                evictions=self.evictions,
+            )
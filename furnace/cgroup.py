@@ -0,0 +1,140 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import errno
+import itertools
+import logging
+import os
+import select
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# How long to wait for the processes of a killed container to leave its cgroup
+CGROUP_EMPTY_TIMEOUT = 5.0
+# How long to wait for every process of a container to be frozen or thawed, e.g. a
+# process in an uninterruptible sleep is only frozen when it wakes up
+CGROUP_FREEZE_TIMEOUT = 5.0
+
+cgroup_counter = itertools.count()
+
+
+def find_cgroup2_mount():
+    # /sys/fs/cgroup on pure cgroup v2 systems, /sys/fs/cgroup/unified on hybrid ones
+    with open('/proc/self/mounts') as f:
+        for line in f:
+            fields = line.split()
+            if fields[2] == 'cgroup2':
+                return Path(fields[1].encode('latin-1').decode('unicode_escape'))
+    return None
+
+
+def get_own_cgroup():
+    # The cgroup v2 path of this process, relative to the mount
+    with open('/proc/self/cgroup') as f:
+        for line in f:
+            if line.startswith('0::'):
+                return line[len('0::'):].strip()
+    return None
+
+
+class ContainerCgroup:
+    # A cgroup v2 group for the processes of a container, below the cgroup of this
+    # process, used for freezing them (Linux 5.2). No controllers are enabled, so it
+    # does not change the resource accounting of the processes. PID1 is moved into it
+    # by the host, the processes started with run(), Popen() and call() join it
+    # themselves before exec, see SetnsContext.
+    def __init__(self, path: Path):
+        self.path = path
+        self.procs_fd = None
+
+    @classmethod
+    def create(cls):
+        mountpoint = find_cgroup2_mount()
+        own_cgroup = get_own_cgroup()
+        if mountpoint is None or own_cgroup is None:
+            raise RuntimeError("Pausing containers needs cgroup v2")
+        path = mountpoint.joinpath(own_cgroup.lstrip('/'), 'furnace-{}-{}'.format(os.getpid(), next(cgroup_counter)))
+        path.mkdir()
+        cgroup = cls(path)
+        if not path.joinpath('cgroup.freeze').exists():
+            cgroup.remove()
+            raise RuntimeError("The cgroup freezer needs Linux 5.2 or newer")
+        cgroup.procs_fd = os.open(str(path.joinpath('cgroup.procs')), os.O_WRONLY | os.O_CLOEXEC)
+        return cgroup
+
+    def add_process(self, pid):
+        # 0 means the calling process
+        os.write(self.procs_fd, str(pid).encode('ascii'))
+
+    def read_events(self):
+        events = {}
+        for line in self.path.joinpath('cgroup.events').read_text().splitlines():
+            key, _, value = line.partition(' ')
+            events[key] = value
+        return events
+
+    def wait_for_event(self, key, value, timeout=None):
+        # cgroup.events signals every change with POLLPRI
+        fd = os.open(str(self.path.joinpath('cgroup.events')), os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            poller = select.poll()
+            poller.register(fd, select.POLLPRI)
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while True:
+                if self.read_events().get(key) == value:
+                    return True
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                poller.poll(None if remaining is None else remaining * 1000)
+        finally:
+            os.close(fd)
+
+    def set_frozen(self, frozen: bool, timeout=CGROUP_FREEZE_TIMEOUT) -> float:
+        # Freezing is asynchronous, the processes stop when they next leave the kernel.
+        # Returns the seconds until every process of the cgroup was frozen (or thawed).
+        # If that does not happen in time, the previous state is restored.
+        start_time = time.monotonic()
+        freeze_path = self.path.joinpath('cgroup.freeze')
+        freeze_path.write_text('1' if frozen else '0')
+        try:
+            done = self.wait_for_event('frozen', '1' if frozen else '0', timeout=timeout)
+        except BaseException:
+            freeze_path.write_text('0' if frozen else '1')
+            raise
+        if not done:
+            freeze_path.write_text('0' if frozen else '1')
+            raise TimeoutError("Could not {} {} in {} seconds".format("freeze" if frozen else "thaw", self.path, timeout))
+        return time.monotonic() - start_time
+
+    def remove(self):
+        if self.procs_fd is not None:
+            os.close(self.procs_fd)
+            self.procs_fd = None
+        # The processes of the killed container leave the cgroup asynchronously
+        if not self.wait_for_event('populated', '0', timeout=CGROUP_EMPTY_TIMEOUT):
+            logger.warning("Processes are still running in {}".format(self.path))
+        try:
+            self.path.rmdir()
+        except OSError as e:
+            if e.errno != errno.EBUSY:
+                raise
+            logger.warning("Could not remove {}, it is still in use".format(self.path))
@@ -17,6 +17,7 @@
 # along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import re
 from collections import namedtuple
 
 from pathlib import Path
@@ -146,3 +147,227 @@ HOST_NETWORK_BIND_MOUNTS = [
         readonly=True,
     ),
 ]
+
+# How mount and umount events of the host propagate into the container. Every
+# propagated mount point makes mount operations on the host slower, in proportion
+# to the number of running containers.
+MOUNT_PROPAGATION_SLAVE = "slave"                   # everything, including bind mount sources (the default)
+MOUNT_PROPAGATION_ROOTFS_SLAVE = "rootfs-slave"     # only the rootfs, bind mounts are made private
+MOUNT_PROPAGATION_PRIVATE = "private"               # nothing
+MOUNT_PROPAGATION_MODES = (MOUNT_PROPAGATION_SLAVE, MOUNT_PROPAGATION_ROOTFS_SLAVE, MOUNT_PROPAGATION_PRIVATE)
+
+# Namespaces that can be left out of a ContainerSpec. The pid and mount namespaces
+# are always created, and the network namespace depends on isolate_networking.
+OPTIONAL_NAMESPACES = ("cgroup", "ipc", "uts")
+REQUIRED_NAMESPACES = ("pid", "mnt")
+
+MINIMAL_CONTAINER_MOUNTS = [m for m in CONTAINER_MOUNTS if m.destination in (Path("/proc"), Path("/dev"))]
+
+FULL_CONTAINER_MOUNTS = CONTAINER_MOUNTS + [
+    Mount(
+        destination=Path("/tmp"),
+        type="tmpfs",
+        source="tmpfs",
+        flags=MS_NOSUID | MS_NODEV,
+        options=[
+            "mode=1777",
+        ],
+    ),
+]
+
+HOST_ROOT_CONTAINER_MOUNTS = [m for m in CONTAINER_MOUNTS if m.destination == Path("/proc")]
+
+MINIMAL_CONTAINER_DEVICE_NODES = [d for d in CONTAINER_DEVICE_NODES if d.name in ("null", "zero", "random", "urandom")]
+
+
+# Transparent hugepage modes of tmpfs, see Documentation/admin-guide/mm/transhuge.rst
+TMPFS_HUGE_MODES = ('never', 'always', 'within_size', 'advise')
+# NUMA memory policies of tmpfs, with an optional node list, e.g. "bind:0-1"
+TMPFS_MEMORY_POLICIES = ('default', 'prefer', 'bind', 'interleave', 'local')
+TMPFS_OPTION_NAMES = ('size', 'nr_inodes', 'huge', 'noswap', 'mpol')
+# The options that depend on the kernel version and configuration
+TMPFS_KERNEL_DEPENDENT_OPTIONS = ('huge', 'noswap', 'mpol')
+
+
+class TmpfsOptions(namedtuple('TmpfsOptions', ['size', 'nr_inodes', 'huge', 'noswap', 'mpol'])):
+    # Tuning of a tmpfs mount of a ContainerSpec, see ContainerSpec.with_tmpfs().
+    # None means the default of the mount (or of the kernel).
+    # size: maximum size, bytes or with a k/m/g suffix or a percentage of the RAM, e.g. "2g", "50%"
+    # nr_inodes: maximum number of inodes, with the same suffixes (not percentage)
+    # huge: transparent hugepages for the files, see TMPFS_HUGE_MODES
+    # noswap: never swap the files out (Linux 6.4)
+    # mpol: NUMA memory policy, see TMPFS_MEMORY_POLICIES, e.g. "interleave:0-3"
+    # The kernel support of the options is checked when the container starts.
+    __slots__ = ()
+
+    def __new__(cls, size=None, nr_inodes=None, huge=None, noswap=False, mpol=None):
+        return super().__new__(cls, size, nr_inodes, huge, noswap, mpol)
+
+    def validate(self):
+        for name in ('size', 'nr_inodes'):
+            value = getattr(self, name)
+            if value is not None and not re.fullmatch(r'[0-9]+[kmgKMG]?' + ('%?' if name == 'size' else ''), str(value)):
+                raise ValueError("Invalid tmpfs {}: {}".format(name, value))
+        if self.huge is not None and self.huge not in TMPFS_HUGE_MODES:
+            raise ValueError("Unknown tmpfs hugepage mode: {}".format(self.huge))
+        if self.mpol is not None:
+            policy, _, nodes = self.mpol.partition(':')
+            if policy not in TMPFS_MEMORY_POLICIES or (nodes and not re.fullmatch(r'[0-9,\-]+', nodes)):
+                raise ValueError("Invalid tmpfs memory policy: {}".format(self.mpol))
+        return self
+
+    def get_mount_options(self):
+        options = []
+        for name in ('size', 'nr_inodes', 'huge', 'mpol'):
+            value = getattr(self, name)
+            if value is not None:
+                options.append('{}={}'.format(name, value))
+        if self.noswap:
+            options.append('noswap')
+        return options
+
+    def apply_to(self, mount: Mount) -> Mount:
+        # The mount with these options replacing its own ones of the same name
+        if mount.type != "tmpfs":
+            raise ValueError("{} is not a tmpfs mount".format(mount.destination))
+        kept = [option for option in mount.options or []
+                if option.partition('=')[0] not in TMPFS_OPTION_NAMES]
+        return mount._replace(options=kept + self.get_mount_options())
+
+    def to_json(self):
+        return self._asdict()
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(**data)
+
+
+# The largest uid or gid, (uid_t)-1 is reserved
+MAX_ID = 2 ** 32 - 2
+
+
+class IdMapping(namedtuple('IdMapping', ['uid', 'gid', 'size'])):
+    # The uids and gids of the user namespace of a container: 0..size-1 in the
+    # container are uid..uid+size-1 (and gid..gid+size-1) on the host. The rootfs is
+    # mounted through an ID-mapped mount, so the files owned by root in the rootfs
+    # are owned by root in the container, and by uid on the host. Overlayfs mounts
+    # can not be ID-mapped, see ContainerContext.
+    __slots__ = ()
+
+    def __new__(cls, uid, gid=None, size=65536):
+        return super().__new__(cls, uid, uid if gid is None else gid, size)
+
+    def validate(self):
+        if self.size < 1:
+            raise ValueError("The size of an ID mapping has to be positive")
+        for name in ('uid', 'gid'):
+            first_id = getattr(self, name)
+            if first_id < 0 or first_id + self.size - 1 > MAX_ID:
+                raise ValueError("Invalid {} range: {}-{}".format(name, first_id, first_id + self.size - 1))
+        return self
+
+    def get_uid_map(self):
+        # in the format of /proc/PID/uid_map
+        return "0 {} {}\n".format(self.uid, self.size)
+
+    def get_gid_map(self):
+        return "0 {} {}\n".format(self.gid, self.size)
+
+    def to_host_uid(self, uid):
+        # ids outside of the mapping are returned as they are
+        return self.uid + uid if uid < self.size else uid
+
+    def to_host_gid(self, gid):
+        return self.gid + gid if gid < self.size else gid
+
+    def to_json(self):
+        return self._asdict()
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(**data)
+
+
+class ContainerSpec(namedtuple('ContainerSpec', ['namespaces', 'mounts', 'device_nodes', 'loop_devices', 'hostname'])):
+    # Describes what a container consists of. Every namespace, mount and device node
+    # makes starting and stopping a container slower, so jobs that don't need them
+    # can use a smaller spec, e.g. ContainerSpec.minimal()
+    # namespaces: names of the namespaces to create, see NAMESPACES
+    # mounts: Mounts done in the container after pivot_root
+    # device_nodes: DeviceNodes created in /dev
+    # loop_devices: whether the loop devices of the host are made available
+    # hostname: hostname in the container, only used if there is a "uts" namespace
+
+    @classmethod
+    def minimal(cls):
+        return cls(
+            namespaces=REQUIRED_NAMESPACES,
+            mounts=MINIMAL_CONTAINER_MOUNTS,
+            device_nodes=MINIMAL_CONTAINER_DEVICE_NODES,
+            loop_devices=False,
+            hostname=None,
+        )
+
+    @classmethod
+    def default(cls):
+        return cls(
+            namespaces=REQUIRED_NAMESPACES + OPTIONAL_NAMESPACES,
+            mounts=CONTAINER_MOUNTS,
+            device_nodes=CONTAINER_DEVICE_NODES,
+            loop_devices=True,
+            hostname=HOSTNAME,
+        )
+
+    @classmethod
+    def full(cls):
+        return cls.default()._replace(mounts=FULL_CONTAINER_MOUNTS)
+
+    @classmethod
+    def host_root(cls):
+        # For containers without a rootfs (root_dir=None), that run the binaries of the
+        # host: only the /proc of the new pid namespace is mounted over the host's one
+        return cls(
+            namespaces=REQUIRED_NAMESPACES + OPTIONAL_NAMESPACES,
+            mounts=HOST_ROOT_CONTAINER_MOUNTS,
+            device_nodes=[],
+            loop_devices=False,
+            hostname=HOSTNAME,
+        )
+
+    def with_tmpfs(self, destination, options: TmpfsOptions):
+        # The spec with the tmpfs mounted on destination tuned, e.g. a larger /dev/shm:
+        #   ContainerSpec.default().with_tmpfs('/dev/shm', TmpfsOptions(size='4g', huge='within_size'))
+        destination = Path(destination)
+        options.validate()
+        if not any(m.destination == destination for m in self.mounts):
+            raise ValueError("There is no mount on {} in the container spec".format(destination))
+        return self._replace(mounts=[
+            options.apply_to(m) if m.destination == destination else m for m in self.mounts
+        ])
+
+    def validate(self):
+        for name in self.namespaces:
+            if name not in OPTIONAL_NAMESPACES + REQUIRED_NAMESPACES:
+                raise ValueError("Unsupported namespace in container spec: {}".format(name))
+        for name in REQUIRED_NAMESPACES:
+            if name not in self.namespaces:
+                raise ValueError("The {} namespace is required in a container spec".format(name))
+        if not any(m.destination == Path("/proc") and m.type == "proc" for m in self.mounts):
+            raise ValueError("/proc has to be mounted in the container")
+        if self.device_nodes and not any(m.destination == Path("/dev") for m in self.mounts):
+            raise ValueError("Device nodes need a /dev mount")
+        return self
+
+    def to_json(self):
+        # the result can be serialized with utils.PathEncoder
+        return self._asdict()
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            namespaces=tuple(data['namespaces']),
+            mounts=[Mount(Path(m[0]), *m[1:]) for m in data['mounts']],
+            device_nodes=[DeviceNode(*d) for d in data['device_nodes']],
+            loop_devices=data['loop_devices'],
+            hostname=data['hostname'],
+        )
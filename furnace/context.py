@@ -16,54 +16,230 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
 #
+import concurrent.futures
+import contextlib
+import errno
+import hashlib
 import json
 import logging
 import os
+import pickle
+import queue
+import select
+import shutil
 import signal
+import struct
 import subprocess
 import sys
-from pathlib import Path
-from typing import Union, List
+import threading
+import time
+import traceback
+from collections import namedtuple
+from pathlib import Path, PurePosixPath
+from typing import Union, List, Callable
 
 from . import pid1
-from .config import NAMESPACES, HOST_NETWORK_BIND_MOUNTS, BindMount
-from .libc import unshare, setns, CLONE_NEWPID
-from .utils import PathEncoder
+from .cache import RunCache, hash_fileobj, is_overlay, rootfs_fingerprint
+from .cgroup import ContainerCgroup
+from .config import NAMESPACES, HOST_NETWORK_BIND_MOUNTS, MOUNT_PROPAGATION_SLAVE, MOUNT_PROPAGATION_MODES, \
+    TMPFS_KERNEL_DEPENDENT_OPTIONS, BindMount, ContainerSpec, IdMapping
+from .hooks import Hooks, global_hooks, EVENT_START, EVENT_READY, EVENT_SPAWN, EVENT_EXIT, EVENT_TEARDOWN, \
+    EVENT_PAUSE, EVENT_RESUME
+from .image import ImageMounter, get_default_image_mounter, image_fingerprint
+from .libc import unshare, setns, pidfd_open, pidfd_send_signal, CLONE_NEWPID, CLONE_NEWUSER
+from .mountplan import BindMountPlan
+from .netns import NetnsPool, named_netns_path
+from .placement import Placement, NumaPacker, AUTO_NUMA_NODE, get_default_numa_packer
+from .prewarm import AccessRecorder, PrewarmProfileStore, prewarm
+from .rootdir import RootDirectory
+from .sampler import ProcessTreeSampler
+from .sharedbuffer import SharedBuffer
+from .supervisor import Supervisor
+from .userns import create_user_namespace, check_idmapped_mounts
+from .utils import PathEncoder, check_tmpfs_options
 
 logger = logging.getLogger(__name__)
 
+# Exit record of a process that was reparented to the container's PID1 and reaped by it.
+# returncode follows the subprocess convention (negative signal number if killed by a signal),
+# utime/stime/lifetime are in seconds, maxrss is in kilobytes.
+OrphanExit = namedtuple('OrphanExit', ['pid', 'argv', 'returncode', 'utime', 'stime', 'maxrss', 'lifetime'])
+
+# Space and inodes of a tmpfs mount of a container, size and used are in bytes
+TmpfsUsage = namedtuple('TmpfsUsage', ['size', 'used', 'inodes', 'inodes_used'])
+
 
 class ContainerPID1Manager:
-    def __init__(self, root_dir: Path, *, isolate_networking=False, bind_mounts=None):
-        self.root_dir = root_dir.resolve()
+    def __init__(self, root_dir: Path, *, isolate_networking=False, bind_mounts=None, orphan_exit_callback=None,
+                 netns_path=None, mountpoint_skeleton=False, read_only_root=False, hooks=None, spec=None,
+                 mount_propagation=MOUNT_PROPAGATION_SLAVE, placement=None, template=None,
+                 id_mapping: IdMapping = None):
+        # With a root_dir of None, the container runs on the root of the host
+        self.root_dir = root_dir.resolve() if root_dir is not None else None
+        if spec is None:
+            spec = ContainerSpec.host_root() if root_dir is None else ContainerSpec.default()
+        self.spec = spec.validate()
+        self.startup_timings = None
+        self.hooks = hooks if hooks is not None else Hooks(parent=global_hooks)
         self.isolate_networking = isolate_networking
+        self.netns_path = netns_path
+        self.mountpoint_skeleton = mountpoint_skeleton
+        self.read_only_root = read_only_root
+        if mount_propagation not in MOUNT_PROPAGATION_MODES:
+            raise ValueError("Unknown mount propagation mode: {}".format(mount_propagation))
+        self.mount_propagation = mount_propagation
+        self.placement = placement
         self.bind_mounts = bind_mounts
         if self.bind_mounts is None:
             self.bind_mounts = []
+        self.orphan_exit_callback = orphan_exit_callback
+        self.orphan_exit_thread = None
+        self.pidfd = None
+        self.id_mapping = id_mapping.validate() if id_mapping is not None else None
+        # A ContainerTemplate with the same settings, to clone PID1 from instead of starting it
+        self.template = template
+        if self.template is not None:
+            self.template.check_compatible(self)
+        if self.root_dir is None:
+            self.check_host_root_settings()
+        if self.id_mapping is not None and self.template is not None:
+            raise ValueError("Container templates can not be used with a user namespace")
 
-    def do_exec(self, control_read, control_write):
-        logger.debug("Executing {} {}".format(sys.executable, pid1.__file__))
-        params = json.dumps({
-            "loglevel": logging.getLevelName(logger.getEffectiveLevel()),
+    def check_host_root_settings(self):
+        # Everything that would change the filesystem of the host
+        if self.bind_mounts:
+            raise ValueError("Bind mounts need a root_dir")
+        if self.read_only_root or self.mountpoint_skeleton:
+            raise ValueError("read_only_root and mountpoint_skeleton need a root_dir")
+        if self.spec.device_nodes or self.spec.loop_devices:
+            raise ValueError("Device nodes need a root_dir, use ContainerSpec.host_root()")
+        # only /proc is mounted over the host's one, anything else would be created on the root of the host
+        if any(m.destination != Path('/proc') for m in self.spec.mounts):
+            raise ValueError("Only /proc can be mounted without a root_dir, use ContainerSpec.host_root()")
+        if self.template is not None:
+            raise ValueError("Container templates need a root_dir")
+        if self.id_mapping is not None:
+            raise ValueError("A user namespace needs a root_dir")
+
+    def get_pid1_params(self, control_read, control_write, userns_fd=None):
+        # The arguments of pid1.PID1, serializable with utils.PathEncoder
+        return {
             "root_dir": self.root_dir,
             "control_read": control_read,
             "control_write": control_write,
             "isolate_networking": self.isolate_networking,
             "bind_mounts": self.bind_mounts,
-        }, cls=PathEncoder)
+            "report_orphan_exits": self.orphan_exit_callback is not None,
+            "netns_path": self.netns_path,
+            "mountpoint_skeleton": self.mountpoint_skeleton,
+            "read_only_root": self.read_only_root,
+            "spec": self.spec.to_json(),
+            "mount_propagation": self.mount_propagation,
+            "placement": self.placement.to_json() if self.placement is not None else None,
+            "id_mapping": self.id_mapping.to_json() if self.id_mapping is not None else None,
+            "userns_fd": userns_fd,
+        }
+
+    def do_exec(self, control_read, control_write, userns_fd):
+        logger.debug("Executing {} {}".format(sys.executable, pid1.__file__))
+        params = json.dumps(dict(
+            self.get_pid1_params(control_read, control_write, userns_fd),
+            loglevel=logging.getLevelName(logger.getEffectiveLevel()),
+        ), cls=PathEncoder)
 
         os.execl(sys.executable, sys.executable, pid1.__file__, params)
 
     def wait_for_ready_signal(self):
         if os.read(self.control_read, 3) != b"RDY":
             raise RuntimeError("Container PID 1 did not send Ready signal")
+        # PID1 sends the time spent in each step of the startup after the ready signal
+        timings_length, = struct.unpack('=I', self.read_exactly(4))
+        self.startup_timings = json.loads(self.read_exactly(timings_length).decode('utf-8'))
+
+    def read_exactly(self, length):
+        data = b''
+        while len(data) < length:
+            chunk = os.read(self.control_read, length - len(data))
+            if not chunk:
+                raise RuntimeError("Container PID 1 closed the control pipe unexpectedly")
+            data += chunk
+        return data
 
     def start(self):
+        start_time = time.monotonic()
+        if self.hooks:
+            self.hooks.emit(EVENT_START, self)
         pipe_parent_read, pipe_child_write = os.pipe()
         pipe_child_read, pipe_parent_write = os.pipe()
+        try:
+            if self.template is not None:
+                self.start_from_template(pipe_child_read, pipe_child_write)
+            else:
+                self.start_new_process(pipe_child_read, pipe_child_write)
+        except BaseException:
+            os.close(pipe_parent_read)
+            os.close(pipe_parent_write)
+            raise
+        finally:
+            os.close(pipe_child_read)
+            os.close(pipe_child_write)
+        self.control_read = pipe_parent_read
+        self.control_write = pipe_parent_write
+        try:
+            self.wait_for_ready_signal()
+        except BaseException:
+            # PID1 failed during the startup, reap it and close its pipes
+            self.kill()
+            raise
+        if self.hooks:
+            self.hooks.emit(EVENT_READY, self, pid=self.pid, duration=time.monotonic() - start_time)
+        if self.orphan_exit_callback is not None:
+            self.orphan_exit_thread = threading.Thread(
+                name='furnace-orphan-exits-{}'.format(self.pid),
+                target=self.read_orphan_exits,
+                daemon=True,
+            )
+            self.orphan_exit_thread.start()
+
+    def start_from_template(self, pipe_child_read, pipe_child_write):
+        # PID1 is not our child, but it can be watched and killed through its pidfd
+        self.pid, self.pidfd = self.template.clone_pid1(
+            pipe_child_read, pipe_child_write,
+            report_orphan_exits=self.orphan_exit_callback is not None,
+            placement=self.placement,
+            netns_path=self.netns_path,
+        )
+        logger.debug("Container PID1 cloned from template, actual PID: {}".format(self.pid))
+
+    def start_new_process(self, pipe_child_read, pipe_child_write):
         os.set_inheritable(pipe_child_read, True)
         os.set_inheritable(pipe_child_write, True)
+        userns_fd = None
+        if self.id_mapping is not None:
+            userns_fd = self.create_user_namespace()
+        try:
+            self.start_pid1_process(pipe_child_read, pipe_child_write, userns_fd)
+        finally:
+            if userns_fd is not None:
+                os.close(userns_fd)
+
+    def create_user_namespace(self):
+        # PID1 joins the user namespace at the end of its startup. An unsupported kernel
+        # or filesystem is reported here, instead of failing in PID1.
+        userns_fd = create_user_namespace(self.id_mapping)
+        try:
+            sources = []
+            for source, _, _ in self.bind_mounts:
+                if Path(source).resolve() not in sources:
+                    sources.append(Path(source).resolve())
+            check_idmapped_mounts(userns_fd, [self.root_dir] + sources)
+        except BaseException:
+            os.close(userns_fd)
+            raise
+        os.set_inheritable(userns_fd, True)
+        return userns_fd
 
+    def start_pid1_process(self, pipe_child_read, pipe_child_write, userns_fd):
         # We unshare (change) the pid namespace here, and other namespaces after
         # the exec, because if we exec'd in the new mount namespace, it would open
         # files in the new namespace's root, and prevent us from umounting the old
@@ -72,18 +248,24 @@ class ContainerPID1Manager:
         # safe because unshare() affects the calling thread only.
         unshare(CLONE_NEWPID)
 
+        sys.stdout.flush()
+        sys.stderr.flush()
         self.pid = os.fork()
         if not self.pid:
             # this is the child process, will turn into PID1 in the container
             try:
-                # this method will NOT return
-                self.do_exec(pipe_child_read, pipe_child_write)
+                # this method will NOT return. Even without a rootfs, PID1 is a new
+                # interpreter: a lock held by an other thread of this process (e.g. the
+                # one of logging) at the time of the fork would never be released.
+                self.do_exec(pipe_child_read, pipe_child_write, userns_fd)
             except BaseException as e:
                 # We are the child process, do NOT run parent's __exit__ handlers
                 print(e, file=sys.stderr)
                 os._exit(1)
 
         logger.debug("Container PID1 actual PID: {}".format(self.pid))
+        # PID1 is not reaped before kill(), so the pid can not be reused yet
+        self.pidfd = open_pidfd(self.pid)
 
         # Reset the pid namespace of the parent process. /proc/self/ns/pid contains
         # a reference to the original pid namespace of the thread. New child processes
@@ -93,49 +275,158 @@ class ContainerPID1Manager:
         setns(original_pidns_fd, CLONE_NEWPID)
         os.close(original_pidns_fd)
 
-        os.close(pipe_child_read)
-        os.close(pipe_child_write)
-        self.control_read = pipe_parent_read
-        self.control_write = pipe_parent_write
-        self.wait_for_ready_signal()
+    def read_orphan_exits(self):
+        # After the ready signal, PID1 only sends newline-separated JSON exit
+        # records. The loop ends when PID1 dies and the pipe gets closed.
+        with open(self.control_read, 'rb', closefd=False) as control_file:
+            for line in control_file:
+                record = OrphanExit(**json.loads(line.decode('utf-8')))
+                try:
+                    self.orphan_exit_callback(record)
+                except Exception:
+                    logger.exception("Orphan exit callback failed for {}".format(record))
+
+    def send_signal(self, sig):
+        # PID1 is not reaped before kill(), so this can not hit an other process
+        if self.pidfd is not None:
+            pidfd_send_signal(self.pidfd, sig)
+        else:
+            os.kill(self.pid, sig)
 
     def kill(self):
         # Killing pid1 will kill every other process in the context
         # The context itself will implode without any references,
         # basically cleaning up everything
-        os.kill(self.pid, signal.SIGKILL)
-        os.waitpid(self.pid, 0)
+        if self.template is not None:
+            self.kill_cloned()
+        else:
+            self.send_signal(signal.SIGKILL)
+            os.waitpid(self.pid, 0)
+        if self.orphan_exit_thread is not None:
+            self.orphan_exit_thread.join()
+            self.orphan_exit_thread = None
+        for fd in (self.pidfd, self.control_read, self.control_write):
+            if fd is not None:
+                os.close(fd)
+        self.pidfd = self.control_read = self.control_write = None
+
+    def kill_cloned(self):
+        # A cloned PID1 is the child of the template process, which reaps it. The
+        # pidfd becomes readable when it exited.
+        try:
+            pidfd_send_signal(self.pidfd, signal.SIGKILL)
+        except ProcessLookupError:
+            # already reaped
+            return
+        select.select([self.pidfd], [], [])
+
+
+def open_pidfd(pid):
+    # Returns None on kernels without pidfd support (before 5.3)
+    try:
+        return pidfd_open(pid)
+    except OSError as e:
+        if e.errno != errno.ENOSYS:
+            raise
+        return None
+
+
+host_pidns_fd = None
+host_pidns_lock = threading.Lock()
+pidfd_setns_supported = None
+
+
+def get_host_pidns_fd():
+    # The original pid namespace of the process, opened once and shared by every
+    # SetnsContext. /proc/self/ns/pid is the namespace of the process itself, not the
+    # one its new children go to, so it does not change with setns(CLONE_NEWPID).
+    global host_pidns_fd
+    with host_pidns_lock:
+        if host_pidns_fd is None:
+            host_pidns_fd = os.open('/proc/self/ns/pid', os.O_RDONLY)
+        return host_pidns_fd
+
+
+def is_pidfd_setns_supported():
+    # setns() accepts a pidfd and a set of namespace flags since Linux 5.8. This is
+    # checked by "changing" the pid namespace of the children to our own namespace.
+    global pidfd_setns_supported
+    with host_pidns_lock:
+        if pidfd_setns_supported is None:
+            pidfd = open_pidfd(os.getpid())
+            if pidfd is None:
+                pidfd_setns_supported = False
+            else:
+                try:
+                    setns(pidfd, CLONE_NEWPID)
+                    pidfd_setns_supported = True
+                except OSError:
+                    pidfd_setns_supported = False
+                finally:
+                    os.close(pidfd)
+        return pidfd_setns_supported
 
 
 class SetnsContext:
-    def __init__(self, pid):
+    def __init__(self, pid, namespaces=None, pidfd=None, placement=None, cgroup=None):
         self.pid = pid
+        self.placement = placement
+        # the ContainerCgroup the new processes join
+        self.cgroup = cgroup
         # we open and close the ns file descriptors in the constructor
-        # and 'destructor' for two reasons:
+        # and close() for two reasons:
         # - if the context is used more than one time, it saves us the file opening
         #   neither the original ns, nor the container's ns is expected to change
         #   during the lifetime of this object
         # - we have to do it in a separate step from setns() calls, because after
         #   a mount namespace change, the next open might not work
-        self.orig_fds = []
+        # Only the original pid namespace has to be restored (the others are changed
+        # in the child after the fork), and that fd is shared by every context.
+        # If the kernel supports it, the pidfd of PID1 is used to join every
+        # namespace with a single setns() call, and no other fds are opened.
+        # The user namespace ("user" in namespaces) is joined last, as it drops the
+        # privileges needed to join the others.
         self.new_fds = []
-        self.orig_pidns = None
+        self.owned_fds = []
+        self.orig_pidns = get_host_pidns_fd()
         self.new_pidns = None
+        self.join_user_namespace = namespaces is not None and "user" in namespaces
+        if pidfd is not None and is_pidfd_setns_supported():
+            self.new_pidns = pidfd
+            flags = 0
+            for ns_name, ns_flag in NAMESPACES.items():
+                if ns_flag != CLONE_NEWPID and (namespaces is None or ns_name in namespaces):
+                    flags |= ns_flag
+            if self.join_user_namespace:
+                flags |= CLONE_NEWUSER
+            self.new_fds.append((pidfd, flags))
+            return
         for ns_name, ns_flag in NAMESPACES.items():
-            orig_ns_fd = os.open('/proc/self/ns/{}'.format(ns_name), os.O_RDONLY)
+            # namespaces that are not in the container are the same as the host's
+            if namespaces is not None and ns_name not in namespaces:
+                continue
             new_ns_fd = os.open('/proc/{}/ns/{}'.format(self.pid, ns_name), os.O_RDONLY)
+            self.owned_fds.append(new_ns_fd)
             if ns_flag == CLONE_NEWPID:
-                self.orig_pidns = orig_ns_fd
                 self.new_pidns = new_ns_fd
             else:
-                self.orig_fds.append((orig_ns_fd, ns_flag))
                 self.new_fds.append((new_ns_fd, ns_flag))
+        if self.join_user_namespace:
+            new_ns_fd = os.open('/proc/{}/ns/user'.format(self.pid), os.O_RDONLY)
+            self.owned_fds.append(new_ns_fd)
+            self.new_fds.append((new_ns_fd, CLONE_NEWUSER))
 
-    def __del__(self):
-        for fd, _ in self.orig_fds + self.new_fds:
+    @property
+    def fd_count(self):
+        return len(self.owned_fds)
+
+    def close(self):
+        for fd in self.owned_fds:
             os.close(fd)
-        os.close(self.orig_pidns)
-        os.close(self.new_pidns)
+        self.owned_fds = []
+
+    def __del__(self):
+        self.close()
 
     def __enter__(self):
         try:
@@ -146,43 +437,712 @@ class SetnsContext:
         return self
 
     def post_fork(self):
+        if self.cgroup is not None:
+            self.cgroup.add_process(0)
+        # before a user namespace drops the privileges of e.g. realtime I/O priorities
+        if self.placement is not None:
+            self.placement.apply()
         for new_ns_fd, ns_flag in self.new_fds:
             setns(new_ns_fd, ns_flag)
+        if self.join_user_namespace:
+            # root of the host is not mapped in the user namespace
+            os.setgroups([])
+            os.setgid(0)
+            os.setuid(0)
 
     def __exit__(self, type, value, traceback):
         setns(self.orig_pidns, CLONE_NEWPID)
         return False
 
 
+class RemoteTraceback(Exception):
+    # Set as the __cause__ of exceptions raised by ContainerContext.call(), to show where they came from
+    def __init__(self, traceback_text):
+        super().__init__(traceback_text)
+        self.traceback_text = traceback_text
+
+    def __str__(self):
+        return '\n"""\n{}"""'.format(self.traceback_text)
+
+
+class ContainerPopen(subprocess.Popen):
+    # Popen that emits lifecycle events. Only used if there are hooks to call.
+    def __init__(self, *args, hooks, **kwargs):
+        self.hooks = hooks
+        self.exit_reported = False
+        self.start_time = time.monotonic()
+        super().__init__(*args, **kwargs)
+        self.hooks.emit(EVENT_SPAWN, self, pid=self.pid, argv=self.args)
+
+    def report_exit(self):
+        if self.returncode is not None and not self.exit_reported:
+            self.exit_reported = True
+            self.hooks.emit(
+                EVENT_EXIT, self,
+                pid=self.pid, argv=self.args, returncode=self.returncode, duration=time.monotonic() - self.start_time,
+            )
+
+    def poll(self):
+        result = super().poll()
+        self.report_exit()
+        return result
+
+    def wait(self, timeout=None):
+        result = super().wait(timeout=timeout)
+        self.report_exit()
+        return result
+
+
 class ContainerContext:
-    def __init__(self, root_dir: Union[str, Path], *, isolate_networking: bool = False, bind_mounts: List[BindMount] = None):
-        if not isinstance(root_dir, Path):
+    def __init__(self, root_dir: Union[str, Path, None], *, isolate_networking: bool = False, bind_mounts: List[BindMount] = None,
+                 report_orphan_exits: bool = False, orphan_exit_callback: Callable[[OrphanExit], None] = None,
+                 netns: Union[str, Path] = None, netns_pool: NetnsPool = None, mountpoint_skeleton: bool = False,
+                 read_only_root: bool = False, spec: ContainerSpec = None, run_cache: RunCache = None,
+                 supervisor: Supervisor = None, sample_interval: float = None,
+                 mount_propagation: str = MOUNT_PROPAGATION_SLAVE, placement: Placement = None,
+                 numa_packer: NumaPacker = None, prewarm_profiles: PrewarmProfileStore = None,
+                 record_access_profile: bool = False, template=None, image_mounter: ImageMounter = None,
+                 pausable: bool = False, auto_pause_after: float = None, id_mapping: IdMapping = None,
+                 rootfs_fingerprint: str = None):
+        # With a root_dir of None, the container runs the binaries of the host, on the
+        # root of the host: it only gets its own namespaces and a /proc, which is much
+        # faster to start. Processes are still killed when the container stops.
+        if root_dir is not None and not isinstance(root_dir, Path):
             root_dir = Path(root_dir)
-        self.root_dir = root_dir.resolve()
-        if bind_mounts is None:
-            bind_mounts = []
-        if not isolate_networking:
+        self.root_dir = root_dir.resolve() if root_dir is not None else None
+        if self.root_dir is None and (run_cache is not None or prewarm_profiles is not None):
+            raise ValueError("run_cache and prewarm_profiles need a root_dir")
+        # root_dir can be a squashfs or ext4 image file. It is mounted read-only when the
+        # container starts, shared with the other containers using the same image.
+        self.image_path = None
+        self.image_mounter = image_mounter
+        if self.root_dir is not None and self.root_dir.is_file():
+            self.image_path = self.root_dir
+            read_only_root = True
+        # Joining a named network namespace, or getting one from a pool both imply isolated networking
+        if netns is not None and netns_pool is not None:
+            raise ValueError("Only one of netns and netns_pool can be specified")
+        self.netns_pool = netns_pool
+        netns_path = None
+        if netns is not None:
+            netns_path = named_netns_path(netns)
+            if not netns_path.exists():
+                raise FileNotFoundError("Network namespace {} does not exist".format(netns_path))
+        if netns_path is not None or netns_pool is not None:
+            isolate_networking = True
+        # a copy, the same list might be given to several containers (e.g. by run_matrix())
+        bind_mounts = list(bind_mounts) if bind_mounts is not None else []
+        # on the root of the host, resolv.conf is the host's anyway
+        if not isolate_networking and self.root_dir is not None:
             bind_mounts.extend(HOST_NETWORK_BIND_MOUNTS)
-        self.pid1 = ContainerPID1Manager(root_dir, isolate_networking=isolate_networking, bind_mounts=bind_mounts)
+        # The run_cache is keyed on the fingerprint of the rootfs, which is only computed
+        # for images and overlayfs mounts, where the changes made by the container can be
+        # seen in the upper layer too. Changes in a plain directory are not noticed, so for
+        # those, the caller has to give one, and the container can not change the rootfs.
+        self.watch_rootfs_changes = False
+        if run_cache is not None and self.image_path is None:
+            if is_overlay(self.root_dir):
+                self.watch_rootfs_changes = not read_only_root
+            elif rootfs_fingerprint is None or not read_only_root:
+                raise ValueError("run_cache needs an image or an overlayfs rootfs, or a rootfs_fingerprint and read_only_root")
+        self.run_cache = run_cache
+        self.given_rootfs_fingerprint = rootfs_fingerprint
+        self.rootfs_fingerprint = None
+        # the fingerprint of the rootfs right after the start, see get_run_cache_fingerprint()
+        self.started_rootfs_fingerprint = None
+        self.orphan_exit_queue = None
+        self.orphan_exit_callback = orphan_exit_callback
+        if report_orphan_exits or orphan_exit_callback is not None:
+            self.orphan_exit_queue = queue.Queue()
+            pid1_orphan_exit_callback = self.on_orphan_exit
+        else:
+            pid1_orphan_exit_callback = None
+        # With an id_mapping, the processes run in a user namespace, and the rootfs and the
+        # bind mounts are ID-mapped into it (Linux 5.12, and support from the filesystems),
+        # so the same rootfs can be shared by containers with different mappings, unchanged.
+        # The rootfs has to be a plain directory (e.g. on ext4, xfs or btrfs), an overlayfs
+        # mount can not be ID-mapped. Unsupported setups raise RuntimeError on __enter__.
+        self.pid1 = ContainerPID1Manager(
+            root_dir,
+            isolate_networking=isolate_networking,
+            bind_mounts=bind_mounts,
+            orphan_exit_callback=pid1_orphan_exit_callback,
+            netns_path=netns_path,
+            # the read-only root mode always uses skeletons for the missing mountpoints
+            mountpoint_skeleton=mountpoint_skeleton or read_only_root,
+            read_only_root=read_only_root,
+            spec=spec,
+            mount_propagation=mount_propagation,
+            template=template,
+            id_mapping=id_mapping,
+        )
         self.setns_context = None
+        self.placement = placement.validate() if placement is not None else None
+        self.numa_packer = numa_packer
+        self.numa_node = None
+        self.supervisor = supervisor
+        self.reserved_fds = 0
+        self.pid1_exited = False
+        self.sample_interval = sample_interval
+        self.sampler = None
+        self.shared_buffers = []
+        # With prewarm_profiles, the recorded profile of the rootfs is read into the
+        # page cache while PID1 starts. With record_access_profile, the files opened
+        # in the container are recorded, and the profile is stored when it stops.
+        if record_access_profile and prewarm_profiles is None:
+            raise ValueError("record_access_profile needs prewarm_profiles to store the profile")
+        self.prewarm_profiles = prewarm_profiles
+        self.record_access_profile = record_access_profile
+        self.prewarm_thread = None
+        self.access_recorder = None
+        self.access_profile = None
+        # opened on the first use of the file API (open(), stat(), ...)
+        self.root_directory = None
+        # A pausable container is put in its own cgroup, see pause(). With auto_pause_after,
+        # it is paused when no process started by run(), Popen() or call() was running for
+        # that many seconds, and resumed when the next one is started.
+        self.pausable = pausable or auto_pause_after is not None
+        self.auto_pause_after = auto_pause_after
+        self.cgroup = None
+        self.paused = False
+        self.pause_condition = threading.Condition()
+        self.busy = 0
+        self.last_activity = None
+        self.active_popens = []
+        self.auto_pause_thread = None
+        self.auto_pause_stopping = False
+
+    @property
+    def namespaces(self):
+        namespaces = list(self.pid1.spec.namespaces)
+        if self.pid1.isolate_networking:
+            namespaces.append("net")
+        if self.pid1.id_mapping is not None:
+            namespaces.append("user")
+        return namespaces
+
+    @property
+    def startup_timings(self):
+        # Seconds spent in each step of the PID1 startup, e.g. {"setup_root_mount": 0.002, ...}
+        return self.pid1.startup_timings
+
+    @property
+    def hooks(self) -> Hooks:
+        # Lifecycle event sinks of this container, see furnace.hooks
+        return self.pid1.hooks
+
+    def plan_bind_mounts(self) -> BindMountPlan:
+        # A dry run of what PID1 will do with the bind mounts. plan.cost shows
+        # how many mounts and rootfs writes are needed.
+        return BindMountPlan(self.root_dir, self.pid1.bind_mounts, use_skeleton=self.pid1.mountpoint_skeleton)
 
     def __enter__(self):
-        self.pid1.start()
-        self.setns_context = SetnsContext(self.pid1.pid)
+        check_tmpfs_options(self.pid1.spec.mounts, TMPFS_KERNEL_DEPENDENT_OPTIONS)
+        # first, an unusable placement is reported before anything has to be cleaned up
+        self.pid1.placement = self.resolve_placement()
+        if self.image_path is not None:
+            self.mount_image()
+        if self.run_cache is not None or self.prewarm_profiles is not None:
+            # before PID1 has a chance to change anything in the rootfs
+            if self.given_rootfs_fingerprint is not None:
+                self.rootfs_fingerprint = self.given_rootfs_fingerprint
+            elif self.image_path is not None:
+                self.rootfs_fingerprint = image_fingerprint(self.image_path)
+            else:
+                self.rootfs_fingerprint = rootfs_fingerprint(self.root_dir)
+        if self.prewarm_profiles is not None and not self.record_access_profile:
+            self.start_prewarm()
+        if self.supervisor is not None:
+            self.reserved_fds = self.estimate_fd_count()
+            self.supervisor.reserve_fds(self.reserved_fds)
+        if self.netns_pool is not None:
+            self.pid1.netns_path = self.netns_pool.acquire()
+        if self.pausable:
+            self.cgroup = ContainerCgroup.create()
+        try:
+            self.pid1.start()
+        except BaseException:
+            self.release_pooled_netns()
+            self.release_reserved_fds()
+            self.release_numa_node()
+            self.unmount_image()
+            self.remove_cgroup()
+            raise
+        if self.cgroup is not None:
+            self.cgroup.add_process(self.pid1.pid)
+        if self.watch_rootfs_changes:
+            self.started_rootfs_fingerprint = rootfs_fingerprint(self.root_dir)
+        self.setns_context = SetnsContext(self.pid1.pid, self.namespaces, self.pid1.pidfd, self.pid1.placement,
+                                          self.cgroup)
+        if self.supervisor is not None and self.pid1.pidfd is not None:
+            self.supervisor.watch(self.pid1.pidfd, self.pid1.pid, self.on_pid1_exit)
+        if self.sample_interval is not None:
+            self.sampler = ProcessTreeSampler(self.pid1.pid, interval=self.sample_interval).start()
+        if self.record_access_profile:
+            self.start_access_recording()
+        if self.auto_pause_after is not None:
+            self.last_activity = time.monotonic()
+            self.auto_pause_thread = threading.Thread(
+                name='furnace-auto-pause-{}'.format(self.pid1.pid), target=self.auto_pause_loop, daemon=True)
+            self.auto_pause_thread.start()
         return self
 
+    def start_prewarm(self):
+        profile = self.prewarm_profiles.load(self.rootfs_fingerprint)
+        if profile is None:
+            return
+        self.prewarm_thread = threading.Thread(
+            name='furnace-prewarm', target=prewarm, args=(self.root_dir, profile), daemon=True)
+        self.prewarm_thread.start()
+
+    def start_access_recording(self):
+        self.access_recorder = AccessRecorder(self.root_dir).start()
+        try:
+            self.call(self.access_recorder.mark_root_mount)
+        except BaseException:
+            self.access_recorder.stop()
+            self.access_recorder = None
+            raise
+
+    def stop_access_recording(self):
+        self.access_profile = self.access_recorder.stop()
+        self.access_recorder = None
+        self.prewarm_profiles.save(self.rootfs_fingerprint, self.access_profile)
+        logger.info("Recorded {} files ({} bytes) to prewarm {}".format(
+            len(self.access_profile.files), self.access_profile.total_bytes, self.root_dir))
+
+    def mount_image(self):
+        mountpoint = (self.image_mounter or get_default_image_mounter()).acquire(self.image_path)
+        self.root_dir = self.pid1.root_dir = mountpoint
+
+    def unmount_image(self):
+        if self.image_path is not None and self.root_dir != self.image_path:
+            (self.image_mounter or get_default_image_mounter()).release(self.root_dir)
+            self.root_dir = self.pid1.root_dir = self.image_path
+
+    def resolve_placement(self):
+        if self.placement is None or self.placement.numa_node is None:
+            return self.placement
+        packer = self.numa_packer or get_default_numa_packer()
+        node = self.placement.numa_node
+        if node == AUTO_NUMA_NODE:
+            node = self.numa_node = packer.assign()
+        try:
+            return self.placement.on_numa_node(node, packer.node_cpus[node])
+        except BaseException:
+            self.release_numa_node()
+            raise
+
+    def release_numa_node(self):
+        if self.numa_node is not None:
+            (self.numa_packer or get_default_numa_packer()).release(self.numa_node)
+            self.numa_node = None
+
+    def estimate_fd_count(self):
+        # The fds kept open while the container is running: two control pipe ends,
+        # the pidfd of PID1, the root directory of the file API and the namespace fds
+        # of the SetnsContext (none if the namespaces are joined through the pidfd)
+        if is_pidfd_setns_supported():
+            return 4
+        return 4 + len(self.namespaces)
+
+    def release_reserved_fds(self):
+        if self.supervisor is not None and self.reserved_fds:
+            self.supervisor.release_fds(self.reserved_fds)
+            self.reserved_fds = 0
+
+    def on_pid1_exit(self, pid):
+        # Called from the supervisor thread if PID1 exits before the container is stopped
+        self.pid1_exited = True
+        logger.error("Container PID1 ({}) of {} exited unexpectedly".format(pid, self.root_dir))
+
+    def check_pid1_alive(self):
+        if self.pid1_exited:
+            raise RuntimeError("Container PID1 ({}) is not running".format(self.pid1.pid))
+
+    def release_pooled_netns(self):
+        if self.netns_pool is not None and self.pid1.netns_path is not None:
+            self.netns_pool.release(self.pid1.netns_path)
+            self.pid1.netns_path = None
+
     def __exit__(self, type, value, traceback):
+        teardown_start = time.monotonic()
+        if self.sampler is not None:
+            self.sampler.stop()
+        if self.access_recorder is not None:
+            self.stop_access_recording()
+        if self.supervisor is not None and self.pid1.pidfd is not None:
+            self.supervisor.unwatch(self.pid1.pidfd)
+        self.stop_auto_pause()
+        if self.paused:
+            # frozen processes in the middle of a syscall would slow down the teardown
+            self.resume()
+        # the tmpfs mounts are gone with PID1
+        tmpfs_usage = self.get_final_tmpfs_usage() if self.hooks else None
+        self.setns_context.close()
         self.setns_context = None
+        if self.root_directory is not None:
+            self.root_directory.close()
+            self.root_directory = None
         self.pid1.kill()
+        self.release_pooled_netns()
+        self.release_reserved_fds()
+        self.release_numa_node()
+        self.unmount_image()
+        self.remove_cgroup()
+        if self.prewarm_thread is not None:
+            self.prewarm_thread.join()
+            self.prewarm_thread = None
+        if self.orphan_exit_queue is not None:
+            self.orphan_exit_queue.put(None)
+        if self.hooks:
+            self.hooks.emit(EVENT_TEARDOWN, self, duration=time.monotonic() - teardown_start, tmpfs_usage=tmpfs_usage)
         return False
 
+    def remove_cgroup(self):
+        if self.cgroup is not None:
+            self.cgroup.remove()
+            self.cgroup = None
+
+    def pause(self) -> float:
+        # Freezes every process of the container at once (cgroup v2 freezer), e.g. the
+        # daemons in an idle container kept for reuse. Returns the seconds it took.
+        with self.pause_condition:
+            return self.set_paused(True, auto=False)
+
+    def resume(self) -> float:
+        with self.pause_condition:
+            return self.set_paused(False, auto=False)
+
+    def set_paused(self, paused, *, auto):
+        # Called with pause_condition held
+        if self.cgroup is None:
+            raise RuntimeError("The container is not pausable, see the pausable argument")
+        if self.paused == paused:
+            return 0.0
+        duration = self.cgroup.set_frozen(paused)
+        self.paused = paused
+        self.pause_condition.notify_all()
+        logger.debug("Container {} {} in {:.3f} ms".format(
+            self.pid1.pid, "paused" if paused else "resumed", duration * 1000))
+        if self.hooks:
+            self.hooks.emit(EVENT_PAUSE if paused else EVENT_RESUME, self, duration=duration, auto=auto)
+        return duration
+
+    def begin_activity(self):
+        # New processes would be frozen right away in a paused container
+        if self.cgroup is None:
+            return
+        with self.pause_condition:
+            self.busy += 1
+            if self.paused:
+                self.set_paused(False, auto=True)
+
+    def end_activity(self, popen=None):
+        if self.cgroup is None:
+            return
+        with self.pause_condition:
+            self.busy -= 1
+            if popen is not None:
+                self.active_popens.append(popen)
+            self.last_activity = time.monotonic()
+            self.pause_condition.notify_all()
+
+    def is_idle(self):
+        # Called with pause_condition held. poll() does not block, and it is safe to
+        # call while the owner of the Popen waits for it in an other thread.
+        running = [popen for popen in self.active_popens if popen.poll() is None]
+        if len(running) != len(self.active_popens):
+            self.active_popens = running
+            self.last_activity = time.monotonic()
+        return self.busy == 0 and not running
+
+    def auto_pause_loop(self):
+        with self.pause_condition:
+            while not self.auto_pause_stopping:
+                if self.paused:
+                    self.pause_condition.wait()
+                    continue
+                idle = self.is_idle()
+                remaining = self.last_activity + self.auto_pause_after - time.monotonic()
+                if idle and remaining <= 0:
+                    try:
+                        self.set_paused(True, auto=True)
+                    except OSError as e:
+                        # tried again after a full period
+                        logger.warning("Could not pause container {}: {}".format(self.pid1.pid, e))
+                        self.last_activity = time.monotonic()
+                    continue
+                # running Popens are checked again after a full period
+                self.pause_condition.wait(remaining if idle else self.auto_pause_after)
+
+    def stop_auto_pause(self):
+        if self.auto_pause_thread is None:
+            return
+        with self.pause_condition:
+            self.auto_pause_stopping = True
+            self.pause_condition.notify_all()
+        self.auto_pause_thread.join()
+        self.auto_pause_thread = None
+
+    def on_orphan_exit(self, record: OrphanExit):
+        self.orphan_exit_queue.put(record)
+        if self.orphan_exit_callback is not None:
+            self.orphan_exit_callback(record)
+
+    def orphan_exits(self, timeout: float = None):
+        # Iterate over the exit records of processes that were reparented to PID1.
+        # Blocks until the next record arrives, or until the container is stopped.
+        # If timeout is given, the iteration also stops if no record arrived in
+        # that many seconds, so timeout=0 drains the records received so far.
+        if self.orphan_exit_queue is None:
+            raise RuntimeError("Orphan exit reporting was not enabled for this container")
+        while True:
+            try:
+                record = self.orphan_exit_queue.get(timeout=timeout)
+            except queue.Empty:
+                return
+            if record is None:
+                # put back the end marker, so that later iterations stop too
+                self.orphan_exit_queue.put(None)
+                return
+            yield record
+
+    def top(self):
+        # The processes of the container (with host pids) in the latest sample, the
+        # most CPU consuming first. Needs sample_interval; see self.sampler for the
+        # timelines, and for dumping the samples to a file.
+        if self.sampler is None:
+            raise RuntimeError("Process sampling was not enabled for this container")
+        return self.sampler.top()
+
+    def shared_buffer(self, size, *, name='furnace-shared-buffer') -> SharedBuffer:
+        # A memfd mapped in this process, inherited by every process started with run()
+        # or Popen() afterwards. They can open it as buffer.child_path. The buffer is
+        # not closed with the container, so the results can be read after it stopped.
+        # The size is sealed: a child truncating the file would crash this process with SIGBUS.
+        buffer = SharedBuffer(size, name=name)
+        buffer.seal_size()
+        self.shared_buffers.append(buffer)
+        return buffer
+
+    def add_shared_buffer_fds(self, kwargs):
+        self.shared_buffers = [buffer for buffer in self.shared_buffers if buffer.fd is not None]
+        if self.shared_buffers:
+            kwargs['pass_fds'] = tuple(kwargs.get('pass_fds', ())) + tuple(buffer.fd for buffer in self.shared_buffers)
+
     def run(self, *args, **kwargs):
-        with self.setns_context:
-            return subprocess.run(*args, **kwargs, preexec_fn=self.setns_context.post_fork)
+        self.check_pid1_alive()
+        self.add_shared_buffer_fds(kwargs)
+        self.begin_activity()
+        try:
+            if self.hooks:
+                return self.run_with_hooks(*args, **kwargs)
+            with self.setns_context:
+                return subprocess.run(*args, **kwargs, preexec_fn=self.setns_context.post_fork)
+        finally:
+            self.end_activity()
+
+    def run_with_hooks(self, *args, **kwargs):
+        # subprocess.run() does not expose the pid of the process, so the spawn event does not have one
+        argv = args[0] if args else kwargs.get('args')
+        self.hooks.emit(EVENT_SPAWN, self, pid=None, argv=argv)
+        start_time = time.monotonic()
+        returncode = None
+        try:
+            with self.setns_context:
+                result = subprocess.run(*args, **kwargs, preexec_fn=self.setns_context.post_fork)
+            returncode = result.returncode
+            return result
+        except subprocess.CalledProcessError as e:
+            returncode = e.returncode
+            raise
+        finally:
+            self.hooks.emit(EVENT_EXIT, self, pid=None, argv=argv, returncode=returncode, duration=time.monotonic() - start_time)
 
     def Popen(self, *args, **kwargs):
-        with self.setns_context:
-            return subprocess.Popen(*args, **kwargs, preexec_fn=self.setns_context.post_fork)
+        self.check_pid1_alive()
+        self.add_shared_buffer_fds(kwargs)
+        popen = None
+        self.begin_activity()
+        try:
+            with self.setns_context:
+                if self.hooks:
+                    popen = ContainerPopen(*args, **kwargs, preexec_fn=self.setns_context.post_fork, hooks=self.hooks)
+                else:
+                    popen = subprocess.Popen(*args, **kwargs, preexec_fn=self.setns_context.post_fork)
+            return popen
+        finally:
+            # the container is not paused automatically while the process is running
+            self.end_activity(popen)
+
+    def container_path(self, path) -> Path:
+        # The path of a file in the container, as seen from the host
+        return Path('/proc/{}/root'.format(self.pid1.pid)).joinpath(Path(path).relative_to('/'))
+
+    def get_root_directory(self) -> RootDirectory:
+        # The root of the container's mount namespace, for the file API below. Paths are
+        # resolved in the container, so symlinks can not point out of it. A single fd is
+        # kept open, so reading a file is a few syscalls instead of starting a process.
+        self.check_pid1_alive()
+        if self.root_directory is None:
+            self.root_directory = RootDirectory(Path('/proc/{}/root'.format(self.pid1.pid)))
+        return self.root_directory
+
+    def open(self, path, mode='r', buffering=-1, encoding=None, errors=None, newline=None):
+        return self.get_root_directory().open(path, mode, buffering, encoding, errors, newline)
+
+    def stat(self, path, *, follow_symlinks=True) -> os.stat_result:
+        return self.get_root_directory().stat(path, follow_symlinks=follow_symlinks)
+
+    def exists(self, path) -> bool:
+        return self.get_root_directory().exists(path)
+
+    def listdir(self, path='/'):
+        return self.get_root_directory().listdir(path)
+
+    def walk(self, top='/', topdown=True, onerror=None):
+        return self.get_root_directory().walk(top, topdown, onerror)
+
+    def tmpfs_usage(self):
+        # {destination: TmpfsUsage} of the tmpfs mounts of the spec, e.g. to size /dev/shm
+        # from what the jobs actually use. The teardown event has the last values.
+        usage = {}
+        for m in self.pid1.spec.mounts:
+            if m.type == "tmpfs":
+                st = self.get_root_directory().statvfs(m.destination)
+                usage[m.destination] = TmpfsUsage(
+                    size=st.f_blocks * st.f_frsize,
+                    used=(st.f_blocks - st.f_bfree) * st.f_frsize,
+                    inodes=st.f_files,
+                    inodes_used=st.f_files - st.f_ffree,
+                )
+        return usage
+
+    def get_final_tmpfs_usage(self):
+        try:
+            return self.tmpfs_usage()
+        except (OSError, RuntimeError):
+            # PID1 is already gone
+            return None
+
+    def get_run_cache_fingerprint(self):
+        # The rootfs might have been changed since the start (by run(), the file API or the
+        # outputs of an earlier cached_run()). The fingerprint of the rootfs before the start
+        # is only used while it is the same as right after the start (when PID1 might have
+        # created mountpoints), otherwise the changes are part of the fingerprint too.
+        if self.started_rootfs_fingerprint is None:
+            return self.rootfs_fingerprint
+        current = rootfs_fingerprint(self.root_dir)
+        if current == self.started_rootfs_fingerprint:
+            return self.rootfs_fingerprint
+        return hashlib.sha256('{}:{}'.format(self.rootfs_fingerprint, current).encode('utf-8')).hexdigest()
+
+    def cached_run(self, args, *, inputs=(), outputs=(), env=None, cwd=None, check=False):
+        # Like run(), but for deterministic commands, the result is looked up in the
+        # run_cache of the container first, keyed on the rootfs fingerprint, the
+        # arguments, the environment, the working directory and the content of the
+        # input files. On a hit, the output files are restored instead of running the
+        # command. stdout and stderr are always captured. inputs and outputs are
+        # absolute paths of regular files in the container, resolved in its root.
+        if self.run_cache is None:
+            raise RuntimeError("No run_cache was given to this container")
+        root = self.get_root_directory()
+        input_hashes = {}
+        for path in inputs:
+            with root.open(path, 'rb') as f:
+                input_hashes[str(path)] = hash_fileobj(f)
+        # with env=None, the command gets the environment of this process
+        effective_env = dict(os.environ) if env is None else env
+        key = RunCache.make_key(self.get_run_cache_fingerprint(), args, effective_env, cwd, input_hashes)
+        cached = self.run_cache.get(key)
+        if cached is not None:
+            meta, entry = cached
+            for index, (path, mode) in enumerate(meta['outputs']):
+                path = PurePosixPath('/').joinpath(path)
+                root.makedirs(path.parent)
+                # a symlink in place of the output is not followed, not even inside the container
+                fd = root.open_fd(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, mode)
+                with open(fd, 'wb') as target, entry.joinpath(str(index)).open('rb') as stored:
+                    os.fchmod(fd, mode)
+                    shutil.copyfileobj(stored, target)
+            result = subprocess.CompletedProcess(args, meta['returncode'], meta['stdout'], meta['stderr'])
+        else:
+            result = self.run(args, env=env, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            # failures are not cached, they might be caused by something outside of the key
+            if result.returncode == 0:
+                with contextlib.ExitStack() as stack:
+                    output_files = []
+                    for path in outputs:
+                        # O_NONBLOCK, so a FIFO does not block, it is refused by put() anyway
+                        fd = root.open_fd(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+                        output_files.append((path, stack.enter_context(open(fd, 'rb'))))
+                    self.run_cache.put(key, result.returncode, result.stdout, result.stderr, output_files)
+        if check:
+            result.check_returncode()
+        return result
+
+    def call(self, func, *args, **kwargs):
+        # Runs func(*args, **kwargs) in a forked child of this process, that is moved
+        # into the container's namespaces. This is much cheaper than starting a new
+        # interpreter in the container, but func and its arguments have to be usable
+        # after a fork (e.g. no locks held by other threads), and the result (or the
+        # exception) has to be picklable.
+        self.check_pid1_alive()
+        result_read, result_write = os.pipe()
+        # Anything left in the buffers would be written by both processes
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.begin_activity()
+        try:
+            with self.setns_context:
+                pid = os.fork()
+                if not pid:
+                    os.close(result_read)
+                    # this method will NOT return
+                    self.call_in_child(result_write, func, args, kwargs)
+            os.close(result_write)
+            with open(result_read, 'rb') as result_file:
+                data = result_file.read()
+            _, status = os.waitpid(pid, 0)
+        finally:
+            self.end_activity()
+        if not data:
+            raise ChildProcessError("Process running {} in the container died with status {}".format(func, status))
+        success, value, traceback_text = pickle.loads(data)
+        if success:
+            return value
+        value.__cause__ = RemoteTraceback(traceback_text)
+        raise value
+
+    def call_in_child(self, result_write, func, args, kwargs):
+        try:
+            self.setns_context.post_fork()
+            try:
+                result = (True, func(*args, **kwargs), None)
+            except BaseException as e:
+                result = (False, e, traceback.format_exc())
+            try:
+                data = pickle.dumps(result)
+            except Exception as e:
+                data = pickle.dumps((
+                    False,
+                    RuntimeError("Result of {} could not be pickled: {}".format(func, e)),
+                    traceback.format_exc(),
+                ))
+            with open(result_write, 'wb') as result_file:
+                result_file.write(data)
+        finally:
+            # We are the child process, do NOT run parent's __exit__ handlers
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(0)
+
+    def map(self, func, iterable, workers: int = None):
+        # Like the builtin map(), but every item is processed by call(), at most
+        # workers (by default the number of CPUs) at a time. Returns a list.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            return list(executor.map(lambda item: self.call(func, item), iterable))
 
     def interactive_shell(self, virtual_hostname='container'):
         print()
@@ -0,0 +1,200 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import concurrent.futures
+import logging
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+from pathlib import Path
+
+from .context import ContainerContext
+
+logger = logging.getLogger(__name__)
+
+# The result of the command in one rootfs. returncode is None if the command did not
+# run: error is set if the container could not be started, cancelled is True if it
+# was skipped or killed because of an other failure (see fail_fast). output is the
+# stdout and stderr of the command, interleaved. startup_time and run_time are seconds.
+MatrixEntry = namedtuple('MatrixEntry', ['name', 'root_dir', 'returncode', 'output', 'startup_time', 'run_time',
+                                         'error', 'cancelled'])
+
+
+class MatrixResult:
+    def __init__(self, entries, wall_time):
+        # in the order of the rootfses given to run_matrix()
+        self.entries = entries
+        self.wall_time = wall_time
+
+    @property
+    def ok(self):
+        return all(entry.returncode == 0 for entry in self.entries)
+
+    @property
+    def failed(self):
+        # The entries that ran, or tried to, and did not succeed
+        return [entry for entry in self.entries if entry.returncode != 0 and not entry.cancelled]
+
+    def __getitem__(self, name):
+        for entry in self.entries:
+            if entry.name == name:
+                return entry
+        raise KeyError(name)
+
+    def format_table(self):
+        lines = ["{:<24} {:>8} {:>12} {:>12}".format("rootfs", "result", "startup", "run")]
+        for entry in self.entries:
+            if entry.cancelled:
+                result = 'cancel'
+            elif entry.error is not None:
+                result = 'error'
+            else:
+                result = str(entry.returncode)
+            lines.append("{:<24} {:>8} {:>9.1f} ms {:>9.1f} ms".format(
+                entry.name, result, (entry.startup_time or 0) * 1000, (entry.run_time or 0) * 1000))
+        lines.append("wall time: {:.1f} ms".format(self.wall_time * 1000))
+        return '\n'.join(lines)
+
+
+def get_entry_names(root_dirs):
+    # The directory names, or the full paths if the names are not unique
+    names = [root_dir.name for root_dir in root_dirs]
+    if len(set(names)) != len(names):
+        names = [str(root_dir) for root_dir in root_dirs]
+    return names
+
+
+class MatrixRun:
+    def __init__(self, args, *, max_parallel, fail_fast, output, env, cwd, context_kwargs):
+        self.args = args
+        self.max_parallel = max_parallel
+        self.fail_fast = fail_fast
+        self.output = output
+        self.env = env
+        self.cwd = cwd
+        self.context_kwargs = context_kwargs
+        self.output_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.failed = False
+        self.running_containers = set()
+
+    def run(self, root_dirs):
+        names = get_entry_names(root_dirs)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
+            return list(executor.map(self.run_entry, names, root_dirs))
+
+    def write_line(self, name, line):
+        if self.output is None:
+            return
+        with self.output_lock:
+            self.output.write("[{}] {}".format(name, line.decode('utf-8', 'replace')))
+            if not line.endswith(b'\n'):
+                self.output.write('\n')
+            self.output.flush()
+
+    def run_entry(self, name, root_dir):
+        cancelled = MatrixEntry(name, root_dir, None, b'', None, None, None, True)
+        if self.failed:
+            return cancelled
+        start_time = time.monotonic()
+        container = ContainerContext(root_dir, **self.context_kwargs)
+        try:
+            container.__enter__()
+        except Exception as e:
+            logger.exception("Could not start a container in {}".format(root_dir))
+            self.on_failure()
+            return MatrixEntry(name, root_dir, None, b'', None, None, "{}: {}".format(type(e).__name__, e), False)
+        startup_time = time.monotonic() - start_time
+        try:
+            with self.lock:
+                if self.failed:
+                    return cancelled._replace(startup_time=startup_time)
+                self.running_containers.add(container)
+            start_time = time.monotonic()
+            try:
+                returncode, output = self.run_command(name, container)
+            except Exception as e:
+                returncode, output, error = None, b'', "{}: {}".format(type(e).__name__, e)
+            else:
+                error = None
+            run_time = time.monotonic() - start_time
+            with self.lock:
+                self.running_containers.discard(container)
+                # killed (or could not be started) because of an other failure, see on_failure()
+                if self.failed and returncode in (None, -signal.SIGKILL):
+                    return cancelled._replace(output=output, startup_time=startup_time, run_time=run_time)
+            if returncode != 0:
+                self.on_failure()
+            return MatrixEntry(name, root_dir, returncode, output, startup_time, run_time, error, False)
+        finally:
+            container.__exit__(None, None, None)
+
+    def run_command(self, name, container):
+        process = container.Popen(self.args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT, env=self.env, cwd=self.cwd)
+        output = []
+        with process:
+            for line in process.stdout:
+                output.append(line)
+                self.write_line(name, line)
+        return process.returncode, b''.join(output)
+
+    def on_failure(self):
+        if not self.fail_fast:
+            return
+        with self.lock:
+            self.failed = True
+            # Killing PID1 kills every process of the container, so the output pipes get closed
+            for container in self.running_containers:
+                try:
+                    container.pid1.send_signal(signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+            self.running_containers.clear()
+
+
+def run_matrix(root_dirs, args, *, max_parallel=None, fail_fast=False, output=sys.stdout, env=None, cwd=None,
+               **context_kwargs) -> MatrixResult:
+    # Runs the same command in a container of each rootfs (directories or image
+    # files), at most max_parallel at a time (by default all at once), so the wall
+    # time is close to the one of the slowest rootfs. The output lines are written
+    # to output with the name of the rootfs as a prefix, as they come (None disables
+    # this). With fail_fast, the first failure kills the running commands and skips
+    # the ones not started yet. The other keyword arguments go to ContainerContext.
+    # Usage:
+    #   result = run_matrix(['/srv/rootfs/debian-12', '/srv/rootfs/fedora-40'], ['/bin/sh', '-c', 'make check'])
+    #   print(result.format_table())
+    root_dirs = [Path(root_dir) for root_dir in root_dirs]
+    if not root_dirs:
+        return MatrixResult([], 0.0)
+    start_time = time.monotonic()
+    matrix_run = MatrixRun(
+        args,
+        max_parallel=max_parallel or len(root_dirs),
+        fail_fast=fail_fast,
+        output=output,
+        env=env,
+        cwd=cwd,
+        context_kwargs=context_kwargs,
+    )
+    entries = matrix_run.run(root_dirs)
+    return MatrixResult(entries, time.monotonic() - start_time)
@@ -0,0 +1,73 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import time
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# name: one of the event names below
+# timestamp: time.monotonic() at the time of the event
+# source: the ContainerContext (or ContainerPID1Manager) the event belongs to
+# data: event specific details, e.g. pid, argv, returncode or duration (in seconds)
+LifecycleEvent = namedtuple('LifecycleEvent', ['name', 'timestamp', 'source', 'data'])
+
+EVENT_START = 'start'           # PID1 is about to be started
+EVENT_READY = 'ready'           # PID1 sent the ready signal; data: pid, duration
+EVENT_SPAWN = 'spawn'           # a process was started with run() or Popen(); data: pid, argv
+EVENT_EXIT = 'exit'             # a process started with run() or Popen() was reaped; data: pid, returncode, duration
+EVENT_TEARDOWN = 'teardown'     # the container was stopped; data: duration, tmpfs_usage
+EVENT_PAUSE = 'pause'           # the processes of the container were frozen; data: duration, auto
+EVENT_RESUME = 'resume'         # the processes of the container were thawed; data: duration, auto
+
+
+class Hooks:
+    # A list of callables that receive LifecycleEvents. Events are passed on to
+    # the parent too, so sinks can be attached to a single container, or to
+    # global_hooks to observe every container.
+    # Emitters check the truth value first, so nothing is allocated when no sink is attached.
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.sinks = []
+
+    def add(self, sink):
+        self.sinks.append(sink)
+        return sink
+
+    def remove(self, sink):
+        self.sinks.remove(sink)
+
+    def __bool__(self):
+        return bool(self.sinks) or bool(self.parent)
+
+    def emit(self, name, source, **data):
+        self.dispatch(LifecycleEvent(name, time.monotonic(), source, data))
+
+    def dispatch(self, event):
+        for sink in self.sinks:
+            try:
+                sink(event)
+            except Exception:
+                logger.exception("Lifecycle hook {} failed on {} event".format(sink, event.name))
+        if self.parent is not None:
+            self.parent.dispatch(event)
+
+
+global_hooks = Hooks()
@@ -0,0 +1,181 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import errno
+import fcntl
+import hashlib
+import itertools
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+from .libc import mount, umount2, is_mount_point, loop_configure, loop_set_fd, MS_BIND, MS_PRIVATE, MS_RDONLY, \
+    MS_NODEV, MNT_DETACH, LOOP_CTL_GET_FREE, LO_FLAGS_READ_ONLY, LO_FLAGS_AUTOCLEAR, LO_FLAGS_DIRECT_IO
+
+logger = logging.getLogger(__name__)
+
+IMAGE_MOUNT_DIR = Path('/run/furnace/images')
+LOOP_CONTROL = Path('/dev/loop-control')
+# An other process can take the free loop device between LOOP_CTL_GET_FREE and attaching it
+LOOP_ATTACH_ATTEMPTS = 10
+
+SQUASHFS_MAGIC = (0, b'hsqs')
+EXT_MAGIC = (1080, b'\x53\xef')
+
+
+def detect_image_type(path: Path):
+    # Returns the filesystem type of an image file, 'squashfs' or 'ext4'
+    with open(str(path), 'rb') as f:
+        header = f.read(2048)
+    for fstype, (offset, magic) in (('squashfs', SQUASHFS_MAGIC), ('ext4', EXT_MAGIC)):
+        if header[offset:offset + len(magic)] == magic:
+            return fstype
+    raise ValueError("{} is not a squashfs or ext4 image".format(path))
+
+
+def image_fingerprint(image_path: Path) -> str:
+    # The counterpart of furnace.cache.rootfs_fingerprint for images
+    identity = ImageMounter.get_identity(Path(image_path).resolve())
+    return hashlib.sha256(json.dumps(identity).encode('utf-8')).hexdigest()
+
+
+def attach_loop_device(image_path: Path, *, direct_io=True):
+    # Attaches the image to a free loop device read-only, with autoclear: the device is
+    # detached when the last mount of it is gone. Returns the path and an open fd of the
+    # loop device, which has to be kept open until the device is mounted.
+    flags = LO_FLAGS_READ_ONLY | LO_FLAGS_AUTOCLEAR
+    if direct_io:
+        flags |= LO_FLAGS_DIRECT_IO
+    backing_fd = os.open(str(image_path), os.O_RDONLY | os.O_CLOEXEC)
+    control_fd = os.open(str(LOOP_CONTROL), os.O_RDWR | os.O_CLOEXEC)
+    try:
+        for _ in range(LOOP_ATTACH_ATTEMPTS):
+            number = fcntl.ioctl(control_fd, LOOP_CTL_GET_FREE)
+            loop_path = Path('/dev/loop{}'.format(number))
+            loop_fd = os.open(str(loop_path), os.O_RDONLY | os.O_CLOEXEC)
+            try:
+                try:
+                    loop_configure(loop_fd, backing_fd, flags, str(image_path))
+                except OSError as e:
+                    if e.errno not in (errno.EINVAL, errno.ENOTTY):
+                        raise
+                    # before Linux 5.8
+                    loop_set_fd(loop_fd, backing_fd, flags, str(image_path))
+                return loop_path, loop_fd
+            except OSError as e:
+                os.close(loop_fd)
+                if e.errno != errno.EBUSY:
+                    raise
+        raise RuntimeError("Could not find a free loop device for {}".format(image_path))
+    finally:
+        os.close(control_fd)
+        os.close(backing_fd)
+
+
+class ImageMounter:
+    # Mounts rootfs images (squashfs or ext4 files) read-only, through a loop device
+    # with direct I/O, so the page cache holds the files of the image only once, not
+    # the image file too. Every image is mounted once, and unmounted when the last
+    # container using it stops. The mounts are made in a private mount, so that they
+    # do not propagate into running containers.
+    def __init__(self, directory: Path = IMAGE_MOUNT_DIR, *, direct_io=True):
+        self.directory = Path(directory)
+        self.direct_io = direct_io
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        # image identity -> mountpoint
+        self.mountpoints = {}
+        # mountpoint -> [image identity, number of users]
+        self.users = {}
+        self.private_mount_ready = False
+
+    @classmethod
+    def get_identity(cls, image_path: Path):
+        # A changed image file gets a new mount, the containers using the old one keep it
+        st = image_path.stat()
+        return str(image_path), st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+    def make_private_mount(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if not is_mount_point(self.directory):
+            mount(self.directory, self.directory, None, MS_BIND, None)
+        mount(Path('none'), self.directory, None, MS_PRIVATE, None)
+        self.private_mount_ready = True
+
+    def acquire(self, image_path: Path) -> Path:
+        # Returns the directory where the image is mounted
+        image_path = Path(image_path).resolve()
+        identity = self.get_identity(image_path)
+        with self.lock:
+            mountpoint = self.mountpoints.get(identity)
+            if mountpoint is None:
+                mountpoint = self.mount_image(image_path)
+                self.mountpoints[identity] = mountpoint
+                self.users[mountpoint] = [identity, 0]
+            self.users[mountpoint][1] += 1
+            return mountpoint
+
+    def release(self, mountpoint: Path):
+        with self.lock:
+            self.users[mountpoint][1] -= 1
+            identity, count = self.users[mountpoint]
+            if count:
+                return
+            del self.users[mountpoint]
+            del self.mountpoints[identity]
+            self.unmount_image(mountpoint)
+
+    def mount_image(self, image_path: Path):
+        if not self.private_mount_ready:
+            self.make_private_mount()
+        fstype = detect_image_type(image_path)
+        mountpoint = self.directory.joinpath('image-{}-{}'.format(os.getpid(), next(self.counter)))
+        mountpoint.mkdir()
+        try:
+            loop_path, loop_fd = attach_loop_device(image_path, direct_io=self.direct_io)
+            try:
+                mount(loop_path, mountpoint, fstype, MS_RDONLY | MS_NODEV, None)
+            finally:
+                # with autoclear, the loop device is detached when this was its last user
+                os.close(loop_fd)
+        except BaseException:
+            mountpoint.rmdir()
+            raise
+        logger.debug("Mounted image {} on {}".format(image_path, mountpoint))
+        return mountpoint
+
+    def unmount_image(self, mountpoint: Path):
+        # The containers have their own copies of the mount, so it is detached
+        umount2(mountpoint, MNT_DETACH)
+        mountpoint.rmdir()
+        logger.debug("Unmounted image from {}".format(mountpoint))
+
+
+default_image_mounter = None
+default_image_mounter_lock = threading.Lock()
+
+
+def get_default_image_mounter():
+    global default_image_mounter
+    with default_image_mounter_lock:
+        if default_image_mounter is None:
+            default_image_mounter = ImageMounter()
+        return default_image_mounter
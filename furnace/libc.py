@@ -18,7 +18,10 @@
 #
 
 import ctypes
+import fcntl
 import logging
+import mmap
+import os
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
@@ -41,18 +44,136 @@ MS_SLAVE = 0x00080000
 MS_SHARED = 0x00100000
 MS_STRICTATIME = 0x01000000
 
+CLONE_PIDFD = 0x00001000
 CLONE_NEWNS = 0x00020000
 CLONE_NEWCGROUP = 0x02000000
 CLONE_NEWUTS = 0x04000000
 CLONE_NEWIPC = 0x08000000
+CLONE_NEWUSER = 0x10000000
 CLONE_NEWPID = 0x20000000
 CLONE_NEWNET = 0x40000000
 
 SYSCALL_NUM_CLONE = 56
 SYSCALL_NUM_GETPID = 39
+SYSCALL_NUM_SET_MEMPOLICY = 238
+SYSCALL_NUM_IOPRIO_SET = 251
+# syscalls added after 5.1 have the same number on every architecture
+SYSCALL_NUM_PIDFD_SEND_SIGNAL = 424
+SYSCALL_NUM_OPEN_TREE = 428
+SYSCALL_NUM_MOVE_MOUNT = 429
+SYSCALL_NUM_PIDFD_OPEN = 434
+SYSCALL_NUM_OPENAT2 = 437
+SYSCALL_NUM_MOUNT_SETATTR = 442
 
 MNT_DETACH = 2
 
+MPOL_DEFAULT = 0
+MPOL_PREFERRED = 1
+MPOL_BIND = 2
+MPOL_INTERLEAVE = 3
+
+MFD_CLOEXEC = 0x0001
+MFD_ALLOW_SEALING = 0x0002
+
+F_ADD_SEALS = 1033
+F_GET_SEALS = 1034
+F_SEAL_SEAL = 0x0001
+F_SEAL_SHRINK = 0x0002
+F_SEAL_GROW = 0x0004
+F_SEAL_WRITE = 0x0008
+
+FAN_CLOEXEC = 0x00000001
+FAN_NONBLOCK = 0x00000002
+FAN_CLASS_NOTIF = 0x00000000
+FAN_UNLIMITED_QUEUE = 0x00000010
+FAN_MARK_ADD = 0x00000001
+FAN_MARK_MOUNT = 0x00000010
+FAN_OPEN = 0x00000020
+FAN_Q_OVERFLOW = 0x00004000
+FAN_NOFD = -1
+
+PROT_READ = 0x1
+MAP_SHARED = 0x01
+
+LOOP_SET_FD = 0x4C00
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_SET_DIRECT_IO = 0x4C08
+LOOP_CONFIGURE = 0x4C0A
+LOOP_CTL_GET_FREE = 0x4C82
+LO_FLAGS_READ_ONLY = 1
+LO_FLAGS_AUTOCLEAR = 4
+LO_FLAGS_DIRECT_IO = 16
+
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_RT = 1
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+AT_FDCWD = -100
+AT_EMPTY_PATH = 0x1000
+AT_RECURSIVE = 0x8000
+
+OPEN_TREE_CLONE = 1
+OPEN_TREE_CLOEXEC = os.O_CLOEXEC
+MOVE_MOUNT_F_EMPTY_PATH = 0x00000004
+
+MOUNT_ATTR_RDONLY = 0x00000001
+MOUNT_ATTR_NOSUID = 0x00000002
+MOUNT_ATTR_NODEV = 0x00000004
+MOUNT_ATTR_NOEXEC = 0x00000008
+MOUNT_ATTR_IDMAP = 0x00100000
+
+RESOLVE_NO_XDEV = 0x01
+RESOLVE_NO_MAGICLINKS = 0x02
+RESOLVE_NO_SYMLINKS = 0x04
+RESOLVE_BENEATH = 0x08
+RESOLVE_IN_ROOT = 0x10
+
+
+class LoopInfo64(ctypes.Structure):
+    _fields_ = [
+        ("lo_device", ctypes.c_uint64),
+        ("lo_inode", ctypes.c_uint64),
+        ("lo_rdevice", ctypes.c_uint64),
+        ("lo_offset", ctypes.c_uint64),
+        ("lo_sizelimit", ctypes.c_uint64),
+        ("lo_number", ctypes.c_uint32),
+        ("lo_encrypt_type", ctypes.c_uint32),
+        ("lo_encrypt_key_size", ctypes.c_uint32),
+        ("lo_flags", ctypes.c_uint32),
+        ("lo_file_name", ctypes.c_char * 64),
+        ("lo_crypt_name", ctypes.c_char * 64),
+        ("lo_encrypt_key", ctypes.c_char * 32),
+        ("lo_init", ctypes.c_uint64 * 2),
+    ]
+
+
+class LoopConfig(ctypes.Structure):
+    _fields_ = [
+        ("fd", ctypes.c_uint32),
+        ("block_size", ctypes.c_uint32),
+        ("info", LoopInfo64),
+        ("reserved", ctypes.c_uint64 * 8),
+    ]
+
+
+class MountAttr(ctypes.Structure):
+    _fields_ = [
+        ("attr_set", ctypes.c_uint64),
+        ("attr_clr", ctypes.c_uint64),
+        ("propagation", ctypes.c_uint64),
+        ("userns_fd", ctypes.c_uint64),
+    ]
+
+
+class OpenHow(ctypes.Structure):
+    _fields_ = [
+        ("flags", ctypes.c_uint64),
+        ("mode", ctypes.c_uint64),
+        ("resolve", ctypes.c_uint64),
+    ]
+
 
 def mount(source: Path, target: Path, fstype, flags, data):
     if fstype is not None:
@@ -104,15 +225,34 @@ def pivot_root(new_root: Path, old_root: Path):
 
 
 def clone(flags, stack=0):
-    syscall = libc.syscall
-    syscall.restype = ctypes.c_int
-    syscall.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int)
-    result = syscall(SYSCALL_NUM_CLONE, flags, stack)
+    # Like fork() with a stack of 0, but the new process can be put into new namespaces
+    # at once (e.g. be the PID1 of a new pid namespace). Python's fork handlers are not
+    # run, so only call it from a single threaded process.
+    syscall = libc['syscall']
+    syscall.restype = ctypes.c_long
+    syscall.argtypes = (ctypes.c_long, ctypes.c_ulong, ctypes.c_void_p)
+    result = syscall(SYSCALL_NUM_CLONE, flags, stack or None)
     if result < 0:
-        raise OSError(abs(result), "clone failed")
+        raise OSError(ctypes.get_errno(), "clone failed")
     return result
 
 
+def clone_with_pidfd(flags):
+    # Like clone(), with CLONE_PIDFD (Linux 5.2): returns the pid and a pidfd of the new
+    # process in the parent, (0, None) in the child. Unlike pidfd_open(pid) called later,
+    # the pidfd can not refer to an other process that got the pid after the child exited.
+    syscall = libc['syscall']
+    syscall.restype = ctypes.c_long
+    syscall.argtypes = (ctypes.c_long, ctypes.c_ulong, ctypes.c_void_p, ctypes.POINTER(ctypes.c_int))
+    pidfd = ctypes.c_int(-1)
+    result = syscall(SYSCALL_NUM_CLONE, flags | CLONE_PIDFD, None, ctypes.byref(pidfd))
+    if result < 0:
+        raise OSError(ctypes.get_errno(), "clone failed")
+    if result == 0:
+        return 0, None
+    return result, pidfd.value
+
+
 def non_caching_getpid():
     # libc caches the return value of getpid, and does not refresh this
     # cache, if we call syscalls (e.g. clone) by hand.
@@ -123,3 +263,163 @@ def non_caching_getpid():
     if result < 0:
         raise OSError(abs(result), "getpid failed")
     return result
+
+
+def mount_setattr(target: Path, flags, *, attr_set=0, attr_clr=0, propagation=0, userns_fd=0, dir_fd=AT_FDCWD):
+    # Available since Linux 5.12, raises OSError with ENOSYS on older kernels
+    # With AT_EMPTY_PATH, the target is the mount of dir_fd, and has to be the string ''
+    # A separate function object is used, so that the argtypes of other syscall() users are not affected
+    syscall = libc['syscall']
+    syscall.restype = ctypes.c_long
+    syscall.argtypes = (ctypes.c_long, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint, ctypes.POINTER(MountAttr), ctypes.c_size_t)
+    attr = MountAttr(attr_set, attr_clr, propagation, userns_fd)
+    result = syscall(SYSCALL_NUM_MOUNT_SETATTR, dir_fd, str(target).encode('utf-8'), flags, ctypes.byref(attr), ctypes.sizeof(attr))
+    if result != 0:
+        raise OSError(ctypes.get_errno(), "mount_setattr failed on {}".format(target))
+
+
+def open_tree(path: Path, flags):
+    # Available since Linux 5.2, raises OSError with ENOSYS on older kernels. With
+    # OPEN_TREE_CLONE, returns an fd of a detached copy of the mount (tree) at path,
+    # that is unmounted when the fd is closed, unless it is attached with move_mount().
+    syscall = libc['syscall']
+    syscall.restype = ctypes.c_long
+    syscall.argtypes = (ctypes.c_long, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint)
+    result = syscall(SYSCALL_NUM_OPEN_TREE, AT_FDCWD, str(path).encode('utf-8'), flags)
+    if result < 0:
+        raise OSError(ctypes.get_errno(), "open_tree failed on {}".format(path))
+    return result
+
+
+def move_mount(from_fd, to_path: Path):
+    # Attaches the mount of from_fd (e.g. from open_tree()) at to_path
+    syscall = libc['syscall']
+    syscall.restype = ctypes.c_long
+    syscall.argtypes = (ctypes.c_long, ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint)
+    result = syscall(SYSCALL_NUM_MOVE_MOUNT, from_fd, b'', AT_FDCWD, str(to_path).encode('utf-8'), MOVE_MOUNT_F_EMPTY_PATH)
+    if result != 0:
+        raise OSError(ctypes.get_errno(), "move_mount failed to {}".format(to_path))
+
+
+def pidfd_open(pid, flags=0):
+    # Available since Linux 5.3, raises OSError with ENOSYS on older kernels
+    syscall = libc['syscall']
+    syscall.restype = ctypes.c_long
+    syscall.argtypes = (ctypes.c_long, ctypes.c_int, ctypes.c_uint)
+    result = syscall(SYSCALL_NUM_PIDFD_OPEN, pid, flags)
+    if result < 0:
+        raise OSError(ctypes.get_errno(), "pidfd_open failed for pid {}".format(pid))
+    return result
+
+
+def openat2(dir_fd, path, flags, mode=0, resolve=0):
+    # Available since Linux 5.6, raises OSError with ENOSYS on older kernels
+    syscall = libc['syscall']
+    syscall.restype = ctypes.c_long
+    syscall.argtypes = (ctypes.c_long, ctypes.c_int, ctypes.c_char_p, ctypes.POINTER(OpenHow), ctypes.c_size_t)
+    how = OpenHow(flags, mode, resolve)
+    result = syscall(SYSCALL_NUM_OPENAT2, dir_fd, str(path).encode('utf-8'), ctypes.byref(how), ctypes.sizeof(how))
+    if result < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno), str(path))
+    return result
+
+
+def pidfd_send_signal(pidfd, sig):
+    # Unlike kill(), this can not hit an other process that reused the pid
+    syscall = libc['syscall']
+    syscall.restype = ctypes.c_long
+    syscall.argtypes = (ctypes.c_long, ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_uint)
+    if syscall(SYSCALL_NUM_PIDFD_SEND_SIGNAL, pidfd, sig, None, 0) != 0:
+        raise OSError(ctypes.get_errno(), "pidfd_send_signal failed")
+
+
+def set_mempolicy(mode, nodes=()):
+    # nodes is a list of NUMA node numbers, turned into a bitmask of unsigned longs
+    bits_per_long = ctypes.sizeof(ctypes.c_ulong) * 8
+    mask = (ctypes.c_ulong * (max(nodes, default=0) // bits_per_long + 1))()
+    for node in nodes:
+        mask[node // bits_per_long] |= 1 << (node % bits_per_long)
+    syscall = libc['syscall']
+    syscall.restype = ctypes.c_long
+    syscall.argtypes = (ctypes.c_long, ctypes.c_int, ctypes.c_void_p, ctypes.c_ulong)
+    # the kernel ignores the last bit of maxnode
+    maxnode = len(mask) * bits_per_long + 1
+    if syscall(SYSCALL_NUM_SET_MEMPOLICY, mode, ctypes.addressof(mask) if nodes else None, maxnode if nodes else 0) != 0:
+        raise OSError(ctypes.get_errno(), "set_mempolicy failed")
+
+
+def ioprio_set(io_class, level, pid=0):
+    syscall = libc['syscall']
+    syscall.restype = ctypes.c_long
+    syscall.argtypes = (ctypes.c_long, ctypes.c_int, ctypes.c_int, ctypes.c_int)
+    if syscall(SYSCALL_NUM_IOPRIO_SET, IOPRIO_WHO_PROCESS, pid, (io_class << IOPRIO_CLASS_SHIFT) | level) != 0:
+        raise OSError(ctypes.get_errno(), "ioprio_set failed")
+
+
+def memfd_create(name, flags=MFD_CLOEXEC):
+    # os.memfd_create() is only available since Python 3.8
+    fd = libc.memfd_create(name.encode('utf-8'), ctypes.c_uint(flags))
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "memfd_create failed")
+    return fd
+
+
+def fanotify_init(flags, event_f_flags):
+    fd = libc.fanotify_init(ctypes.c_uint(flags), ctypes.c_uint(event_f_flags))
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "fanotify_init failed")
+    return fd
+
+
+def fanotify_mark(fanotify_fd, flags, mask, path: Path):
+    # The path is resolved in the mount namespace of the caller, so a mount of a
+    # container can be marked from a process that joined its namespaces
+    function = libc['fanotify_mark']
+    function.restype = ctypes.c_int
+    function.argtypes = (ctypes.c_int, ctypes.c_uint, ctypes.c_uint64, ctypes.c_int, ctypes.c_char_p)
+    if function(fanotify_fd, flags, mask, AT_FDCWD, str(path).encode('utf-8')) != 0:
+        raise OSError(ctypes.get_errno(), "fanotify_mark failed on {}".format(path))
+
+
+def get_page_residency(fd, size):
+    # Returns one byte per page of the file, with the lowest bit set if the page is in the page cache
+    if size == 0:
+        return b''
+    mmap_function = libc['mmap']
+    mmap_function.restype = ctypes.c_void_p
+    mmap_function.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long)
+    munmap_function = libc['munmap']
+    munmap_function.argtypes = (ctypes.c_void_p, ctypes.c_size_t)
+    mincore_function = libc['mincore']
+    mincore_function.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p)
+    address = mmap_function(None, size, PROT_READ, MAP_SHARED, fd, 0)
+    if address is None or address == ctypes.c_void_p(-1).value:
+        raise OSError(ctypes.get_errno(), "mmap failed")
+    try:
+        page_size = mmap.PAGESIZE
+        vector = (ctypes.c_ubyte * ((size + page_size - 1) // page_size))()
+        if mincore_function(address, size, vector) != 0:
+            raise OSError(ctypes.get_errno(), "mincore failed")
+        return bytes(vector)
+    finally:
+        munmap_function(address, size)
+
+
+def loop_configure(loop_fd, backing_fd, flags, file_name=''):
+    # Attaches the backing file and sets the flags with a single ioctl. Available
+    # since Linux 5.8, older kernels fail with EINVAL.
+    config = LoopConfig(fd=backing_fd)
+    config.info.lo_flags = flags
+    config.info.lo_file_name = file_name.encode('utf-8')[:63]
+    fcntl.ioctl(loop_fd, LOOP_CONFIGURE, config)
+
+
+def loop_set_fd(loop_fd, backing_fd, flags, file_name=''):
+    # The same as loop_configure() with the old ioctls. Direct I/O is set separately.
+    fcntl.ioctl(loop_fd, LOOP_SET_FD, backing_fd)
+    info = LoopInfo64(lo_flags=flags & ~(LO_FLAGS_READ_ONLY | LO_FLAGS_DIRECT_IO))
+    info.lo_file_name = file_name.encode('utf-8')[:63]
+    fcntl.ioctl(loop_fd, LOOP_SET_STATUS64, info)
+    if flags & LO_FLAGS_DIRECT_IO:
+        fcntl.ioctl(loop_fd, LOOP_SET_DIRECT_IO, 1)
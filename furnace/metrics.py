@@ -0,0 +1,250 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import abc
+import bisect
+import logging
+import os
+import socket
+import threading
+from pathlib import Path
+
+from .hooks import EVENT_READY, EVENT_SPAWN, EVENT_EXIT, EVENT_TEARDOWN, EVENT_PAUSE
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = tuple(2 ** exponent for exponent in range(20, 36, 2))    # 1 MiB .. 16 GiB
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(abc.ABC):
+    type_name = None
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.lock = threading.Lock()
+
+    @abc.abstractmethod
+    def render_samples(self):
+        pass
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help_text),
+            '# TYPE {} {}'.format(self.name, self.type_name),
+        ]
+        lines.extend(self.render_samples())
+        return lines
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def __init__(self, name, help_text):
+        super().__init__(name, help_text)
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def render_samples(self):
+        with self.lock:
+            return ['{} {}'.format(self.name, format_value(self.value))]
+
+
+class Gauge(Counter):
+    type_name = 'gauge'
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(sorted(buckets))
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.bucket_counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def render_samples(self):
+        with self.lock:
+            bucket_counts = list(self.bucket_counts)
+            total, count = self.sum, self.count
+        lines = []
+        cumulative = 0
+        for upper_bound, bucket_count in zip(self.buckets + (float('inf'),), bucket_counts):
+            cumulative += bucket_count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, format_value(upper_bound), cumulative))
+        lines.append('{}_sum {}'.format(self.name, format_value(total)))
+        lines.append('{}_count {}'.format(self.name, count))
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def get_or_create(self, cls, name, help_text, *args):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help_text, *args)
+            elif type(metric) is not cls:
+                raise ValueError("Metric {} is already registered as a {}".format(name, metric.type_name))
+            return metric
+
+    def counter(self, name, help_text) -> Counter:
+        return self.get_or_create(Counter, name, help_text)
+
+    def gauge(self, name, help_text) -> Gauge:
+        return self.get_or_create(Gauge, name, help_text)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.get_or_create(Histogram, name, help_text, buckets)
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        # The file is replaced atomically, so that e.g. the node_exporter textfile
+        # collector never sees a half-written file
+        path = Path(path)
+        temp_path = path.with_name('.{}.{}.tmp'.format(path.name, os.getpid()))
+        temp_path.write_text(self.render())
+        temp_path.replace(path)
+
+
+class MetricsSocketServer:
+    # Serves the rendered registry to every client that connects to a Unix socket,
+    # e.g. 'socat - UNIX-CONNECT:/run/furnace/metrics.sock'
+    def __init__(self, registry: MetricsRegistry, path):
+        self.registry = registry
+        self.path = Path(path)
+        self.socket = None
+        self.thread = None
+
+    def start(self):
+        if self.path.is_socket():
+            self.path.unlink()
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(str(self.path))
+        self.socket.listen(16)
+        self.thread = threading.Thread(name='furnace-metrics-server', target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                connection, _ = self.socket.accept()
+            except OSError:
+                # the listening socket was closed by stop()
+                return
+            with connection:
+                try:
+                    connection.sendall(self.registry.render().encode('utf-8'))
+                except OSError as e:
+                    logger.debug("Failed to send metrics: {}".format(e))
+
+    def stop(self):
+        # shutdown() wakes up the blocking accept() in the server thread
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        self.thread.join()
+        self.path.unlink()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+        return False
+
+
+class ContainerMetrics:
+    # A lifecycle hook that keeps the standard container metrics up-to-date. Usage:
+    #   global_hooks.add(ContainerMetrics(registry))
+    def __init__(self, registry: MetricsRegistry):
+        self.start_seconds = registry.histogram(
+            'furnace_container_start_seconds', 'Time from starting PID1 until it is ready')
+        self.teardown_seconds = registry.histogram(
+            'furnace_container_teardown_seconds', 'Time needed to stop a container')
+        self.active_containers = registry.gauge(
+            'furnace_containers_active', 'Number of running containers')
+        self.started_containers = registry.counter(
+            'furnace_containers_started_total', 'Number of containers started')
+        self.spawned_processes = registry.counter(
+            'furnace_processes_spawned_total', 'Number of processes started with run() or Popen()')
+        self.process_seconds = registry.histogram(
+            'furnace_process_seconds', 'Run time of processes started with run() or Popen()')
+        self.tmpfs_used_bytes = registry.histogram(
+            'furnace_container_tmpfs_used_bytes', 'Space used in the tmpfs mounts of a container when it stopped',
+            SIZE_BUCKETS)
+        self.freeze_seconds = registry.histogram(
+            'furnace_container_freeze_seconds', 'Time needed to freeze the processes of a container',
+            (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0))
+
+    def __call__(self, event):
+        if event.name == EVENT_READY:
+            self.start_seconds.observe(event.data['duration'])
+            self.started_containers.inc()
+            self.active_containers.inc()
+        elif event.name == EVENT_TEARDOWN:
+            self.teardown_seconds.observe(event.data['duration'])
+            if event.data.get('tmpfs_usage') is not None:
+                self.tmpfs_used_bytes.observe(sum(usage.used for usage in event.data['tmpfs_usage'].values()))
+            self.active_containers.dec()
+        elif event.name == EVENT_PAUSE:
+            self.freeze_seconds.observe(event.data['duration'])
+        elif event.name == EVENT_SPAWN:
+            self.spawned_processes.inc()
+        elif event.name == EVENT_EXIT:
+            self.process_seconds.observe(event.data['duration'])
@@ -0,0 +1,277 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import os
+import stat
+from collections import namedtuple
+from pathlib import Path
+
+from .config import BindMount
+from .libc import mount, mount_setattr, get_all_mounts, MS_BIND, MS_REC, MS_REMOUNT, MS_RDONLY, MS_NOSUID, MS_NODEV, \
+    AT_RECURSIVE, MOUNT_ATTR_RDONLY
+
+logger = logging.getLogger(__name__)
+
+PlannedBindMount = namedtuple('PlannedBindMount', ['source', 'destination', 'readonly', 'recursive', 'is_file'])
+
+# requested: number of bind mounts given by the caller
+# duplicates: bind mounts dropped, because a later one had the same destination
+# collapsed: bind mounts dropped, because an ancestor bind mount already covers them
+# mounts: bind mount syscalls needed for the requested bind mounts
+# readonly_remounts: extra remount syscalls to make bind mounts read-only
+# rootfs_writes: files and directories created in the rootfs (or bind mount sources) as mountpoints
+# skeleton_dirs: directories replaced by a tmpfs skeleton, so that mountpoints can be created without rootfs writes
+# skeleton_mounts: extra mount syscalls needed to build the skeletons
+BindMountPlanCost = namedtuple('BindMountPlanCost', [
+    'requested', 'duplicates', 'collapsed', 'mounts', 'readonly_remounts',
+    'rootfs_writes', 'skeleton_dirs', 'skeleton_mounts',
+])
+
+
+def relative_destination(destination: Path) -> Path:
+    destination = Path(destination)
+    if destination.is_absolute():
+        destination = destination.relative_to("/")
+    return destination
+
+
+def make_read_only_recursive(path: Path):
+    # Makes the mount at path and every mount below it read-only
+    try:
+        mount_setattr(path, AT_RECURSIVE, attr_set=MOUNT_ATTR_RDONLY)
+        return
+    except OSError as e:
+        logger.debug("mount_setattr failed ({}), remounting one by one".format(e))
+    path = path.absolute()
+    for mountpoint in get_all_mounts():
+        if mountpoint == path or path in mountpoint.parents:
+            mount(Path(), mountpoint, None, MS_REMOUNT | MS_BIND | MS_RDONLY, None)
+
+
+class BindMountPlan:
+    # Turns a list of bind mounts into an ordered list of mount operations:
+    # - bind mounts with the same destination are deduplicated (the last one wins, as it would shadow the others)
+    # - bind mounts are sorted parent-first, so a bind mount never hides a previous one
+    # - a bind mount whose source and destination are at the same relative position inside an
+    #   ancestor bind mount is dropped; if its source is a mountpoint, the ancestor is made recursive,
+    #   but only if there are no other mounts under its source, which it would expose too
+    # - read-only remounts are done in a separate pass after all the bind mounts, so
+    #   mountpoints can still be created inside bind mounts that will be read-only
+    # - with use_skeleton, missing mountpoints are not created in the rootfs. Instead, the nearest
+    #   existing parent directory is replaced by a tmpfs containing bind mounts of its original entries.
+    def __init__(self, root_dir: Path, bind_mounts, *, use_skeleton=False):
+        self.root_dir = Path(root_dir)
+        self.use_skeleton = use_skeleton
+        self.requested = len(bind_mounts)
+        self.duplicates = 0
+        self.collapsed = 0
+        self.host_mounts = set(get_all_mounts())
+        self.binds = self.collapse(self.sort(self.deduplicate(bind_mounts)))
+        self.readonly_remounts = []
+        for bind in self.binds:
+            if bind.readonly:
+                self.readonly_remounts.append(bind.destination)
+                if bind.recursive:
+                    # remounting read-only is not recursive, submounts have to be flipped one by one
+                    self.readonly_remounts.extend(sorted(
+                        bind.destination.joinpath(submount.relative_to(bind.source))
+                        for submount in self.host_mounts if bind.source in submount.parents
+                    ))
+        self.skeleton_dirs = []
+        self.skeleton_devices = set()
+        self.known_dirs = set()
+
+    def deduplicate(self, bind_mounts):
+        by_destination = {}
+        for source, destination, readonly in bind_mounts:
+            destination = relative_destination(destination)
+            if destination in by_destination:
+                self.duplicates += 1
+                del by_destination[destination]
+            by_destination[destination] = BindMount(Path(source), destination, readonly)
+        return list(by_destination.values())
+
+    @classmethod
+    def sort(cls, bind_mounts):
+        # Sorting by path components puts every directory before everything inside it
+        return sorted(bind_mounts, key=lambda bind: bind.destination.parts)
+
+    def find_covering_bind(self, planned, destination):
+        # the nearest ancestor bind mount of destination, if there is one
+        for bind in reversed(planned):
+            if bind.destination in destination.parents:
+                return bind
+        return None
+
+    def collapse(self, bind_mounts):
+        planned = []
+        for source, destination, readonly in bind_mounts:
+            resolved_source = source.resolve()
+            covering = self.find_covering_bind(planned, destination)
+            if covering is not None and covering.readonly == readonly and not covering.is_file:
+                try:
+                    relative_source = resolved_source.relative_to(covering.source)
+                except ValueError:
+                    relative_source = None
+                if relative_source is not None and relative_source == destination.relative_to(covering.destination):
+                    if resolved_source not in self.host_mounts:
+                        self.collapsed += 1
+                        continue
+                    # the covering bind mount has to be recursive to show this mount too, which
+                    # is only the same if it does not show any other host mounts with it
+                    other_mounts = {mountpoint for mountpoint in self.host_mounts
+                                    if covering.source in mountpoint.parents and mountpoint != resolved_source}
+                    if not other_mounts:
+                        self.collapsed += 1
+                        planned[planned.index(covering)] = covering._replace(recursive=True)
+                        continue
+            planned.append(PlannedBindMount(resolved_source, destination, readonly, False, resolved_source.is_file()))
+        return planned
+
+    def host_path(self, destination: Path) -> Path:
+        # Where a destination would be on the host after the bind mounts before it are done
+        covering = self.find_covering_bind(self.binds, destination)
+        if covering is None:
+            return self.root_dir.joinpath(destination)
+        return covering.source.joinpath(destination.relative_to(covering.destination))
+
+    def missing_components(self, destination: Path):
+        missing = 0
+        path = destination
+        while path != Path('.') and not os.path.lexists(str(self.host_path(path))):
+            missing += 1
+            path = path.parent
+        return missing, path
+
+    @property
+    def cost(self):
+        rootfs_writes = 0
+        skeleton_dirs = set()
+        skeleton_mounts = 0
+        for bind in self.binds:
+            missing, existing_parent = self.missing_components(bind.destination)
+            if not missing:
+                continue
+            if not self.use_skeleton:
+                rootfs_writes += missing
+            elif existing_parent not in skeleton_dirs:
+                skeleton_dirs.add(existing_parent)
+                entries = os.listdir(str(self.host_path(existing_parent)))
+                skeleton_mounts += 1 + len(entries)
+        return BindMountPlanCost(
+            requested=self.requested,
+            duplicates=self.duplicates,
+            collapsed=self.collapsed,
+            mounts=len(self.binds),
+            readonly_remounts=len(self.readonly_remounts),
+            rootfs_writes=rootfs_writes,
+            skeleton_dirs=len(skeleton_dirs),
+            skeleton_mounts=skeleton_mounts,
+        )
+
+    def execute(self):
+        for bind in self.binds:
+            destination = self.root_dir.joinpath(bind.destination)
+            self.create_mount_target(bind.is_file, destination)
+            flags = MS_BIND
+            if bind.recursive:
+                flags = flags | MS_REC
+            mount(bind.source, destination, None, flags, None)
+        for relative_path in self.readonly_remounts:
+            # "Read-only bind mounts" are actually an illusion, a special feature of the kernel,
+            # which is why we have to make the bind mount read-only in a separate call.
+            # See https://lwn.net/Articles/281157/
+            mount(Path(), self.root_dir.joinpath(relative_path), None, MS_REMOUNT | MS_BIND | MS_RDONLY, None)
+
+    def create_root_mount_targets(self):
+        # Creates the mountpoints that are not inside an other bind mount in advance, so
+        # the rootfs (with its skeletons) can be made read-only before execute(). The rest
+        # are created by execute(), on the bind mounts, which are new (writable) mounts.
+        for bind in self.binds:
+            if self.find_covering_bind(self.binds, bind.destination) is None:
+                self.create_mount_target(bind.is_file, self.root_dir.joinpath(bind.destination))
+
+    def create_mount_target(self, is_file, destination: Path):
+        if self.use_skeleton:
+            self.create_skeleton_parent(destination, replace_symlink=is_file)
+        if is_file:
+            if destination.is_symlink():
+                destination.unlink()
+            elif destination.exists():
+                # touch() would fail on a read-only filesystem, even if the file exists
+                return
+            self.make_dirs(destination.parent)
+            destination.touch()
+        else:
+            self.make_dirs(destination)
+
+    def make_dirs(self, path: Path):
+        # A cache of the directories already created or seen saves a lot of
+        # syscalls, as bind mounts tend to be next to each other
+        if path in self.known_dirs:
+            return
+        path.mkdir(parents=True, exist_ok=True)
+        self.known_dirs.add(path)
+
+    def make_skeletons_read_only(self):
+        for path in self.skeleton_dirs:
+            mount(Path(), path, None, MS_REMOUNT | MS_BIND | MS_RDONLY | MS_NOSUID | MS_NODEV, None)
+
+    def create_skeleton_parent(self, destination: Path, replace_symlink=False):
+        if replace_symlink and destination.is_symlink():
+            # a symlink can not be a mountpoint, so it has to be replaced in a skeleton
+            if os.stat(str(destination.parent)).st_dev not in self.skeleton_devices:
+                self.create_skeleton(destination.parent)
+            return
+        path = destination
+        while not os.path.lexists(str(path)):
+            path = path.parent
+        if path != destination and os.stat(str(path)).st_dev not in self.skeleton_devices:
+            self.create_skeleton(path)
+
+    def create_skeleton(self, path: Path):
+        # Replaces the directory at path with a tmpfs, where all the original
+        # entries are bind mounted (or copied, in case of symlinks). New
+        # mountpoints can then be created in the tmpfs, without touching the
+        # original directory.
+        logger.debug("Creating mountpoint skeleton on {}".format(path))
+        original_stat = path.stat()
+        original_fd = os.open(str(path), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            entries = list(os.scandir(str(path)))
+            mount(Path("tmpfs"), path, "tmpfs", MS_NOSUID | MS_NODEV, "mode={:o}".format(stat.S_IMODE(original_stat.st_mode)))
+            os.chown(str(path), original_stat.st_uid, original_stat.st_gid)
+            for entry in entries:
+                target = path.joinpath(entry.name)
+                original = Path('/proc/self/fd/{}'.format(original_fd), entry.name)
+                if entry.is_symlink():
+                    os.symlink(os.readlink(str(original)), str(target))
+                    continue
+                if entry.is_dir():
+                    target.mkdir()
+                else:
+                    target.touch()
+                mount(original, target, None, MS_BIND | MS_REC, None)
+        finally:
+            os.close(original_fd)
+        self.skeleton_dirs.append(path)
+        self.skeleton_devices.add(path.stat().st_dev)
+        # directories below were cached as existing on the original filesystem
+        self.known_dirs = {known for known in self.known_dirs if path not in known.parents}
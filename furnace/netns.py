@@ -0,0 +1,184 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import fcntl
+import itertools
+import logging
+import os
+import socket
+import struct
+import sys
+import threading
+from pathlib import Path
+from typing import Union
+
+from .libc import unshare, setns, mount, umount2, MS_BIND, MNT_DETACH, CLONE_NEWNET
+
+logger = logging.getLogger(__name__)
+
+# The same directory is used by 'ip netns', so named namespaces created by it can be joined by name
+NAMED_NETNS_DIR = Path('/run/netns')
+NETNS_POOL_DIR = Path('/run/furnace/netns')
+
+SIOCGIFFLAGS = 0x8913
+SIOCSIFFLAGS = 0x8914
+IFF_UP = 0x1
+
+
+def named_netns_path(name: Union[str, Path]) -> Path:
+    # A bare name refers to a namespace created by 'ip netns add', anything else is a path
+    name = Path(name)
+    if name.is_absolute() or len(name.parts) > 1:
+        return name
+    return NAMED_NETNS_DIR.joinpath(name)
+
+
+def bring_up_loopback():
+    # struct ifreq is the interface name followed by a union, of which we only use the flags
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        ifreq = fcntl.ioctl(sock, SIOCGIFFLAGS, struct.pack('16sH22x', b'lo', 0))
+        flags = struct.unpack('16sH22x', ifreq)[1]
+        if not flags & IFF_UP:
+            fcntl.ioctl(sock, SIOCSIFFLAGS, struct.pack('16sH22x', b'lo', flags | IFF_UP))
+
+
+def run_in_child(function, *args):
+    # Namespace changes are done in a short-lived child process, so that a
+    # failure half-way through can not leave the calling thread in a wrong namespace
+    pid = os.fork()
+    if not pid:
+        try:
+            os._exit(0 if function(*args) else 1)
+        except BaseException as e:
+            print(e, file=sys.stderr)
+            os._exit(2)
+    _, status = os.waitpid(pid, 0)
+    if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 2:
+        raise RuntimeError("Network namespace operation {} failed".format(function.__name__))
+    return os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+
+def _create_and_pin(path: Path):
+    unshare(CLONE_NEWNET)
+    bring_up_loopback()
+    mount(Path('/proc/self/ns/net'), path, None, MS_BIND, None)
+    return True
+
+
+def _is_clean(path: Path):
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        setns(fd, CLONE_NEWNET)
+    finally:
+        os.close(fd)
+    if [name for _, name in socket.if_nameindex()] != ['lo']:
+        return False
+    bring_up_loopback()
+    return True
+
+
+def create_netns(path: Path):
+    # Creates a network namespace with the loopback interface up, and keeps it
+    # alive without any processes by bind mounting it to path (like 'ip netns add')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.touch()
+    try:
+        run_in_child(_create_and_pin, path)
+    except BaseException:
+        path.unlink()
+        raise
+
+
+def destroy_netns(path: Path):
+    try:
+        umount2(path, MNT_DETACH)
+    except OSError as e:
+        logger.warning("Failed to umount network namespace {}: {}".format(path, e))
+    path.unlink()
+
+
+class NetnsPool:
+    def __init__(self, size: int, *, directory: Path = NETNS_POOL_DIR):
+        self.size = size
+        self.directory = Path(directory)
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.free = []
+        self.in_use = set()
+        self.closed = False
+        self.fill()
+
+    def new_path(self):
+        return self.directory.joinpath('pool-{}-{}-{}'.format(os.getpid(), id(self), next(self.counter)))
+
+    def fill(self):
+        with self.lock:
+            missing = self.size - len(self.free) - len(self.in_use)
+        for _ in range(max(missing, 0)):
+            path = self.new_path()
+            create_netns(path)
+            with self.lock:
+                self.free.append(path)
+
+    def acquire(self) -> Path:
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Network namespace pool is already closed")
+            if self.free:
+                path = self.free.pop()
+                self.in_use.add(path)
+                return path
+        # The pool ran dry, fall back to creating a namespace on demand
+        path = self.new_path()
+        create_netns(path)
+        with self.lock:
+            self.in_use.add(path)
+        return path
+
+    def release(self, path: Path):
+        # Only namespaces without leftover interfaces (e.g. a veth pair created
+        # by a job) are recycled, everything else is thrown away
+        with self.lock:
+            self.in_use.discard(path)
+            keep = not self.closed and len(self.free) + len(self.in_use) < self.size
+        if keep:
+            try:
+                keep = run_in_child(_is_clean, path)
+            except RuntimeError:
+                keep = False
+        if keep:
+            with self.lock:
+                self.free.append(path)
+        else:
+            logger.debug("Destroying network namespace {}".format(path))
+            destroy_netns(path)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            free, self.free = self.free, []
+        for path in free:
+            destroy_netns(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+        return False
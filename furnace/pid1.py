@@ -17,31 +17,75 @@
 # along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import array
 import json
 import logging
 import os
+# os.wait4() imports it on the first call, which would fail after pivot_root
+import resource  # NOQA: F401 'resource' imported but unused
 import signal
+import socket
 import stat
+import struct
 import subprocess
 import sys
+import time
+import traceback
 from socket import sethostname
 from pathlib import Path
 
-from furnace.libc import unshare, mount, umount2, non_caching_getpid, pivot_root, is_mount_point, \
-    MS_BIND, MS_REC, MS_SLAVE, MS_REMOUNT, MS_RDONLY, CLONE_NEWPID, CLONE_NEWNET, MNT_DETACH
-from furnace.config import NAMESPACES, CONTAINER_MOUNTS, CONTAINER_DEVICE_NODES, HOSTNAME, BindMount, DeviceNode
+from furnace.libc import unshare, setns, mount, umount2, non_caching_getpid, pivot_root, is_mount_point, clone_with_pidfd, \
+    MS_BIND, MS_REC, MS_SLAVE, MS_PRIVATE, CLONE_NEWPID, CLONE_NEWNET, CLONE_NEWNS, CLONE_NEWUSER, MNT_DETACH
+from furnace.config import NAMESPACES, BindMount, DeviceNode, ContainerSpec, IdMapping, MOUNT_PROPAGATION_SLAVE, \
+    MOUNT_PROPAGATION_ROOTFS_SLAVE, MOUNT_PROPAGATION_PRIVATE
+from furnace.mountplan import BindMountPlan, make_read_only_recursive
+from furnace.placement import Placement
+from furnace.userns import make_idmapped_mount, shift_ownership
 
 logger = logging.getLogger("container.pid1")
 
+# The argv snapshot is truncated so that a single exit record stays small
+ORPHAN_EXIT_MAX_ARGS = 32
+
+# Size limit of the messages on the socket of a container template
+TEMPLATE_MESSAGE_SIZE = 64 * 1024
+# A request carries the two control pipe ends of the new container, and optionally a netns fd
+TEMPLATE_MAX_FDS = 3
+
 
 class PID1:
-    def __init__(self, root_dir, control_read, control_write, isolate_networking, bind_mounts):
+    def __init__(self, root_dir, control_read, control_write, isolate_networking, bind_mounts, report_orphan_exits=False,
+                 netns_path=None, mountpoint_skeleton=False, read_only_root=False, spec=None,
+                 mount_propagation=MOUNT_PROPAGATION_SLAVE, placement=None, template_socket=None,
+                 id_mapping=None, userns_fd=None):
         self.control_read = control_read
         self.control_write = control_write
-        self.root_dir = Path(root_dir).resolve()
+        # None means the root of the host, see get_host_root_steps()
+        self.root_dir = Path(root_dir).resolve() if root_dir is not None else None
         self.isolate_networking = isolate_networking
+        self.netns_path = netns_path
+        self.mountpoint_skeleton = mountpoint_skeleton
+        self.read_only_root = read_only_root
+        self.mount_propagation = mount_propagation
+        self.placement = Placement.from_json(placement) if placement is not None else None
+        self.bind_mount_plan = None
+        self.report_orphan_exits = report_orphan_exits
         self.bind_mounts = self.convert_bind_mounts_parameter(bind_mounts)
-        self.loop_devices = list(self.get_loop_devices())
+        if spec is None:
+            self.spec = ContainerSpec.default()
+        else:
+            self.spec = ContainerSpec.from_json(spec)
+        self.loop_devices = []
+        if self.spec.loop_devices:
+            self.loop_devices = list(self.get_loop_devices())
+        self.startup_timings = {}
+        self.template_socket = socket.socket(fileno=template_socket) if template_socket is not None else None
+        # The user namespace, created by the host with the mapping, is joined at the end
+        # of the startup, see enter_user_namespace()
+        self.id_mapping = IdMapping.from_json(id_mapping) if id_mapping is not None else None
+        self.userns_fd = userns_fd
+        # see snapshot_tmpfs_contents()
+        self.tmpfs_contents = []
 
     @classmethod
     def convert_bind_mounts_parameter(cls, bind_mounts):
@@ -61,44 +105,141 @@ class PID1:
         # and get rid of zombies automatically
         signal.signal(signal.SIGCHLD, signal.SIG_IGN)
 
+    def enable_orphan_exit_reporting(self):
+        # Instead of letting the kernel throw away the exit status of every
+        # process reparented to us, reap them by hand and send a compact
+        # record of each one to the host on the control pipe.
+        # This must only be enabled after the startup is finished, otherwise
+        # we would steal the exit status of our own subprocess calls.
+        signal.signal(signal.SIGCHLD, self.reap_orphans)
+        # Children that died before the handler was installed were
+        # already reaped by the kernel, but there might be some new ones.
+        self.reap_orphans()
+
+    def reap_orphans(self, signum=None, frame=None):
+        while True:
+            try:
+                # WNOWAIT leaves the child in a waitable state, so that we can
+                # still read its /proc entries before actually reaping it
+                info = os.waitid(os.P_ALL, 0, os.WEXITED | os.WNOHANG | os.WNOWAIT)
+            except ChildProcessError:
+                return
+            if info is None or info.si_pid == 0:
+                return
+            argv, lifetime = self.get_process_snapshot(info.si_pid)
+            pid, status, rusage = os.wait4(info.si_pid, 0)
+            if os.WIFSIGNALED(status):
+                returncode = -os.WTERMSIG(status)
+            else:
+                returncode = os.WEXITSTATUS(status)
+            record = {
+                "pid": pid,
+                "argv": argv,
+                "returncode": returncode,
+                "utime": rusage.ru_utime,
+                "stime": rusage.ru_stime,
+                "maxrss": rusage.ru_maxrss,
+                "lifetime": lifetime,
+            }
+            os.write(self.control_write, json.dumps(record).encode('utf-8') + b"\n")
+
     @classmethod
-    def create_mount_target(cls, source, destination):
-        if source.is_file():
-            if destination.is_symlink():
-                destination.unlink()
-            destination.parent.mkdir(parents=True, exist_ok=True)
-            destination.touch()
-        else:
-            destination.mkdir(parents=True, exist_ok=True)
+    def get_process_snapshot(cls, pid):
+        # The memory of a zombie is already gone, so its cmdline is usually
+        # empty. In that case, the process name from stat is the best we have.
+        proc_dir = Path('/proc', str(pid))
+        try:
+            cmdline = proc_dir.joinpath('cmdline').read_bytes()
+            proc_stat = proc_dir.joinpath('stat').read_bytes()
+            uptime = float(Path('/proc/uptime').read_text().split()[0])
+        except OSError:
+            return [], None
+        # the command name is in parentheses and may contain spaces
+        comm = proc_stat[proc_stat.index(b'(') + 1:proc_stat.rindex(b')')]
+        fields_after_comm = proc_stat[proc_stat.rindex(b')') + 2:].split()
+        # starttime is the 22nd field, counting from 1 with pid and comm included
+        start_time = int(fields_after_comm[19]) / os.sysconf('SC_CLK_TCK')
+        argv = [arg.decode('utf-8', 'replace') for arg in cmdline.split(b'\0') if arg]
+        if not argv:
+            argv = [comm.decode('utf-8', 'replace')]
+        return argv[:ORPHAN_EXIT_MAX_ARGS], max(uptime - start_time, 0.0)
 
     def create_bind_mounts(self):
-        for source, relative_destination, read_only in self.bind_mounts:
-            destination = self.root_dir.joinpath(relative_destination)
-            self.create_mount_target(source, destination)
-            mount(source, destination, None, MS_BIND, None)
-            if read_only:
-                # "Read-only bind mounts" are actually an illusion, a special feature of the kernel,
-                # which is why we have to make the bind mount read-only in a separate call.
-                # See https://lwn.net/Articles/281157/
-                flags = MS_REMOUNT | MS_BIND | MS_RDONLY
-                mount(Path(), destination, None, flags, None)
+        plan = self.bind_mount_plan = BindMountPlan(self.root_dir, self.bind_mounts, use_skeleton=self.mountpoint_skeleton)
+        logger.debug("Bind mount plan: {}".format(plan.cost))
+        plan.execute()
 
-    def setup_root_mount(self):
+    def set_root_mount_propagation(self):
         # SLAVE means that mount events will get inside the container, but
         # mounting something inside will not leak out.
-        # Use PRIVATE to not let outside events propagate in
-        mount(Path("none"), Path("/"), None, MS_REC | MS_SLAVE, None)
-        self.create_bind_mounts()
-        if not is_mount_point(self.root_dir):
-            mount(self.root_dir, self.root_dir, None, MS_BIND, None)
-        old_root_dir = self.root_dir.joinpath('old_root')
-        old_root_dir.mkdir(parents=True, exist_ok=True)
+        # PRIVATE does not let outside events propagate in
+        if self.mount_propagation == MOUNT_PROPAGATION_PRIVATE:
+            mount(Path("none"), Path("/"), None, MS_REC | MS_PRIVATE, None)
+        else:
+            mount(Path("none"), Path("/"), None, MS_REC | MS_SLAVE, None)
+
+    def setup_root_mount(self):
+        self.set_root_mount_propagation()
+        if self.read_only_root:
+            self.setup_read_only_root_mount()
+        else:
+            self.create_bind_mounts()
+            if not is_mount_point(self.root_dir):
+                mount(self.root_dir, self.root_dir, None, MS_BIND, None)
+            self.pivot_to_root_dir()
+        if self.mount_propagation == MOUNT_PROPAGATION_ROOTFS_SLAVE:
+            self.make_bind_mounts_private()
+
+    def make_bind_mounts_private(self):
+        # After pivot_root, only the rootfs and the bind mounts are left from the host's
+        # mounts. Most bind mount sources are on the host's root filesystem, so as slaves
+        # they would receive every mount event of the host.
+        for bind in self.bind_mount_plan.binds:
+            flags = MS_PRIVATE
+            if bind.recursive:
+                flags = flags | MS_REC
+            mount(Path("none"), Path('/').joinpath(bind.destination), None, flags, None)
+
+    def pivot_to_root_dir(self):
+        # pivot_root(".", ".") stacks the old root on top of the new one, where it can be
+        # unmounted right away. See pivot_root(2). Unlike an old_root directory in the
+        # rootfs, this does not race with other containers started in the same rootfs.
+        if self.userns_fd is not None:
+            self.make_root_mount_idmapped()
         os.chdir(str(self.root_dir))
-        pivot_root(Path('.'), Path('old_root'))
-        os.chroot('.')
+        pivot_root(Path('.'), Path('.'))
+        umount2(Path('.'), MNT_DETACH)
+        os.chdir('/')
+
+    def make_root_mount_idmapped(self):
+        # The finished mount tree of the rootfs (with the bind mounts and skeletons) is
+        # copied and mounted on top of itself, ID-mapped, so the files are not chowned.
+        # Mountpoints can not be created through an ID-mapped mount by us (root on the
+        # host is not in the mapping), so this is done after the bind mounts.
+        make_idmapped_mount(self.root_dir, self.root_dir, self.userns_fd, recursive=True)
+
+    def setup_read_only_root_mount(self):
+        # Nothing is written to the rootfs in this mode, so the same directory can be
+        # used by any number of containers at the same time. Missing mountpoints are
+        # created on tmpfs skeletons.
+        # Our own recursive bind mount, so that its flags can be changed freely
+        mount(self.root_dir, self.root_dir, None, MS_BIND | MS_REC, None)
+        plan = self.bind_mount_plan = BindMountPlan(self.root_dir, self.bind_mounts, use_skeleton=True)
+        logger.debug("Bind mount plan: {}".format(plan.cost))
+        container_mount_destinations = [m.destination for m in self.spec.mounts]
+        for destination in container_mount_destinations:
+            if not any(other in destination.parents for other in container_mount_destinations):
+                plan.create_mount_target(False, self.root_dir.joinpath(destination.relative_to('/')))
+        # nothing can be created in the skeletons after this
+        plan.create_root_mount_targets()
+        make_read_only_recursive(self.root_dir)
+        # bind mounts are new mounts, so they can still be writable
+        plan.execute()
+        plan.make_skeletons_read_only()
+        self.pivot_to_root_dir()
 
     def mount_defaults(self):
-        for m in CONTAINER_MOUNTS:
+        for m in self.spec.mounts:
             options = None
             if m.options:
                 options = ",".join(m.options)
@@ -107,7 +248,7 @@ class PID1:
 
     def create_tmpfs_dirs(self):
         if Path('/bin/systemd-tmpfiles').exists():
-            for m in CONTAINER_MOUNTS:
+            for m in self.spec.mounts:
                 if m.type == "tmpfs":
                     tmpfiles_output = subprocess.check_output(
                         ['/bin/systemd-tmpfiles', '--create', '--prefix', str(m.destination)],
@@ -132,31 +273,66 @@ class PID1:
         nodepath.chmod(mode=mode)
 
     def create_default_dev_nodes(self):
-        for d in CONTAINER_DEVICE_NODES:
+        for d in self.spec.device_nodes:
             self.create_device_node(d.name, d.major, d.minor, 0o666)
 
     def create_loop_devices(self):
+        if not self.spec.loop_devices:
+            return
         self.create_device_node('loop-control', 10, 237, 0o660)
         for loop in self.loop_devices:
             self.create_device_node(loop.name, 7, loop.minor, 0o660, is_block_device=True)
 
-    def umount_old_root(self):
-        umount2('/old_root', MNT_DETACH)
-        os.rmdir('/old_root')
+    def set_hostname(self):
+        # without a separate uts namespace, this would change the hostname of the host
+        if "uts" in self.spec.namespaces and self.spec.hostname:
+            sethostname(self.spec.hostname)
+
+    def shift_tmpfs_ownership(self):
+        # The tmpfs mounts of the spec, and what systemd-tmpfiles created in them, are
+        # owned by root on the host, so they are handed over to the root of the container
+        for m in self.spec.mounts:
+            if m.type == "tmpfs":
+                shift_ownership(m.destination, self.id_mapping)
+
+    def enter_user_namespace(self):
+        # The other namespaces stay owned by the user namespace of the host, so root in
+        # the container can not e.g. mount or change the hostname. The startup steps
+        # needing privileges have to come before this.
+        setns(self.userns_fd, CLONE_NEWUSER)
+        os.close(self.userns_fd)
+        self.userns_fd = None
+        os.setgroups([])
+        os.setgid(0)
+        os.setuid(0)
 
     def create_namespaces(self):
         unshare_flags = 0
         for name, flag in NAMESPACES.items():
             if flag == CLONE_NEWPID:
                 continue
-            if flag == CLONE_NEWNET and not self.isolate_networking:
+            if flag != CLONE_NEWNET and name not in self.spec.namespaces:
+                continue
+            if flag == CLONE_NEWNET and (not self.isolate_networking or self.netns_path is not None):
                 continue
             if Path('/proc/self/ns', name).exists():
                 unshare_flags = unshare_flags | flag
             else:
                 logger.warning("Namespace type {} not supported on this system".format(name))
+        if self.netns_path is not None:
+            self.join_network_namespace()
         unshare(unshare_flags)
 
+    def join_network_namespace(self):
+        # An already existing (pooled or shared) network namespace is used instead
+        # of a new one. This has to happen before the mount namespace is changed,
+        # because the path is only valid on the host.
+        netns_fd = os.open(self.netns_path, os.O_RDONLY)
+        try:
+            setns(netns_fd, CLONE_NEWNET)
+        finally:
+            os.close(netns_fd)
+
     def run(self):
         if non_caching_getpid() != 1:
             raise ValueError("We are not actually PID1, exiting for safety reasons")
@@ -165,23 +341,226 @@ class PID1:
         make_sure_codecs_are_loaded = b'a'.decode('unicode_escape')  # NOQA: F841 local variable 'make_sure_codecs_are_loaded' is assigned to but never used
         os.setsid()
         self.enable_zombie_reaping()
-        self.create_namespaces()
-        self.setup_root_mount()
-        self.mount_defaults()
-        self.create_default_dev_nodes()
-        self.create_loop_devices()
-        self.create_tmpfs_dirs()
-        self.umount_old_root()
-        sethostname(HOSTNAME)
+        if self.placement is not None:
+            # everything started by PID1 inherits it
+            self.placement.apply()
+        for step in self.get_startup_steps():
+            self.run_startup_step(step)
+        return self.serve()
 
-        os.write(self.control_write, b"RDY")
+    def serve(self):
+        # The ready signal is followed by the length prefixed startup timings
+        timings = json.dumps(self.startup_timings).encode('utf-8')
+        os.write(self.control_write, b"RDY" + struct.pack('=I', len(timings)) + timings)
         logger.debug("Container started")
+        if self.report_orphan_exits:
+            self.enable_orphan_exit_reporting()
         # this will return when the pipe is closed
         # E.g. the outside control process died before killing us
         os.read(self.control_read, 1)
         logger.debug("Control pipe closed, stopping")
         return 0
 
+    def get_startup_steps(self):
+        if self.root_dir is None:
+            return self.get_host_root_steps()
+        steps = [
+            self.create_namespaces,
+            self.setup_root_mount,
+            self.mount_defaults,
+            self.create_default_dev_nodes,
+            self.create_loop_devices,
+            self.create_tmpfs_dirs,
+            self.set_hostname,
+        ]
+        if self.userns_fd is not None:
+            steps.extend([self.shift_tmpfs_ownership, self.enter_user_namespace])
+        return steps
+
+    def get_host_root_steps(self):
+        # The root of the host is kept, there is no pivot_root, no device nodes and
+        # no systemd-tmpfiles. The mounts of the spec (only /proc by default, see
+        # ContainerSpec.host_root()) are done in the container's mount namespace.
+        return [
+            self.create_namespaces,
+            self.set_root_mount_propagation,
+            self.mount_defaults,
+            self.set_hostname,
+        ]
+
+    def run_template(self):
+        # A container template prepares the mount tree of a container once, and clones
+        # new containers from it on request. The template process itself stays in the
+        # pid namespace of the host, so the pids it sends back are valid on the host.
+        make_sure_codecs_are_loaded = b'a'.decode('unicode_escape')  # NOQA: F841 local variable 'make_sure_codecs_are_loaded' is assigned to but never used
+        os.setsid()
+        self.enable_zombie_reaping()
+        for step in self.get_template_steps():
+            self.run_startup_step(step)
+        self.template_socket.send(json.dumps({"ready": True, "timings": self.startup_timings}).encode('utf-8'))
+        logger.debug("Container template ready")
+        while True:
+            request, fds = self.receive_template_request()
+            if request is None:
+                logger.debug("Template socket closed, stopping")
+                return 0
+            pidfd = None
+            try:
+                pid, pidfd = self.clone_container(request, fds)
+                reply = {"pid": pid}
+            except Exception as e:
+                logger.exception("Could not clone a container")
+                reply = {"error": "{}: {}".format(type(e).__name__, e)}
+            finally:
+                for fd in fds:
+                    os.close(fd)
+            # Clones are reaped automatically, so their pid might already belong to an other
+            # process when the host gets it. The pidfd from clone() is sent along with it.
+            try:
+                if pidfd is not None:
+                    self.template_socket.sendmsg([json.dumps(reply).encode('utf-8')],
+                                                 [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [pidfd]))])
+                else:
+                    self.template_socket.send(json.dumps(reply).encode('utf-8'))
+            finally:
+                if pidfd is not None:
+                    os.close(pidfd)
+
+    def get_template_steps(self):
+        # Everything but the per-container namespaces. The mounts of the spec are done
+        # here too, so that systemd-tmpfiles can populate them.
+        return [
+            self.create_template_mount_namespace,
+            self.setup_root_mount,
+            self.mount_defaults,
+            self.create_default_dev_nodes,
+            self.create_loop_devices,
+            self.create_tmpfs_dirs,
+            self.snapshot_tmpfs_contents,
+        ]
+
+    def create_template_mount_namespace(self):
+        unshare(CLONE_NEWNS)
+
+    def receive_template_request(self):
+        fd_size = array.array('i').itemsize
+        message, ancillary_data, _, _ = self.template_socket.recvmsg(
+            TEMPLATE_MESSAGE_SIZE, socket.CMSG_SPACE(TEMPLATE_MAX_FDS * fd_size))
+        fds = array.array('i')
+        for level, kind, data in ancillary_data:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(data[:len(data) - (len(data) % fd_size)])
+        if not message:
+            return None, list(fds)
+        return json.loads(message.decode('utf-8')), list(fds)
+
+    def clone_container(self, request, fds):
+        # Creates every namespace of the container with a single clone(). The new mount
+        # namespace is a copy of the prepared mount tree of the template.
+        flags = CLONE_NEWPID | CLONE_NEWNS | signal.SIGCHLD
+        for name in self.spec.namespaces:
+            flags |= NAMESPACES[name]
+        if request["isolate_networking"] and len(fds) < 3:
+            flags |= CLONE_NEWNET
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid, pidfd = clone_with_pidfd(flags)
+        if not pid:
+            # We are the PID1 of the new container, do NOT return to the request loop
+            try:
+                self.control_read, self.control_write = fds[:2]
+                self.template_socket.close()
+                if len(fds) > 2:
+                    setns(fds[2], CLONE_NEWNET)
+                    os.close(fds[2])
+                status = self.run_cloned(request)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+        return pid, pidfd
+
+    def run_cloned(self, request):
+        if non_caching_getpid() != 1:
+            raise ValueError("We are not actually PID1, exiting for safety reasons")
+        os.setsid()
+        self.report_orphan_exits = request["report_orphan_exits"]
+        self.placement = Placement.from_json(request["placement"]) if request["placement"] is not None else None
+        if self.placement is not None:
+            self.placement.apply()
+        self.startup_timings = {}
+        for step in self.get_clone_steps():
+            self.run_startup_step(step)
+        return self.serve()
+
+    def get_clone_steps(self):
+        return [
+            self.remount_defaults,
+            self.restore_tmpfs_contents,
+            self.create_default_dev_nodes,
+            self.create_loop_devices,
+            self.set_hostname,
+        ]
+
+    def remount_defaults(self):
+        # The copied mounts of the spec still belong to the template: proc to the pid
+        # namespace of the host, the tmpfs mounts are shared with the other clones, etc.
+        destinations = [m.destination for m in self.spec.mounts]
+        for destination in reversed(destinations):
+            if not any(other in destination.parents for other in destinations):
+                # the mounts below it go away with it
+                umount2(destination, MNT_DETACH)
+        self.mount_defaults()
+
+    def snapshot_tmpfs_contents(self):
+        # What systemd-tmpfiles created in the tmpfs mounts, so that the clones can
+        # recreate it without running it again. Device nodes are created separately.
+        destinations = {m.destination for m in self.spec.mounts}
+        for m in self.spec.mounts:
+            if m.type != "tmpfs":
+                continue
+            for dirpath, dirnames, filenames in os.walk(str(m.destination)):
+                # other mounts of the spec are remounted anyway
+                dirnames[:] = sorted(name for name in dirnames if Path(dirpath, name) not in destinations)
+                for name in dirnames + sorted(filenames):
+                    path = os.path.join(dirpath, name)
+                    st = os.lstat(path)
+                    if stat.S_ISDIR(st.st_mode):
+                        content = None
+                    elif stat.S_ISLNK(st.st_mode):
+                        content = os.readlink(path)
+                    elif stat.S_ISREG(st.st_mode):
+                        with open(path, 'rb') as f:
+                            content = f.read().decode('latin-1')
+                    else:
+                        continue
+                    self.tmpfs_contents.append((path, stat.S_IFMT(st.st_mode), stat.S_IMODE(st.st_mode),
+                                                st.st_uid, st.st_gid, content))
+        # parents first
+        self.tmpfs_contents.sort(key=lambda entry: entry[0].count('/'))
+
+    def restore_tmpfs_contents(self):
+        for path, kind, mode, uid, gid, content in self.tmpfs_contents:
+            if os.path.lexists(path):
+                continue
+            if kind == stat.S_IFDIR:
+                os.mkdir(path)
+            elif kind == stat.S_IFLNK:
+                os.symlink(content, path)
+            else:
+                with open(path, 'wb') as f:
+                    f.write(content.encode('latin-1'))
+            os.lchown(path, uid, gid)
+            if kind != stat.S_IFLNK:
+                os.chmod(path, mode)
+
+    def run_startup_step(self, step):
+        start_time = time.monotonic()
+        step()
+        self.startup_timings[step.__name__] = time.monotonic() - start_time
+
     # NOTE: use only before create_namespaces()
     def get_loop_devices(self):
         for loop_path in Path('/dev').glob('loop[0-9]*'):
@@ -194,4 +573,6 @@ if __name__ == "__main__":
     args = json.loads(sys.argv[1])
     logger.setLevel(args.pop("loglevel"))
     pid1 = PID1(**args)
+    if pid1.template_socket is not None:
+        sys.exit(pid1.run_template())
     sys.exit(pid1.run())
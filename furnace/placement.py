@@ -0,0 +1,162 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import os
+import threading
+from collections import namedtuple
+from pathlib import Path
+
+from .libc import set_mempolicy, ioprio_set, MPOL_BIND, MPOL_PREFERRED, MPOL_INTERLEAVE, \
+    IOPRIO_CLASS_RT, IOPRIO_CLASS_BE, IOPRIO_CLASS_IDLE
+
+logger = logging.getLogger(__name__)
+
+NUMA_NODE_DIR = Path('/sys/devices/system/node')
+
+# Use as Placement(numa_node=AUTO_NUMA_NODE) to let the NumaPacker choose the node
+AUTO_NUMA_NODE = 'auto'
+
+MEMORY_POLICIES = {
+    'bind': MPOL_BIND,
+    'preferred': MPOL_PREFERRED,
+    'interleave': MPOL_INTERLEAVE,
+}
+SCHEDULERS = {
+    'other': os.SCHED_OTHER,
+    'batch': os.SCHED_BATCH,
+    'idle': os.SCHED_IDLE,
+}
+IO_CLASSES = {
+    'realtime': IOPRIO_CLASS_RT,
+    'best-effort': IOPRIO_CLASS_BE,
+    'idle': IOPRIO_CLASS_IDLE,
+}
+
+
+def parse_cpu_list(text):
+    # e.g. "0-3,8-11" -> {0, 1, 2, 3, 8, 9, 10, 11}
+    cpus = set()
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+class Placement(namedtuple('Placement', ['cpus', 'memory_nodes', 'memory_policy', 'nice', 'scheduler',
+                                         'io_class', 'io_level', 'numa_node'])):
+    # Where and how the processes of a container run. PID1 applies it to itself, so
+    # everything it starts inherits it, and run()/Popen()/call() apply it to their
+    # children. Every field is optional, None means "inherit from the host process".
+    # cpus: CPU numbers for sched_setaffinity
+    # memory_nodes, memory_policy: NUMA nodes for set_mempolicy, see MEMORY_POLICIES
+    # nice: nice level; scheduler: see SCHEDULERS
+    # io_class, io_level: I/O priority class (see IO_CLASSES) and level (0-7, 0 is the highest)
+    # numa_node: run on the CPUs and memory of this NUMA node, or AUTO_NUMA_NODE
+    __slots__ = ()
+
+    def __new__(cls, cpus=None, memory_nodes=None, memory_policy='bind', nice=None, scheduler=None,
+                io_class=None, io_level=4, numa_node=None):
+        if cpus is not None:
+            cpus = sorted(cpus)
+        if memory_nodes is not None:
+            memory_nodes = sorted(memory_nodes)
+        return super().__new__(cls, cpus, memory_nodes, memory_policy, nice, scheduler, io_class, io_level, numa_node)
+
+    def validate(self):
+        if self.memory_policy not in MEMORY_POLICIES:
+            raise ValueError("Unknown memory policy: {}".format(self.memory_policy))
+        if self.scheduler is not None and self.scheduler not in SCHEDULERS:
+            raise ValueError("Unknown scheduler: {}".format(self.scheduler))
+        if self.io_class is not None and self.io_class not in IO_CLASSES:
+            raise ValueError("Unknown I/O class: {}".format(self.io_class))
+        if not 0 <= self.io_level <= 7:
+            raise ValueError("I/O priority level must be between 0 and 7")
+        if self.cpus is not None and not self.cpus:
+            raise ValueError("The CPU set of a placement can not be empty")
+        return self
+
+    def on_numa_node(self, node, node_cpus):
+        # The placement with the NUMA node resolved to CPUs and memory nodes. Explicitly
+        # given CPUs are restricted to the node.
+        cpus = set(node_cpus) if self.cpus is None else set(self.cpus) & set(node_cpus)
+        if not cpus:
+            raise ValueError("None of the CPUs {} are on NUMA node {}".format(self.cpus, node))
+        return Placement(**dict(self._asdict(), cpus=cpus, memory_nodes=[node], numa_node=node))
+
+    def apply(self):
+        # Applies the placement to the calling process
+        if self.cpus is not None:
+            os.sched_setaffinity(0, self.cpus)
+        if self.memory_nodes is not None:
+            set_mempolicy(MEMORY_POLICIES[self.memory_policy], self.memory_nodes)
+        if self.scheduler is not None:
+            os.sched_setscheduler(0, SCHEDULERS[self.scheduler], os.sched_param(0))
+        if self.nice is not None:
+            os.setpriority(os.PRIO_PROCESS, 0, self.nice)
+        if self.io_class is not None:
+            ioprio_set(IO_CLASSES[self.io_class], self.io_level)
+
+    def to_json(self):
+        return self._asdict()
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(**data)
+
+
+class NumaPacker:
+    # Assigns containers to NUMA nodes, always to the one with the smallest total
+    # weight of containers on it (relative to its CPU count). Containers are
+    # released when they stop.
+    def __init__(self, node_dir: Path = NUMA_NODE_DIR):
+        self.lock = threading.Lock()
+        self.node_cpus = {}
+        for path in sorted(Path(node_dir).glob('node[0-9]*')):
+            cpus = parse_cpu_list(path.joinpath('cpulist').read_text())
+            if cpus:
+                self.node_cpus[int(path.name[len('node'):])] = cpus
+        if not self.node_cpus:
+            # no NUMA support in the kernel, it is a single node
+            self.node_cpus[0] = os.sched_getaffinity(0)
+        self.load = {node: 0 for node in self.node_cpus}
+
+    def assign(self, weight=1):
+        with self.lock:
+            node = min(self.load, key=lambda node: (self.load[node] / len(self.node_cpus[node]), node))
+            self.load[node] += weight
+            return node
+
+    def release(self, node, weight=1):
+        with self.lock:
+            self.load[node] -= weight
+
+
+default_numa_packer = None
+default_numa_packer_lock = threading.Lock()
+
+
+def get_default_numa_packer():
+    global default_numa_packer
+    with default_numa_packer_lock:
+        if default_numa_packer is None:
+            default_numa_packer = NumaPacker()
+        return default_numa_packer
@@ -0,0 +1,209 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import concurrent.futures
+import json
+import logging
+import mmap
+import os
+import select
+import stat
+import struct
+import threading
+import uuid
+from pathlib import Path
+
+from .libc import fanotify_init, fanotify_mark, get_page_residency, FAN_CLOEXEC, FAN_NONBLOCK, FAN_CLASS_NOTIF, \
+    FAN_UNLIMITED_QUEUE, FAN_MARK_ADD, FAN_MARK_MOUNT, FAN_OPEN, FAN_Q_OVERFLOW, FAN_NOFD
+from .rootdir import RootDirectory
+
+logger = logging.getLogger(__name__)
+
+# struct fanotify_event_metadata: event_len, vers, reserved, metadata_len, mask, fd, pid
+FANOTIFY_EVENT = struct.Struct('=IBBHQii')
+FANOTIFY_BUFFER_SIZE = 64 * 1024
+
+PREWARM_PROFILE_VERSION = 1
+
+
+class PrewarmProfile:
+    # The files a job read from a rootfs, in the order they were first opened, with
+    # the ranges (offset, length in bytes) worth reading ahead. Paths are relative
+    # to the rootfs.
+    def __init__(self, files=None):
+        self.files = files or []
+
+    @property
+    def total_bytes(self):
+        return sum(length for _, ranges in self.files for _, length in ranges)
+
+    def to_json(self):
+        return {
+            'version': PREWARM_PROFILE_VERSION,
+            'files': [[path, [list(file_range) for file_range in ranges]] for path, ranges in self.files],
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        if data.get('version') != PREWARM_PROFILE_VERSION:
+            raise ValueError("Unknown prewarm profile version: {}".format(data.get('version')))
+        return cls([(path, [tuple(file_range) for file_range in ranges]) for path, ranges in data['files']])
+
+
+class PrewarmProfileStore:
+    # Profiles on the disk, one per rootfs, keyed by its fingerprint (see
+    # furnace.cache.rootfs_fingerprint), so a changed rootfs gets a new profile.
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path_for(self, fingerprint):
+        return self.directory.joinpath('{}.json'.format(fingerprint))
+
+    def load(self, fingerprint):
+        try:
+            return PrewarmProfile.from_json(json.loads(self.path_for(fingerprint).read_text()))
+        except FileNotFoundError:
+            return None
+
+    def save(self, fingerprint, profile: PrewarmProfile):
+        temp_path = self.directory.joinpath('.tmp-{}'.format(uuid.uuid4().hex))
+        temp_path.write_text(json.dumps(profile.to_json()))
+        temp_path.rename(self.path_for(fingerprint))
+
+
+def get_cached_ranges(fd, size):
+    # The ranges of the file that are in the page cache, merged from consecutive pages
+    ranges = []
+    for page, resident in enumerate(get_page_residency(fd, size)):
+        if not resident & 1:
+            continue
+        offset = page * mmap.PAGESIZE
+        if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+            ranges[-1][1] += mmap.PAGESIZE
+        else:
+            ranges.append([offset, mmap.PAGESIZE])
+    return [(offset, min(length, size - offset)) for offset, length in ranges]
+
+
+class AccessRecorder:
+    # Records which files are opened through the root mount of a container, with
+    # fanotify. The fanotify group is created here, but the mount has to be marked
+    # from the mount namespace of the container, see mark_root_mount().
+    # fanotify does not tell which parts of a file were read, so when the recording
+    # stops, the parts of the opened files that are in the page cache are recorded.
+    # If the files were cached before (e.g. the host used them), this overestimates
+    # what the job needs.
+    def __init__(self, root_dir: Path):
+        self.root_dir = Path(root_dir)
+        self.fanotify_fd = fanotify_init(FAN_CLASS_NOTIF | FAN_CLOEXEC | FAN_NONBLOCK | FAN_UNLIMITED_QUEUE,
+                                         os.O_RDONLY | os.O_LARGEFILE | os.O_CLOEXEC)
+        self.wakeup_read, self.wakeup_write = os.pipe2(os.O_CLOEXEC)
+        # relative path -> None, in the order of the first access
+        self.paths = {}
+        self.overflowed = False
+        self.thread = None
+
+    def mark_root_mount(self):
+        # Run this in the container, e.g. with ContainerContext.call()
+        fanotify_mark(self.fanotify_fd, FAN_MARK_ADD | FAN_MARK_MOUNT, FAN_OPEN, Path('/'))
+
+    def start(self):
+        self.thread = threading.Thread(name='furnace-access-recorder', target=self.loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def loop(self):
+        while True:
+            readable, _, _ = select.select([self.fanotify_fd, self.wakeup_read], [], [])
+            self.read_events()
+            if self.wakeup_read in readable:
+                return
+
+    def read_events(self):
+        while True:
+            try:
+                data = os.read(self.fanotify_fd, FANOTIFY_BUFFER_SIZE)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                event_len, _, _, _, mask, fd, _ = FANOTIFY_EVENT.unpack_from(data, offset)
+                offset += event_len
+                if mask & FAN_Q_OVERFLOW:
+                    self.overflowed = True
+                if fd == FAN_NOFD:
+                    continue
+                try:
+                    # the path is relative to the root of the container's mount namespace
+                    path = os.readlink('/proc/self/fd/{}'.format(fd))
+                finally:
+                    os.close(fd)
+                if path.startswith('/') and not path.endswith(' (deleted)'):
+                    self.paths.setdefault(path.lstrip('/'), None)
+
+    def stop(self) -> PrewarmProfile:
+        os.write(self.wakeup_write, b'x')
+        self.thread.join()
+        for fd in (self.fanotify_fd, self.wakeup_read, self.wakeup_write):
+            os.close(fd)
+        if self.overflowed:
+            logger.warning("Some file accesses in {} were not recorded".format(self.root_dir))
+        files = []
+        # symlinks in the rootfs are resolved in it, not on the host
+        with RootDirectory(self.root_dir) as root:
+            for path in self.paths:
+                try:
+                    fd = root.open_fd(path, os.O_RDONLY | os.O_NONBLOCK)
+                except OSError:
+                    continue
+                try:
+                    st = os.fstat(fd)
+                    if not stat.S_ISREG(st.st_mode):
+                        continue
+                    ranges = get_cached_ranges(fd, st.st_size)
+                finally:
+                    os.close(fd)
+                if ranges:
+                    files.append((path, ranges))
+        return PrewarmProfile(files)
+
+
+def prewarm_file(root: RootDirectory, path, ranges):
+    # The path is resolved in the rootfs, so a profile with an absolute path, '..' or
+    # a symlink of the rootfs can not make it read the files of the host
+    try:
+        fd = root.open_fd(path, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+        # the profile is older than the rootfs
+        return 0
+    try:
+        for offset, length in ranges:
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+    return sum(length for _, length in ranges)
+
+
+def prewarm(root_dir: Path, profile: PrewarmProfile, *, workers=8):
+    # Starts reading the files of the profile into the page cache, from several
+    # threads, as opening the files and submitting the reads also takes time.
+    # Returns the number of bytes requested.
+    with RootDirectory(Path(root_dir)) as root, concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(lambda item: prewarm_file(root, item[0], item[1]), profile.files))
@@ -0,0 +1,124 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import builtins
+import logging
+import os
+from pathlib import PurePosixPath
+
+from .libc import openat2, RESOLVE_IN_ROOT, RESOLVE_NO_MAGICLINKS
+
+logger = logging.getLogger(__name__)
+
+RESOLVE_FLAGS = RESOLVE_IN_ROOT | RESOLVE_NO_MAGICLINKS
+
+
+class RootDirectory:
+    # File access in a directory tree as if it was the root directory, from this
+    # process: absolute symlinks and '..' are resolved inside the tree, so they
+    # can not point out of it. Used for reading and writing the files of running
+    # containers without starting a process in them, through /proc/<pid>/root,
+    # which shows the mount namespace of the process. Needs openat2 (Linux 5.6).
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(str(path), os.O_PATH | os.O_DIRECTORY | os.O_CLOEXEC)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def open_fd(self, path, flags, mode=0o666):
+        # openat2 refuses a mode without O_CREAT or O_TMPFILE (which includes O_DIRECTORY)
+        if not flags & os.O_CREAT and flags & os.O_TMPFILE != os.O_TMPFILE:
+            mode = 0
+        return openat2(self.fd, path, flags | os.O_CLOEXEC, mode, RESOLVE_FLAGS)
+
+    def open(self, path, mode='r', buffering=-1, encoding=None, errors=None, newline=None):
+        # Same as the builtin open(), the name of the file object is the path in the tree
+        return builtins.open(str(path), mode, buffering, encoding, errors, newline,
+                             opener=lambda name, flags: self.open_fd(name, flags))
+
+    def stat(self, path, *, follow_symlinks=True) -> os.stat_result:
+        flags = os.O_PATH if follow_symlinks else os.O_PATH | os.O_NOFOLLOW
+        fd = self.open_fd(path, flags)
+        try:
+            return os.stat(fd)
+        finally:
+            os.close(fd)
+
+    def statvfs(self, path='/') -> os.statvfs_result:
+        fd = self.open_fd(path, os.O_PATH)
+        try:
+            return os.statvfs(fd)
+        finally:
+            os.close(fd)
+
+    def exists(self, path) -> bool:
+        try:
+            self.stat(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def listdir(self, path='/'):
+        fd = self.open_fd(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            return os.listdir(fd)
+        finally:
+            os.close(fd)
+
+    def makedirs(self, path, mode=0o777):
+        # Like os.makedirs(path, exist_ok=True). Every directory is created relative to
+        # its parent, which is resolved in the tree, so it can not end up outside of it.
+        path = PurePosixPath('/').joinpath(path)
+        for directory in list(reversed(path.parents))[1:] + [path]:
+            if directory == directory.parent:
+                continue
+            parent_fd = self.open_fd(directory.parent, os.O_PATH | os.O_DIRECTORY)
+            try:
+                os.mkdir(directory.name, mode, dir_fd=parent_fd)
+            except FileExistsError:
+                pass
+            finally:
+                os.close(parent_fd)
+
+    def walk(self, top='/', topdown=True, onerror=None):
+        # Like os.walk(), without following symlinks. os.fwalk() opens every
+        # directory relative to its parent, with O_NOFOLLOW, so only the top
+        # directory has to be resolved in the tree.
+        top = PurePosixPath('/').joinpath(top)
+        try:
+            top_fd = self.open_fd(top, os.O_RDONLY | os.O_DIRECTORY)
+        except OSError as e:
+            if onerror is not None:
+                onerror(e)
+            return
+        try:
+            for dirpath, dirnames, filenames, _ in os.fwalk('.', topdown=topdown, onerror=onerror, dir_fd=top_fd):
+                yield str(top.joinpath(dirpath)), dirnames, filenames
+        finally:
+            os.close(top_fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+        return False
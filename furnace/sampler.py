@@ -0,0 +1,237 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import collections
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+# pid: in the host pid namespace; cpu_percent: since the previous sample (100 is one full CPU)
+# rss, read_bytes, write_bytes: in bytes, the I/O counters are cumulative
+ProcessSample = namedtuple('ProcessSample', [
+    'pid', 'ppid', 'name', 'state', 'cpu_percent', 'cpu_time', 'rss', 'read_bytes', 'write_bytes',
+])
+# The sum of the ProcessSamples of the tree at one point in time
+AggregateSample = namedtuple('AggregateSample', [
+    'time', 'processes', 'cpu_percent', 'rss', 'read_bytes', 'write_bytes',
+])
+
+
+def read_children(pid):
+    # /proc/<pid>/task/<tid>/children lists the children of each thread
+    children = []
+    try:
+        tids = os.listdir('/proc/{}/task'.format(pid))
+    except FileNotFoundError:
+        return children
+    for tid in tids:
+        try:
+            with open('/proc/{}/task/{}/children'.format(pid, tid)) as f:
+                children.extend(int(child) for child in f.read().split())
+        except FileNotFoundError:
+            continue
+    return children
+
+
+def get_pid_namespace(pid):
+    try:
+        return os.readlink('/proc/{}/ns/pid'.format(pid))
+    except FileNotFoundError:
+        return None
+
+
+def walk_process_tree(root_pids):
+    pids = []
+    pending = list(root_pids)
+    while pending:
+        pid = pending.pop()
+        pids.append(pid)
+        pending.extend(read_children(pid))
+    return pids
+
+
+def read_process(pid):
+    # Returns (ppid, name, state, start time, cpu time in seconds, rss, read_bytes, write_bytes),
+    # or None if the process exited in the meantime
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            stat = f.read()
+        with open('/proc/{}/status'.format(pid)) as f:
+            status = f.read()
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+    try:
+        with open('/proc/{}/io'.format(pid)) as f:
+            io = f.read()
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+    except PermissionError:
+        # only readable by root (or the owner) of the process
+        io = ''
+    # the name is in parentheses, and may contain spaces or parentheses itself
+    name = stat[stat.index('(') + 1:stat.rindex(')')]
+    fields = stat[stat.rindex(')') + 2:].split()
+    state, ppid = fields[0], int(fields[1])
+    cpu_time = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    start_time = int(fields[19])
+    rss = 0
+    for line in status.splitlines():
+        if line.startswith('VmRSS:'):
+            rss = int(line.split()[1]) * 1024
+            break
+    counters = dict(line.split(': ') for line in io.splitlines() if ': ' in line)
+    return (ppid, name, state, start_time, cpu_time, rss,
+            int(counters.get('read_bytes', 0)), int(counters.get('write_bytes', 0)))
+
+
+class ProcessTreeSampler:
+    # Samples the process tree under a pid (e.g. a container's PID1, as seen from the host)
+    # every interval seconds in a background thread. The last history samples are kept.
+    # Processes started by ContainerContext.run() and Popen() are the children of this
+    # process, not of PID1, so with include_own_children, the children of this process
+    # in the pid namespace of root_pid (and their descendants) are sampled too.
+    def __init__(self, root_pid, *, interval=1.0, history=3600, include_own_children=True):
+        self.root_pid = root_pid
+        self.pid_namespace = get_pid_namespace(root_pid) if include_own_children else None
+        self.interval = interval
+        self.lock = threading.Lock()
+        # (time, [ProcessSample, ...]) tuples
+        self.snapshots = collections.deque(maxlen=history)
+        # (pid, start time) -> (sample time, cpu time), to calculate cpu_percent
+        self.previous_cpu_times = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.sample()
+        self.thread = threading.Thread(name='furnace-sampler-{}'.format(self.root_pid), target=self.loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+        return False
+
+    def loop(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def find_roots(self):
+        roots = [self.root_pid]
+        if self.pid_namespace is not None:
+            for child in read_children(os.getpid()):
+                if child != self.root_pid and get_pid_namespace(child) == self.pid_namespace:
+                    roots.append(child)
+        return roots
+
+    def sample(self):
+        now = time.monotonic()
+        processes = []
+        cpu_times = {}
+        for pid in walk_process_tree(self.find_roots()):
+            info = read_process(pid)
+            if info is None:
+                continue
+            ppid, name, state, start_time, cpu_time, rss, read_bytes, write_bytes = info
+            # the start time tells apart a new process that reused the pid
+            key = (pid, start_time)
+            cpu_times[key] = (now, cpu_time)
+            cpu_percent = 0.0
+            if key in self.previous_cpu_times:
+                previous_time, previous_cpu_time = self.previous_cpu_times[key]
+                if now > previous_time:
+                    cpu_percent = 100 * (cpu_time - previous_cpu_time) / (now - previous_time)
+            processes.append(ProcessSample(pid, ppid, name, state, cpu_percent, cpu_time, rss, read_bytes, write_bytes))
+        self.previous_cpu_times = cpu_times
+        with self.lock:
+            self.snapshots.append((now, processes))
+        return processes
+
+    def top(self):
+        # The processes of the latest sample, the most CPU consuming first
+        with self.lock:
+            if not self.snapshots:
+                return []
+            processes = self.snapshots[-1][1]
+        return sorted(processes, key=lambda process: (-process.cpu_percent, -process.rss))
+
+    def timeline(self):
+        # AggregateSamples of the whole tree, the oldest first
+        with self.lock:
+            snapshots = list(self.snapshots)
+        return [aggregate(sample_time, processes) for sample_time, processes in snapshots]
+
+    def process_timeline(self, pid):
+        # (time, ProcessSample) pairs of a single process
+        with self.lock:
+            snapshots = list(self.snapshots)
+        return [
+            (sample_time, process)
+            for sample_time, processes in snapshots
+            for process in processes
+            if process.pid == pid
+        ]
+
+    def dump(self, path):
+        # One JSON array per line, gzipped: [time, [ProcessSample fields], ...]
+        with self.lock:
+            snapshots = list(self.snapshots)
+        with gzip.open(str(path), 'wt') as f:
+            f.write(json.dumps({'fields': ProcessSample._fields}) + '\n')
+            for sample_time, processes in snapshots:
+                f.write(json.dumps([round(sample_time, 3)] + [list(process) for process in processes]) + '\n')
+
+
+def aggregate(sample_time, processes):
+    return AggregateSample(
+        time=sample_time,
+        processes=len(processes),
+        cpu_percent=sum(process.cpu_percent for process in processes),
+        rss=sum(process.rss for process in processes),
+        read_bytes=sum(process.read_bytes for process in processes),
+        write_bytes=sum(process.write_bytes for process in processes),
+    )
+
+
+def load_dump(path):
+    # Reads a file written by ProcessTreeSampler.dump(), returns (time, [ProcessSample, ...]) tuples
+    snapshots = []
+    with gzip.open(str(path), 'rt') as f:
+        header = json.loads(f.readline())
+        if list(header['fields']) != list(ProcessSample._fields):
+            raise ValueError("Unknown sample format in {}".format(path))
+        for line in f:
+            sample_time, *processes = json.loads(line)
+            snapshots.append((sample_time, [ProcessSample(*process) for process in processes]))
+    return snapshots
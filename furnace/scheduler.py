@@ -0,0 +1,330 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import heapq
+import itertools
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+from pathlib import Path
+
+from .config import ContainerSpec
+from .context import ContainerContext
+from .metrics import MetricsRegistry
+from .utils import PathEncoder
+
+logger = logging.getLogger(__name__)
+
+# queued, running: number of jobs; completed: number of finished jobs
+# queue_wait, run_time: total seconds spent by the finished jobs in the queue and running
+# usage: CPU budget consumed so far (cpu * run seconds), the base of the fair share
+TenantStats = namedtuple('TenantStats', ['queued', 'running', 'completed', 'queue_wait', 'run_time', 'usage'])
+
+
+def get_available_memory():
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+class Job:
+    def __init__(self, root_dir, commands, *, spec, tenant, priority, cpu, memory):
+        self.root_dir = Path(root_dir).resolve()
+        self.commands = commands
+        self.spec = (spec if spec is not None else ContainerSpec.default()).validate()
+        self.tenant = tenant
+        self.priority = priority
+        self.cpu = cpu
+        self.memory = memory
+        self.future = Future()
+        self.submit_time = time.monotonic()
+
+    @property
+    def container_key(self):
+        # Consecutive jobs with the same key can run in the same container
+        return str(self.root_dir), json.dumps(self.spec.to_json(), sort_keys=True, cls=PathEncoder)
+
+
+class Tenant:
+    def __init__(self, name, weight):
+        self.name = name
+        self.weight = weight
+        # (-priority, sequence number, job): the highest priority first, FIFO otherwise
+        self.queue = []
+        self.running_cpu = 0
+        self.running = 0
+        self.completed = 0
+        self.queue_wait = 0.0
+        self.run_time = 0.0
+        self.usage = 0.0
+
+    def share_key(self):
+        # The tenant using the smallest part of its share right now goes first,
+        # ties are broken by the usage so far, both relative to the weight
+        return self.running_cpu / self.weight, self.usage / self.weight
+
+
+class Scheduler:
+    # Runs jobs (a list of commands in a container) from several tenants on this host.
+    # - At most cpu_budget CPUs and memory_budget bytes are reserved by the running
+    #   jobs, based on the cpu and memory declared in submit().
+    # - The next job is taken from the tenant that uses the smallest part of its
+    #   weighted share, so a burst from one tenant does not block the others.
+    #   Within a tenant, jobs run in priority order.
+    # - Containers are kept running after a job, and reused by the next job of the same
+    #   tenant with the same rootfs and spec. Note that this means that jobs can see the
+    #   changes the previous job made to the container (e.g. in /tmp), so containers are
+    #   only reused across tenants with share_containers.
+    # Usage:
+    #   with Scheduler(cpu_budget=8, tenant_weights={'ci': 3, 'nightly': 1}) as scheduler:
+    #       future = scheduler.submit('/path/to/rootfs', [['make', 'test']], tenant='ci')
+    #       results = future.result()   # list of subprocess.CompletedProcess
+    def __init__(self, *, cpu_budget=None, memory_budget=None, tenant_weights=None, max_idle_containers=4,
+                 idle_timeout=60.0, isolate_networking=True, share_containers=False,
+                 registry: MetricsRegistry = None):
+        self.cpu_budget = cpu_budget if cpu_budget is not None else os.cpu_count()
+        self.memory_budget = memory_budget if memory_budget is not None else get_available_memory()
+        self.tenant_weights = tenant_weights or {}
+        self.max_idle_containers = max_idle_containers
+        self.idle_timeout = idle_timeout
+        self.isolate_networking = isolate_networking
+        self.share_containers = share_containers
+        self.condition = threading.Condition()
+        self.tenants = {}
+        self.sequence = itertools.count()
+        self.used_cpu = 0
+        self.used_memory = 0
+        # container key -> list of (idle since, ContainerContext)
+        self.idle_containers = {}
+        self.workers = set()
+        self.stopping = False
+        self.dispatcher = None
+        registry = registry if registry is not None else MetricsRegistry()
+        self.queue_wait_seconds = registry.histogram(
+            'furnace_scheduler_queue_wait_seconds', 'Time jobs spent in the queue')
+        self.run_seconds = registry.histogram(
+            'furnace_scheduler_run_seconds', 'Time jobs spent running, including the container startup')
+        self.queued_jobs = registry.gauge('furnace_scheduler_queued_jobs', 'Number of jobs waiting to run')
+        self.running_jobs = registry.gauge('furnace_scheduler_running_jobs', 'Number of running jobs')
+        self.reused_containers = registry.counter(
+            'furnace_scheduler_containers_reused_total', 'Number of jobs that ran in an already started container')
+
+    def start(self):
+        self.dispatcher = threading.Thread(name='furnace-scheduler', target=self.dispatch_loop, daemon=True)
+        self.dispatcher.start()
+        return self
+
+    def stop(self):
+        # Waits for the running jobs, cancels the queued ones, and stops the idle containers
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.dispatcher.join()
+        for worker in list(self.workers):
+            worker.join()
+        for tenant in self.tenants.values():
+            for _, _, job in tenant.queue:
+                job.future.cancel()
+            tenant.queue = []
+        self.queued_jobs.set(0)
+        for containers in self.idle_containers.values():
+            for _, container in containers:
+                container.__exit__(None, None, None)
+        self.idle_containers = {}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+        return False
+
+    def submit(self, root_dir, commands, *, tenant='default', priority=0, spec: ContainerSpec = None,
+               cpu=1, memory=0) -> Future:
+        # commands: list of argv lists, run one after the other in the same container.
+        # The result of the future is the list of their CompletedProcesses (with
+        # stdout and stderr captured).
+        # cpu and memory (in bytes) are the resources reserved for the job.
+        if cpu > self.cpu_budget or (self.memory_budget is not None and memory > self.memory_budget):
+            raise ValueError("Job needs more resources than the budget of the scheduler")
+        job = Job(root_dir, commands, spec=spec, tenant=tenant, priority=priority, cpu=cpu, memory=memory)
+        with self.condition:
+            if self.stopping:
+                raise RuntimeError("Scheduler is stopped")
+            if tenant not in self.tenants:
+                self.tenants[tenant] = Tenant(tenant, self.tenant_weights.get(tenant, 1))
+            heapq.heappush(self.tenants[tenant].queue, (-priority, next(self.sequence), job))
+            self.queued_jobs.inc()
+            self.condition.notify_all()
+        return job.future
+
+    def stats(self):
+        with self.condition:
+            return {
+                name: TenantStats(
+                    queued=len(tenant.queue),
+                    running=tenant.running,
+                    completed=tenant.completed,
+                    queue_wait=tenant.queue_wait,
+                    run_time=tenant.run_time,
+                    usage=tenant.usage,
+                )
+                for name, tenant in self.tenants.items()
+            }
+
+    def fits(self, job):
+        if self.used_cpu + job.cpu > self.cpu_budget:
+            return False
+        return self.memory_budget is None or self.used_memory + job.memory <= self.memory_budget
+
+    def next_job(self):
+        # The head of the queue of the tenant that is the furthest below its share.
+        # If it does not fit, nothing is started until it does, so that big jobs do
+        # not starve behind a stream of small ones.
+        waiting = [tenant for tenant in self.tenants.values() if tenant.queue]
+        if not waiting:
+            return None
+        tenant = min(waiting, key=Tenant.share_key)
+        job = tenant.queue[0][2]
+        if not self.fits(job):
+            return None
+        heapq.heappop(tenant.queue)
+        return job
+
+    def dispatch_loop(self):
+        while True:
+            with self.condition:
+                if self.stopping:
+                    return
+                # checked on every pass, a steady stream of jobs would keep them forever
+                expired = self.take_expired_containers()
+                job = self.next_job()
+                if job is not None:
+                    self.start_job(job)
+                elif not expired:
+                    self.condition.wait(timeout=self.get_expiry_timeout())
+            # stopping PID1 takes a while, submit() and the workers are not blocked meanwhile
+            for container in expired:
+                container.__exit__(None, None, None)
+
+    def start_job(self, job):
+        # called with the condition held
+        if not job.future.set_running_or_notify_cancel():
+            self.queued_jobs.dec()
+            return
+        self.reserve(job)
+        worker = threading.Thread(name='furnace-scheduler-job', target=self.run_job, args=(job,), daemon=True)
+        self.workers.add(worker)
+        worker.start()
+
+    def reserve(self, job):
+        tenant = self.tenants[job.tenant]
+        tenant.running += 1
+        tenant.running_cpu += job.cpu
+        tenant.queue_wait += time.monotonic() - job.submit_time
+        self.used_cpu += job.cpu
+        self.used_memory += job.memory
+        self.queued_jobs.dec()
+        self.running_jobs.inc()
+        self.queue_wait_seconds.observe(time.monotonic() - job.submit_time)
+
+    def release(self, job, run_time):
+        tenant = self.tenants[job.tenant]
+        tenant.running -= 1
+        tenant.running_cpu -= job.cpu
+        tenant.completed += 1
+        tenant.run_time += run_time
+        tenant.usage += job.cpu * run_time
+        self.used_cpu -= job.cpu
+        self.used_memory -= job.memory
+        self.running_jobs.dec()
+        self.run_seconds.observe(run_time)
+
+    def container_key(self, job):
+        tenant = None if self.share_containers else job.tenant
+        return (tenant,) + job.container_key
+
+    def get_container(self, job):
+        with self.condition:
+            idle = self.idle_containers.get(self.container_key(job))
+            if idle:
+                self.reused_containers.inc()
+                return idle.pop()[1]
+        container = ContainerContext(job.root_dir, spec=job.spec, isolate_networking=self.isolate_networking)
+        container.__enter__()
+        return container
+
+    def put_container(self, job, container):
+        with self.condition:
+            idle_count = sum(len(containers) for containers in self.idle_containers.values())
+            if not self.stopping and idle_count < self.max_idle_containers:
+                self.idle_containers.setdefault(self.container_key(job), []).append((time.monotonic(), container))
+                return
+        container.__exit__(None, None, None)
+
+    def take_expired_containers(self):
+        # called with the condition held, the caller stops the returned containers
+        deadline = time.monotonic() - self.idle_timeout
+        expired = []
+        for key, containers in list(self.idle_containers.items()):
+            for idle_since, container in list(containers):
+                if idle_since < deadline:
+                    containers.remove((idle_since, container))
+                    expired.append(container)
+            if not containers:
+                del self.idle_containers[key]
+        return expired
+
+    def get_expiry_timeout(self):
+        # seconds until the next idle container expires
+        idle_since = [since for containers in self.idle_containers.values() for since, _ in containers]
+        if not idle_since:
+            return self.idle_timeout
+        return max(min(idle_since) + self.idle_timeout - time.monotonic(), 0)
+
+    def run_job(self, job):
+        start_time = time.monotonic()
+        container = None
+        try:
+            container = self.get_container(job)
+            results = [
+                container.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                for command in job.commands
+            ]
+        except BaseException as e:
+            logger.exception("Job of tenant {} failed".format(job.tenant))
+            if container is not None:
+                # the container might be in a bad state, do not reuse it
+                container.__exit__(type(e), e, e.__traceback__)
+            job.future.set_exception(e)
+        else:
+            self.put_container(job, container)
+            job.future.set_result(results)
+        finally:
+            with self.condition:
+                self.release(job, time.monotonic() - start_time)
+                self.workers.discard(threading.current_thread())
+                self.condition.notify_all()
@@ -0,0 +1,190 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import time
+
+from .libc import memfd_create, MFD_CLOEXEC, MFD_ALLOW_SEALING, F_ADD_SEALS, F_GET_SEALS, \
+    F_SEAL_SEAL, F_SEAL_SHRINK, F_SEAL_GROW, F_SEAL_WRITE
+
+logger = logging.getLogger(__name__)
+
+
+class SharedBuffer:
+    # A memfd mapped into this process. Children started by ContainerContext.run() and
+    # Popen() inherit the fd, and can map the same memory through child_path, so data
+    # does not have to be copied through pipes or files.
+    def __init__(self, size, *, name='furnace-shared-buffer', fd=None):
+        if fd is None:
+            fd = memfd_create(name, MFD_CLOEXEC | MFD_ALLOW_SEALING)
+            try:
+                os.ftruncate(fd, size)
+            except BaseException:
+                os.close(fd)
+                raise
+        self.fd = fd
+        self.size = size
+        prot = mmap.PROT_READ | mmap.PROT_WRITE
+        if self.seals & F_SEAL_WRITE:
+            prot = mmap.PROT_READ
+        self.mmap = mmap.mmap(self.fd, size, prot=prot)
+        self.buffer = memoryview(self.mmap)
+
+    @classmethod
+    def open(cls, path):
+        # For the processes in the container, e.g. SharedBuffer.open(os.environ['DATA_BUFFER'])
+        fd = os.open(str(path), os.O_RDWR)
+        return cls(os.fstat(fd).st_size, fd=fd)
+
+    @property
+    def child_path(self):
+        # The fd has the same number in the children
+        return '/proc/self/fd/{}'.format(self.fd)
+
+    def seal_size(self):
+        # The size of the memfd can not be changed any more, so mapping it is safe
+        fcntl.fcntl(self.fd, F_ADD_SEALS, F_SEAL_SHRINK | F_SEAL_GROW)
+
+    def seal_contents(self):
+        # Makes the content read-only for everyone, e.g. to hand over a dataset that no one
+        # can change. The writable mapping has to go first, the content is mapped read-only.
+        self.buffer.release()
+        self.mmap.close()
+        fcntl.fcntl(self.fd, F_ADD_SEALS, F_SEAL_SHRINK | F_SEAL_GROW | F_SEAL_WRITE | F_SEAL_SEAL)
+        self.mmap = mmap.mmap(self.fd, self.size, prot=mmap.PROT_READ)
+        self.buffer = memoryview(self.mmap)
+
+    @property
+    def seals(self):
+        try:
+            return fcntl.fcntl(self.fd, F_GET_SEALS)
+        except OSError:
+            # not a memfd
+            return 0
+
+    def close(self):
+        if self.fd is None:
+            return
+        self.buffer.release()
+        self.mmap.close()
+        os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+        return False
+
+
+class RingBuffer:
+    # A single producer, single consumer byte stream in a SharedBuffer, for when the data
+    # does not fit in the buffer at once. The layout, for users in other languages
+    # (native endian 64 bit unsigned integers, then the data from offset 64):
+    #   0: capacity of the data area
+    #   8: total bytes written; only the producer changes it, after writing the data
+    #  16: total bytes read; only the consumer changes it, after reading the data
+    #  24: 1 if the producer closed the stream
+    # The waiting functions poll, which is cheap enough for large chunks of data.
+    HEADER_SIZE = 64
+    HEADER = struct.Struct('=QQQQ')
+    POLL_INTERVAL = 0.0005
+
+    def __init__(self, shared_buffer: SharedBuffer, *, initialize=True):
+        self.shared_buffer = shared_buffer
+        self.buffer = shared_buffer.buffer
+        self.capacity = shared_buffer.size - self.HEADER_SIZE
+        if self.capacity <= 0:
+            raise ValueError("Shared buffer is too small for a ring buffer")
+        if initialize:
+            self.HEADER.pack_into(self.buffer, 0, self.capacity, 0, 0, 0)
+        elif self.read_field(0) != self.capacity:
+            raise ValueError("Shared buffer does not contain a ring buffer")
+
+    def read_field(self, index):
+        return struct.unpack_from('=Q', self.buffer, index * 8)[0]
+
+    def write_field(self, index, value):
+        struct.pack_into('=Q', self.buffer, index * 8, value)
+
+    def write(self, data):
+        # Writes as much of data as fits, returns the number of bytes written
+        data = memoryview(data).cast('B')
+        written, read = self.read_field(1), self.read_field(2)
+        length = min(len(data), self.capacity - (written - read))
+        offset = written % self.capacity
+        first = min(length, self.capacity - offset)
+        self.buffer[self.HEADER_SIZE + offset:self.HEADER_SIZE + offset + first] = data[:first]
+        self.buffer[self.HEADER_SIZE:self.HEADER_SIZE + length - first] = data[first:length]
+        self.write_field(1, written + length)
+        return length
+
+    def read(self, size=None):
+        # Returns at most size bytes of the available data, b'' if there is none
+        written, read = self.read_field(1), self.read_field(2)
+        length = written - read
+        if size is not None:
+            length = min(length, size)
+        offset = read % self.capacity
+        first = min(length, self.capacity - offset)
+        data = bytes(self.buffer[self.HEADER_SIZE + offset:self.HEADER_SIZE + offset + first])
+        data += bytes(self.buffer[self.HEADER_SIZE:self.HEADER_SIZE + length - first])
+        self.write_field(2, read + length)
+        return data
+
+    def write_all(self, data, timeout=None):
+        data = memoryview(data).cast('B')
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while data:
+            written = self.write(data)
+            data = data[written:]
+            if data and not written:
+                if deadline is not None and time.monotonic() > deadline:
+                    raise TimeoutError("Ring buffer is full")
+                time.sleep(self.POLL_INTERVAL)
+
+    def close_writer(self):
+        self.write_field(3, 1)
+
+    @property
+    def writer_closed(self):
+        return self.read_field(3) == 1
+
+    def read_chunks(self, chunk_size=None, timeout=None):
+        # Yields the data as it arrives, until the producer closes the stream
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            # the flag has to be checked before reading, or the last write could be missed
+            closed = self.writer_closed
+            data = self.read(chunk_size)
+            if data:
+                if timeout is not None:
+                    deadline = time.monotonic() + timeout
+                yield data
+            elif closed:
+                return
+            elif deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError("No data in the ring buffer")
+            else:
+                time.sleep(self.POLL_INTERVAL)
@@ -0,0 +1,127 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import os
+import select
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class FdBudgetExceeded(RuntimeError):
+    pass
+
+
+class Supervisor:
+    # Watches any number of processes through pidfds in a single epoll loop, and
+    # calls a callback as soon as one of them exits. The processes are not reaped,
+    # that is still the job of their parent.
+    # It also keeps track of the file descriptors used by the containers, and
+    # refuses (or waits, if fd_budget_timeout is given) to start new containers
+    # over fd_budget.
+    def __init__(self, *, fd_budget: int = None, fd_budget_timeout: float = 0):
+        self.fd_budget = fd_budget
+        self.fd_budget_timeout = fd_budget_timeout
+        self.fds_in_use = 0
+        self.fd_condition = threading.Condition()
+        self.lock = threading.Lock()
+        # pidfd -> (pid, callback)
+        self.watched = {}
+        self.epoll = None
+        self.wakeup_read = None
+        self.wakeup_write = None
+        self.thread = None
+
+    def start(self):
+        self.epoll = select.epoll()
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        self.epoll.register(self.wakeup_read, select.EPOLLIN)
+        self.thread = threading.Thread(name='furnace-supervisor', target=self.loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        os.write(self.wakeup_write, b'x')
+        self.thread.join()
+        self.epoll.close()
+        os.close(self.wakeup_read)
+        os.close(self.wakeup_write)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+        return False
+
+    def watch(self, pidfd, pid, callback):
+        # callback(pid) is called from the supervisor thread when the process exits
+        with self.lock:
+            self.watched[pidfd] = (pid, callback)
+        # a pidfd becomes readable when the process exits
+        self.epoll.register(pidfd, select.EPOLLIN | select.EPOLLONESHOT)
+
+    def unwatch(self, pidfd):
+        with self.lock:
+            if self.watched.pop(pidfd, None) is None:
+                # it was already reported
+                return
+        try:
+            self.epoll.unregister(pidfd)
+        except (OSError, ValueError):
+            pass
+
+    def loop(self):
+        while True:
+            for fd, _ in self.epoll.poll():
+                if fd == self.wakeup_read:
+                    return
+                with self.lock:
+                    watched = self.watched.pop(fd, None)
+                    if watched is None:
+                        # unwatch() already removed it
+                        continue
+                    # While the lock is held, unwatch() can not return, so the owner can
+                    # not close the pidfd yet. The errors are ignored like in unwatch().
+                    try:
+                        self.epoll.unregister(fd)
+                    except (OSError, ValueError):
+                        pass
+                pid, callback = watched
+                try:
+                    callback(pid)
+                except Exception:
+                    logger.exception("Exit callback of pid {} failed".format(pid))
+
+    def reserve_fds(self, count):
+        if self.fd_budget is None:
+            return
+        with self.fd_condition:
+            if not self.fd_condition.wait_for(lambda: self.fds_in_use + count <= self.fd_budget, self.fd_budget_timeout):
+                raise FdBudgetExceeded("File descriptor budget of {} exceeded ({} in use, {} requested)".format(
+                    self.fd_budget, self.fds_in_use, count))
+            self.fds_in_use += count
+
+    def release_fds(self, count):
+        if self.fd_budget is None:
+            return
+        with self.fd_condition:
+            self.fds_in_use -= count
+            self.fd_condition.notify_all()
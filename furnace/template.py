@@ -0,0 +1,194 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import array
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+from pathlib import Path
+from typing import Union, List
+
+from . import pid1
+from .config import BindMount, ContainerSpec, HOST_NETWORK_BIND_MOUNTS, MOUNT_PROPAGATION_SLAVE, \
+    MOUNT_PROPAGATION_MODES, TMPFS_KERNEL_DEPENDENT_OPTIONS
+from .context import ContainerContext, open_pidfd
+from .utils import PathEncoder, check_tmpfs_options
+
+logger = logging.getLogger(__name__)
+
+
+class ContainerTemplate:
+    # A process with the fully prepared mount tree of a container (bind mounts, root
+    # mount, the mounts of the spec, device nodes, systemd-tmpfiles), that new
+    # containers are cloned from. A clone gets new namespaces and a copy of the mount
+    # tree with a single clone() call, and only remounts the mounts of the spec,
+    # instead of starting a new Python interpreter and doing every step of the startup.
+    # Changes to the rootfs made after the template was started (e.g. new mount points)
+    # are not seen by the clones. Needs pidfd support (Linux 5.3).
+    # Usage:
+    #   with ContainerTemplate('/path/to/rootfs') as template:
+    #       for job in jobs:
+    #           with template.container() as container:
+    #               container.run(job)
+    def __init__(self, root_dir: Union[str, Path], *, isolate_networking: bool = False,
+                 bind_mounts: List[BindMount] = None, mountpoint_skeleton: bool = False, read_only_root: bool = False,
+                 spec: ContainerSpec = None, mount_propagation: str = MOUNT_PROPAGATION_SLAVE):
+        self.root_dir = Path(root_dir).resolve()
+        self.isolate_networking = isolate_networking
+        self.bind_mounts = list(bind_mounts or [])
+        if not isolate_networking:
+            self.bind_mounts.extend(HOST_NETWORK_BIND_MOUNTS)
+        self.mountpoint_skeleton = mountpoint_skeleton or read_only_root
+        self.read_only_root = read_only_root
+        self.spec = (spec if spec is not None else ContainerSpec.default()).validate()
+        if mount_propagation not in MOUNT_PROPAGATION_MODES:
+            raise ValueError("Unknown mount propagation mode: {}".format(mount_propagation))
+        self.mount_propagation = mount_propagation
+        self.lock = threading.Lock()
+        self.pid = None
+        self.socket = None
+        self.startup_timings = None
+
+    @property
+    def settings(self):
+        return (self.root_dir, self.isolate_networking, [tuple(bind) for bind in self.bind_mounts],
+                self.mountpoint_skeleton, self.read_only_root, self.spec, self.mount_propagation)
+
+    def check_compatible(self, manager):
+        # Called by ContainerPID1Manager, the container has to be what the template prepared
+        settings = (manager.root_dir, manager.isolate_networking, [tuple(bind) for bind in manager.bind_mounts],
+                    manager.mountpoint_skeleton, manager.read_only_root, manager.spec, manager.mount_propagation)
+        if settings != self.settings:
+            raise ValueError("The settings of the container differ from its template, use template.container()")
+
+    def container(self, **kwargs) -> ContainerContext:
+        # A ContainerContext cloned from this template. The keyword arguments are passed
+        # to ContainerContext, except for the ones given to the template.
+        return ContainerContext(
+            self.root_dir,
+            isolate_networking=self.isolate_networking,
+            # ContainerContext adds the host network bind mounts itself
+            bind_mounts=[bind for bind in self.bind_mounts if bind not in HOST_NETWORK_BIND_MOUNTS],
+            mountpoint_skeleton=self.mountpoint_skeleton,
+            read_only_root=self.read_only_root,
+            spec=self.spec,
+            mount_propagation=self.mount_propagation,
+            template=self,
+            **kwargs
+        )
+
+    def start(self):
+        if open_pidfd(os.getpid()) is None:
+            raise RuntimeError("Container templates need pidfd support (Linux 5.3 or newer)")
+        check_tmpfs_options(self.spec.mounts, TMPFS_KERNEL_DEPENDENT_OPTIONS)
+        parent_socket, child_socket = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        child_socket.set_inheritable(True)
+        self.pid = os.fork()
+        if not self.pid:
+            try:
+                parent_socket.close()
+                # this method will NOT return
+                self.do_exec(child_socket.fileno())
+            except BaseException as e:
+                # We are the child process, do NOT run parent's __exit__ handlers
+                print(e, file=sys.stderr)
+                os._exit(1)
+        child_socket.close()
+        self.socket = parent_socket
+        reply = self.socket.recv(pid1.TEMPLATE_MESSAGE_SIZE)
+        if not reply:
+            self.stop()
+            raise RuntimeError("Container template did not start")
+        self.startup_timings = json.loads(reply.decode('utf-8'))['timings']
+        logger.debug("Container template of {} started, PID: {}".format(self.root_dir, self.pid))
+        return self
+
+    def do_exec(self, template_socket):
+        params = json.dumps({
+            "loglevel": logging.getLevelName(logger.getEffectiveLevel()),
+            "root_dir": self.root_dir,
+            "control_read": None,
+            "control_write": None,
+            "isolate_networking": self.isolate_networking,
+            "bind_mounts": self.bind_mounts,
+            "mountpoint_skeleton": self.mountpoint_skeleton,
+            "read_only_root": self.read_only_root,
+            "spec": self.spec.to_json(),
+            "mount_propagation": self.mount_propagation,
+            "template_socket": template_socket,
+        }, cls=PathEncoder)
+        os.execl(sys.executable, sys.executable, pid1.__file__, params)
+
+    def stop(self):
+        # The running clones are not affected
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        if self.pid is not None:
+            os.waitpid(self.pid, 0)
+            self.pid = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+        return False
+
+    def clone_pid1(self, control_read, control_write, *, report_orphan_exits, placement, netns_path):
+        # Returns the pid and the pidfd of the new PID1
+        if self.socket is None:
+            raise RuntimeError("Container template is not running")
+        request = json.dumps({
+            "report_orphan_exits": report_orphan_exits,
+            "placement": placement.to_json() if placement is not None else None,
+            "isolate_networking": self.isolate_networking,
+        }).encode('utf-8')
+        fds = [control_read, control_write]
+        if netns_path is not None:
+            fds.append(os.open(str(netns_path), os.O_RDONLY))
+        try:
+            with self.lock:
+                self.socket.sendmsg([request], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+                reply, ancillary_data, _, _ = self.socket.recvmsg(
+                    pid1.TEMPLATE_MESSAGE_SIZE, socket.CMSG_SPACE(array.array('i').itemsize))
+        finally:
+            if netns_path is not None:
+                os.close(fds[2])
+        # The template reaps its clones, so the pid alone might already belong to an other
+        # process, if the clone exited early. The pidfd is opened by the template at clone().
+        pidfds = array.array('i')
+        for level, kind, data in ancillary_data:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                pidfds.frombytes(data[:len(data) - (len(data) % pidfds.itemsize)])
+        if not reply:
+            for fd in pidfds:
+                os.close(fd)
+            raise RuntimeError("Container template stopped unexpectedly")
+        reply = json.loads(reply.decode('utf-8'))
+        if 'error' in reply:
+            raise RuntimeError("Could not clone a container from the template: {}".format(reply['error']))
+        if len(pidfds) != 1:
+            for fd in pidfds:
+                os.close(fd)
+            raise RuntimeError("Container template did not send the pidfd of the clone")
+        return reply['pid'], pidfds[0]
@@ -0,0 +1,121 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import errno
+import logging
+import os
+import sys
+from pathlib import Path
+
+from .config import IdMapping
+from .libc import unshare, open_tree, move_mount, mount_setattr, CLONE_NEWUSER, OPEN_TREE_CLONE, OPEN_TREE_CLOEXEC, \
+    AT_EMPTY_PATH, AT_RECURSIVE, MOUNT_ATTR_IDMAP
+
+logger = logging.getLogger(__name__)
+
+
+def create_user_namespace(id_mapping: IdMapping):
+    # Returns an fd of a new user namespace with the mapping. The maps of a namespace
+    # can only be written from its parent namespace, so a short lived child process
+    # creates it, and we write its maps.
+    ready_read, ready_write = os.pipe2(os.O_CLOEXEC)
+    done_read, done_write = os.pipe2(os.O_CLOEXEC)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if not pid:
+        try:
+            os.close(ready_read)
+            os.close(done_write)
+            unshare(CLONE_NEWUSER)
+            os.write(ready_write, b'x')
+            # the namespace is kept alive until the parent opened it
+            os.read(done_read, 1)
+        except BaseException as e:
+            # We are the child process, do NOT run parent's __exit__ handlers
+            print(e, file=sys.stderr)
+        finally:
+            os._exit(0)
+    os.close(ready_write)
+    os.close(done_read)
+    try:
+        if not os.read(ready_read, 1):
+            raise RuntimeError("Could not create a user namespace")
+        proc_dir = Path('/proc', str(pid))
+        proc_dir.joinpath('uid_map').write_text(id_mapping.get_uid_map())
+        proc_dir.joinpath('gid_map').write_text(id_mapping.get_gid_map())
+        return os.open(str(proc_dir.joinpath('ns', 'user')), os.O_RDONLY | os.O_CLOEXEC)
+    finally:
+        os.close(ready_read)
+        os.close(done_write)
+        os.waitpid(pid, 0)
+
+
+def make_idmapped_mount(source: Path, destination: Path, userns_fd, *, recursive=False):
+    # Mounts a copy of the mount at source (with the mounts below it, if recursive) on
+    # destination, with the ownership mapped through the user namespace. Only a new,
+    # not yet attached mount can be ID-mapped.
+    flags = OPEN_TREE_CLONE | OPEN_TREE_CLOEXEC
+    if recursive:
+        flags |= AT_RECURSIVE
+    tree_fd = open_tree(source, flags)
+    try:
+        mount_setattr('', AT_EMPTY_PATH | (AT_RECURSIVE if recursive else 0), dir_fd=tree_fd,
+                      attr_set=MOUNT_ATTR_IDMAP, userns_fd=userns_fd)
+        move_mount(tree_fd, destination)
+    finally:
+        os.close(tree_fd)
+
+
+def check_idmapped_mounts(userns_fd, paths):
+    # ID-mapped mounts need Linux 5.12, and support from every filesystem involved
+    # (e.g. ext4, xfs, btrfs; tmpfs since 6.3, but not overlayfs mounts).
+    # A detached, ID-mapped copy of the mounts at paths (and below them) is made and
+    # thrown away, so that the container fails before PID1 is started.
+    for path in paths:
+        try:
+            tree_fd = open_tree(path, OPEN_TREE_CLONE | OPEN_TREE_CLOEXEC | AT_RECURSIVE)
+            try:
+                mount_setattr('', AT_EMPTY_PATH | AT_RECURSIVE, dir_fd=tree_fd, attr_set=MOUNT_ATTR_IDMAP, userns_fd=userns_fd)
+            finally:
+                os.close(tree_fd)
+        except OSError as e:
+            if e.errno == errno.ENOSYS:
+                raise RuntimeError("ID-mapped mounts need Linux 5.12 or newer") from None
+            if e.errno == errno.EINVAL:
+                raise RuntimeError(
+                    "The filesystem of {} (or of a mount below it) does not support ID-mapped mounts. "
+                    "Overlayfs mounts can not be ID-mapped, use a directory on e.g. ext4, xfs or btrfs".format(path)
+                ) from None
+            raise
+
+
+def shift_ownership(path: Path, id_mapping: IdMapping):
+    # Changes the owners of the files in the filesystem mounted at path from container
+    # ids to host ids. Used on the tmpfs mounts PID1 populates before it joins the user
+    # namespace. Other mounts below path are left alone.
+    device = os.lstat(str(path)).st_dev
+    paths = [str(path)]
+    for dirpath, dirnames, filenames in os.walk(str(path)):
+        dirnames[:] = [name for name in dirnames if os.lstat(os.path.join(dirpath, name)).st_dev == device]
+        paths.extend(os.path.join(dirpath, name) for name in dirnames + filenames)
+    for file_path in paths:
+        st = os.lstat(file_path)
+        if st.st_dev == device:
+            os.lchown(file_path, id_mapping.to_host_uid(st.st_uid), id_mapping.to_host_gid(st.st_gid))
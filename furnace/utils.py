@@ -18,11 +18,16 @@
 #
 
 import abc
+import errno
 import logging
+import shutil
+import tempfile
+import threading
+from collections import namedtuple
 from json import JSONEncoder
 from pathlib import Path
 
-from .libc import mount, umount, umount2, MS_BIND, MNT_DETACH, MS_REMOUNT, MS_RDONLY
+from .libc import mount, umount, umount2, MS_BIND, MNT_DETACH, MS_REMOUNT, MS_RDONLY, MS_NOATIME, MS_NODIRATIME
 
 logger = logging.getLogger(__name__)
 
@@ -40,12 +45,15 @@ class MountContext(abc.ABC):
         self.destination = destination
 
     def umount(self):
+        # Returns False if the mount was only detached
         logger.debug("Unmounting {path}".format(path=self.destination))
         try:
             umount(self.destination)
         except OSError:
             logger.warning("Failed to umount {path}, detaching instead".format(path=self.destination))
             umount2(self.destination, MNT_DETACH)
+            return False
+        return True
 
     @abc.abstractmethod
     def get_mount_parameters(self):
@@ -77,12 +85,152 @@ class BindMountContext(MountContext):
             mount(Path(), self.destination, None, MS_REMOUNT | MS_BIND | MS_RDONLY, None)
 
 
+OVERLAY_REDIRECT_DIR_MODES = ('on', 'follow', 'off', 'nofollow')
+OVERLAY_XINO_MODES = ('on', 'off', 'auto')
+
+# Created in the work directory by a volatile mount, the next mount is refused while it exists
+OVERLAY_VOLATILE_MARKER = Path('work/incompat/volatile')
+
+
+class OverlayOptions(namedtuple('OverlayOptions', ['volatile', 'metacopy', 'index', 'redirect_dir', 'xino',
+                                                   'userxattr', 'noatime', 'nodiratime'])):
+    # Options of an overlayfs mount. None means the default of the kernel (see
+    # /sys/module/overlay/parameters). Options not supported by the kernel are left
+    # out with a warning, see OverlayfsMountContext.mount().
+    # volatile: no syncfs/fsync on the upper layer (Linux 5.10), for throwaway upper
+    #   layers, which are inconsistent after a crash
+    # metacopy: metadata changes (chmod, chown, utime) do not copy up the file data
+    # index: inode index, needed for hard links over copy up, off makes copy up faster
+    # redirect_dir: renaming lower directories, see OVERLAY_REDIRECT_DIR_MODES
+    # xino: unique inode numbers over the layers, see OVERLAY_XINO_MODES
+    # userxattr: user.overlay.* xattrs instead of trusted.overlay.* (Linux 5.11)
+    # noatime, nodiratime: MS_NOATIME/MS_NODIRATIME mount flags
+    __slots__ = ()
+
+    def __new__(cls, volatile=False, metacopy=None, index=None, redirect_dir=None, xino=None,
+                userxattr=False, noatime=False, nodiratime=False):
+        return super().__new__(cls, volatile, metacopy, index, redirect_dir, xino, userxattr, noatime, nodiratime)
+
+    @classmethod
+    def fast_scratch(cls):
+        # For upper layers that are thrown away after the job
+        return cls(volatile=True, metacopy=True, index=False, noatime=True)
+
+    def validate(self):
+        if self.redirect_dir is not None and self.redirect_dir not in OVERLAY_REDIRECT_DIR_MODES:
+            raise ValueError("Unknown overlayfs redirect_dir mode: {}".format(self.redirect_dir))
+        if self.xino is not None and self.xino not in OVERLAY_XINO_MODES:
+            raise ValueError("Unknown overlayfs xino mode: {}".format(self.xino))
+        if self.metacopy and self.redirect_dir in ('off', 'nofollow'):
+            raise ValueError("overlayfs metacopy needs redirect_dir on or follow")
+        return self
+
+    def get_mount_options(self):
+        # The options passed to the kernel, except the layer directories
+        options = []
+        if self.volatile:
+            options.append('volatile')
+        for name in ('metacopy', 'index'):
+            value = getattr(self, name)
+            if value is not None:
+                options.append('{}={}'.format(name, 'on' if value else 'off'))
+        for name in ('redirect_dir', 'xino'):
+            value = getattr(self, name)
+            if value is not None:
+                options.append('{}={}'.format(name, value))
+        if self.userxattr:
+            options.append('userxattr')
+        return options
+
+    def get_mount_flags(self):
+        return (MS_NOATIME if self.noatime else 0) | (MS_NODIRATIME if self.nodiratime else 0)
+
+    def to_json(self):
+        return self._asdict()
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(**data)
+
+
+overlay_option_support = {}
+overlay_option_support_lock = threading.Lock()
+
+
+def is_overlay_option_supported(option):
+    # Tries the option with an overlay mount of empty directories on a tmpfs
+    with overlay_option_support_lock:
+        if option not in overlay_option_support:
+            overlay_option_support[option] = probe_overlay_option(option)
+        return overlay_option_support[option]
+
+
+def probe_overlay_option(option):
+    probe_dir = Path(tempfile.mkdtemp(prefix='furnace-overlay-probe-'))
+    try:
+        mount(Path('tmpfs'), probe_dir, 'tmpfs', 0, None)
+        try:
+            for name in ('lower', 'upper', 'work', 'mounted'):
+                probe_dir.joinpath(name).mkdir()
+            layers = 'lowerdir={0}/lower,upperdir={0}/upper,workdir={0}/work'.format(probe_dir)
+            try:
+                mount(Path('overlay'), probe_dir.joinpath('mounted'), 'overlay', 0, layers + ',' + option)
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                return False
+            umount(probe_dir.joinpath('mounted'))
+            return True
+        finally:
+            umount2(probe_dir, MNT_DETACH)
+    finally:
+        shutil.rmtree(str(probe_dir), ignore_errors=True)
+
+
+tmpfs_option_support = {}
+tmpfs_option_support_lock = threading.Lock()
+
+
+def is_tmpfs_option_supported(option):
+    with tmpfs_option_support_lock:
+        if option not in tmpfs_option_support:
+            probe_dir = Path(tempfile.mkdtemp(prefix='furnace-tmpfs-probe-'))
+            try:
+                mount(Path('tmpfs'), probe_dir, 'tmpfs', 0, option)
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                tmpfs_option_support[option] = False
+            else:
+                umount(probe_dir)
+                tmpfs_option_support[option] = True
+            finally:
+                probe_dir.rmdir()
+        return tmpfs_option_support[option]
+
+
+def check_tmpfs_options(mounts, option_names):
+    # Raises ValueError if an option of the tmpfs mounts is not supported by the kernel
+    # (e.g. huge= without transparent hugepages, noswap before Linux 6.4, mpol= with a
+    # NUMA node that does not exist), instead of failing in PID1 with a bare EINVAL.
+    # Only the given options are checked, the results are cached.
+    for m in mounts:
+        if m.type != "tmpfs":
+            continue
+        for option in m.options or []:
+            if option.partition('=')[0] in option_names and not is_tmpfs_option_supported(option):
+                raise ValueError("The tmpfs option {} of {} is not supported by the kernel".format(option, m.destination))
+
+
 class OverlayfsMountContext(MountContext):
-    def __init__(self, ro_dirs, rw_dir, work_dir, destination):
+    def __init__(self, ro_dirs, rw_dir, work_dir, destination, options: OverlayOptions = None):
         super().__init__("overlay", destination)
         self.ro_dirs = ro_dirs
         self.rw_dir = rw_dir
         self.work_dir = work_dir
+        self.options = (options if options is not None else OverlayOptions()).validate()
+        # the mount options used, without the ones the kernel does not support
+        self.mount_options = self.options.get_mount_options()
 
     def get_mount_parameters(self):
         options_string = 'lowerdir={lowerdir},upperdir={upperdir},workdir={workdir}'.format(
@@ -90,4 +238,31 @@ class OverlayfsMountContext(MountContext):
             upperdir=self.rw_dir,
             workdir=self.work_dir
         )
-        return "overlay", 0, options_string
+        options_string = ','.join([options_string] + self.mount_options)
+        return "overlay", self.options.get_mount_flags(), options_string
+
+    def mount(self):
+        try:
+            super().mount()
+        except OSError as e:
+            # Older kernels refuse unknown options with EINVAL, retry without them
+            if e.errno != errno.EINVAL or not self.mount_options:
+                raise
+            unsupported = [option for option in self.mount_options if not is_overlay_option_supported(option)]
+            if not unsupported:
+                raise
+            logger.warning("overlayfs options not supported by the kernel, ignoring them: {}".format(
+                ', '.join(unsupported)))
+            self.mount_options = [option for option in self.mount_options if option not in unsupported]
+            super().mount()
+
+    def umount(self):
+        unmounted = super().umount()
+        if unmounted and 'volatile' in self.mount_options:
+            # The data is still in the page cache after a clean umount, so the upper layer
+            # can be reused, only a crash would make it inconsistent
+            try:
+                shutil.rmtree(str(Path(self.work_dir).joinpath(OVERLAY_VOLATILE_MARKER)))
+            except FileNotFoundError:
+                pass
+        return unmounted
@@ -0,0 +1,80 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import time
+from pathlib import Path
+
+from furnace.cache import RunCache, rootfs_fingerprint
+from furnace.utils import OverlayfsMountContext
+
+
+def test_run_cache_stores_and_restores_results(tmp_path):
+    output = tmp_path.joinpath('output')
+    output.write_bytes(b'generated')
+    cache = RunCache(tmp_path.joinpath('cache'))
+    key = RunCache.make_key('rootfs', ['generate'], None, None, {'/input': 'abc'})
+    assert key != RunCache.make_key('rootfs', ['generate'], None, None, {'/input': 'abd'})
+    assert RunCache.make_key('rootfs', ['generate'], {b'LANG': b'C'}, b'/src', {}) == \
+        RunCache.make_key('rootfs', ['generate'], {'LANG': 'C'}, '/src', {})
+    assert cache.get(key) is None
+    with output.open('rb') as f:
+        cache.put(key, 0, b'out', b'err', [('/output', f)])
+    meta, entry = cache.get(key)
+    assert (meta['returncode'], meta['stdout'], meta['stderr']) == (0, b'out', b'err')
+    assert meta['outputs'][0][0] == '/output'
+    assert entry.joinpath('0').read_bytes() == b'generated'
+    assert cache.stats().hit_rate == 0.5
+    assert RunCache(tmp_path.joinpath('cache')).stats().entries == 1, "Entries should be loaded from the disk"
+
+
+def test_run_cache_evicts_least_recently_used(tmp_path):
+    cache = RunCache(tmp_path.joinpath('cache'), max_size=25)
+    for key in ['first', 'second']:
+        cache.put(key, 0, b'x' * 10, b'', [])
+        # make sure the modification times differ
+        time.sleep(0.01)
+    cache.get('first')
+    cache.put('third', 0, b'x' * 10, b'', [])
+    assert cache.get('second') is None
+    assert cache.get('first') is not None
+    assert cache.stats().evictions == 1
+    assert cache.stats().size == 20
+
+
+def test_rootfs_fingerprint_of_overlay(tmp_path):
+    lower = tmp_path.joinpath('lower')
+    lower.mkdir()
+    upper = tmp_path.joinpath('upper')
+    upper.mkdir()
+    work = tmp_path.joinpath('work')
+    work.mkdir()
+    mounted = tmp_path.joinpath('mounted')
+    mounted.mkdir()
+    with OverlayfsMountContext([lower], upper, work, mounted):
+        empty = rootfs_fingerprint(mounted)
+        mounted.joinpath('dir').mkdir()
+        mounted.joinpath('dir').rmdir()
+        assert rootfs_fingerprint(mounted) == empty, "Directory modification times should not matter"
+        mounted.joinpath('file').write_text('data')
+        changed = rootfs_fingerprint(mounted)
+        assert changed != empty
+        os.utime(str(mounted.joinpath('file')), ns=(0, 0))
+        assert rootfs_fingerprint(mounted) != changed
+    assert rootfs_fingerprint(Path(str(lower))) == rootfs_fingerprint(lower)
@@ -0,0 +1,32 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import pytest
+
+from furnace.cgroup import ContainerCgroup
+
+
+def test_set_frozen_restores_the_state_on_timeout(tmp_path):
+    # a cgroup that never gets frozen
+    tmp_path.joinpath('cgroup.freeze').write_text('0')
+    tmp_path.joinpath('cgroup.events').write_text('populated 1\nfrozen 0\n')
+    cgroup = ContainerCgroup(tmp_path)
+    with pytest.raises(TimeoutError):
+        cgroup.set_frozen(True, timeout=0.1)
+    assert tmp_path.joinpath('cgroup.freeze').read_text() == '0'
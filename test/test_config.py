@@ -0,0 +1,67 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from pathlib import Path
+
+import pytest
+
+from furnace.config import ContainerSpec, IdMapping, TmpfsOptions
+
+
+def test_tmpfs_options_replace_the_defaults_of_the_mount():
+    spec = ContainerSpec.default().with_tmpfs('/dev/shm', TmpfsOptions(size='2g', huge='within_size', mpol='interleave:0'))
+    shm = next(m for m in spec.mounts if m.destination == Path('/dev/shm'))
+    assert shm.options == ['mode=1777', 'size=2g', 'huge=within_size', 'mpol=interleave:0']
+    run = next(m for m in spec.mounts if m.destination == Path('/run'))
+    assert run.options == ['mode=1777', 'size=65536k'], "Other mounts should not change"
+    assert TmpfsOptions(nr_inodes='10k', noswap=True).get_mount_options() == ['nr_inodes=10k', 'noswap']
+    assert TmpfsOptions.from_json(TmpfsOptions(size='50%').to_json()) == TmpfsOptions(size='50%')
+
+
+@pytest.mark.parametrize('options', [
+    TmpfsOptions(size='lots'),
+    TmpfsOptions(nr_inodes='10%'),
+    TmpfsOptions(huge='sometimes'),
+    TmpfsOptions(mpol='random'),
+    TmpfsOptions(mpol='bind:0;1'),
+])
+def test_invalid_tmpfs_options(options):
+    with pytest.raises(ValueError):
+        ContainerSpec.default().with_tmpfs('/dev/shm', options)
+
+
+def test_tmpfs_options_need_a_tmpfs_mount():
+    with pytest.raises(ValueError):
+        ContainerSpec.default().with_tmpfs('/proc', TmpfsOptions(size='1g'))
+    with pytest.raises(ValueError):
+        ContainerSpec.default().with_tmpfs('/nonexistent', TmpfsOptions(size='1g'))
+
+
+def test_id_mapping():
+    mapping = IdMapping(100000).validate()
+    assert mapping.gid == 100000
+    assert mapping.get_uid_map() == "0 100000 65536\n"
+    assert IdMapping(100000, 200000, 1000).get_gid_map() == "0 200000 1000\n"
+    assert mapping.to_host_uid(0) == 100000
+    assert mapping.to_host_gid(65535) == 165535
+    assert mapping.to_host_uid(70000) == 70000, "Ids outside of the mapping should not change"
+    assert IdMapping.from_json(mapping.to_json()) == mapping
+    for invalid in (IdMapping(-1), IdMapping(1, size=0), IdMapping(2 ** 32 - 100)):
+        with pytest.raises(ValueError):
+            invalid.validate()
@@ -17,16 +17,30 @@
 # along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import io
 import os
 import pytest
 import re
+import shutil
+import signal
 import subprocess
 import threading
+import time
 from pathlib import Path
 
-from furnace.config import BindMount
+from furnace.cache import RunCache
+from furnace.config import BindMount, ContainerSpec, IdMapping, TmpfsOptions, MOUNT_PROPAGATION_MODES, MOUNT_PROPAGATION_PRIVATE
 from furnace.context import ContainerContext
+from furnace.fanout import run_matrix
+from furnace.image import ImageMounter
 from furnace.libc import is_mount_point
+from furnace.netns import NetnsPool
+from furnace.placement import Placement, NumaPacker, AUTO_NUMA_NODE
+from furnace.prewarm import PrewarmProfileStore
+from furnace.scheduler import Scheduler
+from furnace.sharedbuffer import RingBuffer, SharedBuffer
+from furnace.supervisor import Supervisor, FdBudgetExceeded
+from furnace.template import ContainerTemplate
 from furnace.utils import BindMountContext, OverlayfsMountContext
 
 
@@ -126,6 +140,139 @@ def test_lock_dirs_are_present(rootfs_for_testing):
         # no assert, because the previous two commands would have thrown an Exception on error
 
 
+def test_run_matrix(rootfs_for_testing):
+    output = io.StringIO()
+    bind_mounts = [BindMount(rootfs_for_testing.joinpath('tmp'), Path('/mnt'), True)]
+    result = run_matrix([rootfs_for_testing] * 3, ['/bin/ls', '/mnt'], bind_mounts=bind_mounts, output=None)
+    assert result.ok
+    assert len(bind_mounts) == 1, "The bind_mounts argument should not be changed"
+    result = run_matrix([rootfs_for_testing, rootfs_for_testing], ['/bin/sh', '-c', 'echo ok; sleep 0.5'], output=output)
+    assert result.ok
+    assert [entry.output for entry in result.entries] == [b'ok\n', b'ok\n']
+    assert output.getvalue() == '[{0}] ok\n[{0}] ok\n'.format(rootfs_for_testing)
+    assert result.wall_time < sum(entry.startup_time + entry.run_time for entry in result.entries), \
+        "The containers should run in parallel"
+    result = run_matrix([rootfs_for_testing] * 3, ['/bin/sh', '-c', 'exit 3'], max_parallel=1, fail_fast=True, output=None)
+    assert not result.ok
+    assert [entry.returncode for entry in result.entries] == [3, None, None]
+    assert [entry.cancelled for entry in result.entries] == [False, True, True]
+    assert len(result.failed) == 1
+    assert str(rootfs_for_testing) in result.format_table()
+
+
+def test_pause_and_resume(rootfs_for_testing):
+    with ContainerContext(rootfs_for_testing, pausable=True) as cnt:
+        counter = cnt.Popen(['/bin/sh', '-c', 'while true; do echo x >>/tmp/ticks; /bin/sleep 0.01; done'])
+        time.sleep(0.2)
+        assert cnt.pause() > 0
+        assert cnt.paused
+        size = cnt.stat('/tmp/ticks').st_size
+        time.sleep(0.2)
+        assert cnt.stat('/tmp/ticks').st_size == size, "The processes should not run while paused"
+        cnt.resume()
+        time.sleep(0.2)
+        assert cnt.stat('/tmp/ticks').st_size > size
+        cnt.pause()
+        assert cnt.run(['/bin/true']).returncode == 0, "run() should resume the container"
+        assert not cnt.paused
+        counter.kill()
+        counter.wait()
+    with ContainerContext(rootfs_for_testing) as cnt:
+        with pytest.raises(RuntimeError):
+            cnt.pause()
+
+
+def test_auto_pause(rootfs_for_testing):
+    with ContainerContext(rootfs_for_testing, auto_pause_after=0.2) as cnt:
+        sleeper = cnt.Popen(['/bin/sleep', '0.5'])
+        time.sleep(0.4)
+        assert not cnt.paused, "The container should not be paused while a process is running"
+        sleeper.wait()
+        time.sleep(0.5)
+        assert cnt.paused
+        assert cnt.run(['/bin/true']).returncode == 0
+        assert not cnt.paused
+
+
+def test_user_namespace_with_idmapped_rootfs(debootstrapped_dir, rootfs_for_testing, tmp_path):
+    # Overlayfs mounts can not be ID-mapped, the plain directory is used, read-only,
+    # as it is shared with the other tests
+    data_dir = tmp_path.joinpath('data')
+    data_dir.mkdir()
+    bind_mounts = [BindMount(data_dir, Path('/mnt'), False)]
+    with ContainerContext(debootstrapped_dir, id_mapping=IdMapping(100000), bind_mounts=bind_mounts,
+                          read_only_root=True, isolate_networking=True) as cnt:
+        output = cnt.run(['/bin/sh', '-c', 'id -u; stat -c %u /bin/sh /dev/null /run'], check=True, stdout=subprocess.PIPE).stdout
+        assert output.split() == [b'0', b'0', b'0', b'0'], "Root should own the rootfs and the tmpfs mounts in the container"
+        cnt.run(['/bin/touch', '/mnt/new_file'], check=True)
+        assert cnt.call(os.getuid) == 0
+        assert cnt.stat('/mnt/new_file').st_uid == 100000, "The host should see the mapped uid"
+        assert cnt.run(['/bin/hostname', 'changed'], stderr=subprocess.DEVNULL).returncode != 0
+    assert data_dir.joinpath('new_file').stat().st_uid == 0, "The files should be stored without the mapping"
+    with pytest.raises(RuntimeError):
+        with ContainerContext(rootfs_for_testing, id_mapping=IdMapping(100000)):
+            pass
+    with pytest.raises(ValueError):
+        ContainerContext(None, id_mapping=IdMapping(100000))
+
+
+def test_host_root_container():
+    with ContainerContext(None) as cnt:
+        assert cnt.startup_timings.keys() == {'create_namespaces', 'set_root_mount_propagation', 'mount_defaults', 'set_hostname'}
+        output = cnt.run(['/bin/sh', '-c', 'echo $$; hostname'], check=True, stdout=subprocess.PIPE).stdout.decode('utf-8')
+        assert output.split() == ['2', 'localhost'], "The shell should be in a new pid and uts namespace"
+        assert cnt.listdir('/proc/1/fd'), "The /proc of the container's pid namespace should be mounted"
+        cnt.run(['/bin/bash', '-c', '/bin/sleep 31339 >/dev/null 2>/dev/null&'], check=True)
+    ps_output = subprocess.run(['/bin/ps', '-eo', 'args'], check=True, stdout=subprocess.PIPE).stdout.decode('utf-8')
+    assert '/bin/sleep 31339' not in ps_output.splitlines(), 'The sleep should no longer be running'
+    with pytest.raises(ValueError):
+        ContainerContext(None, bind_mounts=[BindMount(Path('/tmp'), Path('/mnt'), False)])
+    with pytest.raises(ValueError):
+        ContainerContext(None, spec=ContainerSpec.default())
+    with pytest.raises(ValueError):
+        ContainerContext(None, spec=ContainerSpec.host_root()._replace(mounts=ContainerSpec.minimal().mounts))
+
+
+def test_tmpfs_options_and_usage(rootfs_for_testing):
+    spec = ContainerSpec.default().with_tmpfs('/dev/shm', TmpfsOptions(size='128m', nr_inodes='1k', huge='within_size'))
+    with ContainerContext(rootfs_for_testing, spec=spec) as cnt:
+        cnt.run(['/bin/dd', 'if=/dev/zero', 'of=/dev/shm/data', 'bs=1M', 'count=4'], check=True, stderr=subprocess.DEVNULL)
+        usage = cnt.tmpfs_usage()
+        assert usage[Path('/dev/shm')].size == 128 * 1024 * 1024
+        assert usage[Path('/dev/shm')].inodes == 1024
+        assert usage[Path('/dev/shm')].used >= 4 * 1024 * 1024
+        assert usage[Path('/run')].used < 4 * 1024 * 1024
+    spec = ContainerSpec.default().with_tmpfs('/dev/shm', TmpfsOptions(mpol='bind:4095'))
+    with pytest.raises(ValueError):
+        with ContainerContext(rootfs_for_testing, spec=spec):
+            pass
+
+
+def test_file_api_resolves_paths_in_the_container(rootfs_for_testing, tmp_path):
+    mounted_dir = tmp_path.joinpath('mounted')
+    mounted_dir.mkdir()
+    mounted_dir.joinpath('test_file').write_text('Test data')
+    bind_mounts = [BindMount(mounted_dir, Path('mounted'), False)]
+    with ContainerContext(rootfs_for_testing, bind_mounts=bind_mounts) as cnt:
+        with cnt.open('/mounted/test_file') as f:
+            assert f.read() == 'Test data'
+        cnt.run(['/bin/ln', '-s', '/mounted/test_file', '/tmp/link'], check=True)
+        with cnt.open('/tmp/link') as f:
+            assert f.read() == 'Test data', "Absolute symlinks should be resolved in the container"
+        with cnt.open('/mounted/written', 'w') as f:
+            f.write('from the host')
+        assert mounted_dir.joinpath('written').read_text() == 'from the host'
+        assert cnt.stat('/tmp/link', follow_symlinks=False).st_size == len('/mounted/test_file')
+        assert '1' in cnt.listdir('/proc'), "The container's own /proc should be visible"
+        assert ('/mounted', [], ['test_file', 'written']) in [
+            (dirpath, dirnames, sorted(filenames)) for dirpath, dirnames, filenames in cnt.walk('/mounted')
+        ]
+        assert cnt.exists('/mounted/test_file')
+        assert not cnt.exists('/mounted/missing')
+        with pytest.raises(FileNotFoundError):
+            cnt.open('/mounted/missing')
+
+
 def test_networking_is_isolated_when_asked(rootfs_for_testing):
     with ContainerContext(rootfs_for_testing, isolate_networking=True) as cnt:
         ip_output = cnt.run(['/bin/ip', 'address', 'list'], check=True, stdout=subprocess.PIPE).stdout.decode('utf-8')
@@ -254,3 +401,320 @@ def test_ro_bind_mounts_from_outside(rootfs_for_testing, tmp_path):
             assert output == b"Test data"
             result = cnt.run(['/bin/touch', '/mounted_ro/test_file'])
             assert result.returncode != 0, "Touch should fail, because mounted_ro should be read-only"
+
+
+def test_orphan_exits_are_reported(rootfs_for_testing):
+    with ContainerContext(rootfs_for_testing, report_orphan_exits=True) as cnt:
+        # The inner shell exits immediately, so the sleep is reparented to PID1
+        cnt.run(['/bin/sh', '-c', '(/bin/sleep 0.5; exit 7) &'], check=True)
+        record = next(cnt.orphan_exits(timeout=10))
+        assert record.returncode == 7
+        assert record.argv[0].endswith('sh')
+        assert record.lifetime >= 0.5
+        assert list(cnt.orphan_exits(timeout=0)) == []
+
+
+def test_networking_from_netns_pool(rootfs_for_testing, tmp_path):
+    with NetnsPool(1, directory=tmp_path) as pool:
+        for _ in range(2):
+            with ContainerContext(rootfs_for_testing, netns_pool=pool) as cnt:
+                ip_output = cnt.run(['/bin/ip', 'address', 'list'], check=True, stdout=subprocess.PIPE).stdout.decode('utf-8')
+                assert re.search("^1: lo.*UP", ip_output, flags=re.MULTILINE) is not None, "Loopback interface should be up"
+                assert re.search("^2: ", ip_output, flags=re.MULTILINE) is None, "No other interfaces should be present"
+            assert len(pool.free) == 1, "The network namespace should be returned to the pool"
+
+
+def test_containers_can_share_named_netns(rootfs_for_testing, tmp_path):
+    with NetnsPool(1, directory=tmp_path) as pool:
+        shared_netns = pool.acquire()
+        with ContainerContext(rootfs_for_testing, netns=shared_netns) as cnt1, \
+                ContainerContext(rootfs_for_testing, netns=shared_netns) as cnt2:
+            netns1 = cnt1.run(['/bin/readlink', '/proc/self/ns/net'], check=True, stdout=subprocess.PIPE).stdout
+            netns2 = cnt2.run(['/bin/readlink', '/proc/self/ns/net'], check=True, stdout=subprocess.PIPE).stdout
+            assert netns1 == netns2
+        pool.release(shared_netns)
+
+
+def test_mountpoint_skeleton_does_not_touch_files(debootstrapped_dir, tmp_path):
+    overlay_workdir = tmp_path.joinpath('overlay_work')
+    overlay_workdir.mkdir()
+    overlay_rwdir = tmp_path.joinpath('overlay_rw')
+    overlay_rwdir.mkdir()
+    overlay_mounted = tmp_path.joinpath('overlay_mount')
+    overlay_mounted.mkdir()
+    bind_source = tmp_path.joinpath('bind_source')
+    bind_source.mkdir()
+    bind_source.joinpath('test_file').write_text('Test data')
+    bind_mounts = [BindMount(bind_source, Path('mounted', 'multiple', 'dirs'), False)]
+    with OverlayfsMountContext([debootstrapped_dir], overlay_rwdir, overlay_workdir, overlay_mounted):
+        with ContainerContext(overlay_mounted, isolate_networking=True, bind_mounts=bind_mounts, mountpoint_skeleton=True) as cnt:
+            assert cnt.plan_bind_mounts().cost.rootfs_writes == 0
+            output = cnt.run(['/bin/cat', '/mounted/multiple/dirs/test_file'], check=True, stdout=subprocess.PIPE).stdout
+            assert output == b"Test data"
+
+    modified_files = list(overlay_rwdir.iterdir())
+    assert len(modified_files) == 0, "No mountpoints should have been created in the rootfs"
+
+
+def test_lifecycle_hooks(rootfs_for_testing):
+    events = []
+    cnt = ContainerContext(rootfs_for_testing)
+    cnt.hooks.add(events.append)
+    with cnt:
+        cnt.run(['/bin/true'], check=True)
+        cnt.Popen(['/bin/sh', '-c', 'exit 3']).wait()
+    assert [event.name for event in events] == ['start', 'ready', 'spawn', 'exit', 'spawn', 'exit', 'teardown']
+    assert events[5].data['returncode'] == 3
+    assert all(earlier.timestamp <= later.timestamp for earlier, later in zip(events, events[1:]))
+
+
+def read_os_release(path):
+    with open(path) as f:
+        return f.read()
+
+
+def test_call_runs_python_in_the_container(rootfs_for_testing):
+    with ContainerContext(rootfs_for_testing) as cnt:
+        assert cnt.call(os.getpid) != os.getpid()
+        assert cnt.call(read_os_release, '/etc/os-release') == rootfs_for_testing.joinpath('etc', 'os-release').read_text()
+        assert sorted(cnt.call(os.listdir, '/')) == sorted(cnt.run(['/bin/ls', '-A', '/'], check=True, stdout=subprocess.PIPE).stdout.decode('utf-8').split())
+        with pytest.raises(FileNotFoundError):
+            cnt.call(read_os_release, '/no/such/file')
+        assert cnt.map(os.path.isdir, ['/bin', '/etc/os-release', '/nonexistent'], workers=2) == [True, False, False]
+
+
+def test_read_only_root_does_not_touch_the_rootfs(rootfs_for_testing, tmp_path):
+    tmp_path.joinpath('bind_source').mkdir()
+    bind_mounts = [BindMount(tmp_path.joinpath('bind_source'), Path('not', 'in', 'rootfs'), False)]
+    overlay_rwdir = rootfs_for_testing.parent.joinpath('overlay_rw')
+    with ThreadForTesting():
+        containers = [ContainerContext(rootfs_for_testing, read_only_root=True, bind_mounts=list(bind_mounts)) for _ in range(4)]
+        for cnt in containers:
+            cnt.__enter__()
+        try:
+            for index, cnt in enumerate(containers):
+                result = cnt.run(['/bin/touch', '/etc/test_file'])
+                assert result.returncode != 0, "The root should be read-only"
+                cnt.run(['/bin/touch', '/not/in/rootfs/file{}'.format(index)], check=True)
+                cnt.run(['/bin/touch', '/dev/shm/test_file', '/run/test_file'], check=True)
+        finally:
+            for cnt in containers:
+                cnt.__exit__(None, None, None)
+    assert len(list(tmp_path.joinpath('bind_source').iterdir())) == 4
+    assert list(overlay_rwdir.iterdir()) == [], "Nothing should have been written to the rootfs"
+
+
+def test_read_only_root_with_missing_mountpoints(rootfs_for_testing, tmp_path):
+    # /run needs a skeleton on /, which is where the bind mount goes too
+    shutil.rmtree(str(rootfs_for_testing.joinpath('run')))
+    bind_source = tmp_path.joinpath('bind_source')
+    bind_source.mkdir()
+    bind_mounts = [BindMount(bind_source, Path('/not_in_rootfs'), False)]
+    with ContainerContext(rootfs_for_testing, read_only_root=True, bind_mounts=bind_mounts) as cnt:
+        cnt.run(['/bin/touch', '/not_in_rootfs/file', '/run/file'], check=True)
+        assert cnt.run(['/bin/touch', '/file'], stderr=subprocess.DEVNULL).returncode != 0, "The root should be read-only"
+    assert bind_source.joinpath('file').exists()
+    assert not rootfs_for_testing.joinpath('not_in_rootfs').exists()
+
+
+def test_container_spec_presets(rootfs_for_testing):
+    with ContainerContext(rootfs_for_testing, spec=ContainerSpec.minimal()) as cnt:
+        assert sorted(cnt.listdir('/dev')) == ['null', 'random', 'urandom', 'zero']
+        assert not cnt.exists('/sys/kernel'), "/sys should not be mounted"
+        assert 'create_namespaces' in cnt.startup_timings
+    with ContainerContext(rootfs_for_testing, spec=ContainerSpec.full()) as cnt:
+        mount_output = cnt.run(['/bin/mount'], check=True, stdout=subprocess.PIPE).stdout.decode('utf-8')
+        assert re.search("^tmpfs on /tmp ", mount_output, flags=re.MULTILINE) is not None
+    with pytest.raises(ValueError):
+        ContainerContext(rootfs_for_testing, spec=ContainerSpec.minimal()._replace(namespaces=('pid',)))
+
+
+def test_cached_run(rootfs_for_testing, tmp_path):
+    cache = RunCache(tmp_path.joinpath('cache'))
+    rootfs_for_testing.joinpath('input').write_text('input data')
+    command = ['/bin/sh', '-c', 'tr a-z A-Z </input >/output; echo generated']
+    with ContainerContext(rootfs_for_testing, run_cache=cache) as cnt:
+        result = cnt.cached_run(command, inputs=['/input'], outputs=['/output'], check=True)
+        assert result.stdout == b'generated\n'
+        cnt.run(['/bin/rm', '/output'], check=True)
+        assert cnt.cached_run(command, inputs=['/input'], outputs=['/output'], check=True).stdout == b'generated\n'
+        assert rootfs_for_testing.joinpath('output').read_text() == 'INPUT DATA'
+        assert cache.stats().hits == 1
+        rootfs_for_testing.joinpath('input').write_text('other data')
+        cnt.cached_run(command, inputs=['/input'], outputs=['/output'], check=True)
+        assert cache.stats().misses == 2, "A changed input should not be a hit"
+        # changes made in the container are part of the key, even if they are not inputs
+        cnt.run(['/bin/sh', '-c', 'echo first >/state'], check=True)
+        assert cnt.cached_run(['/bin/cat', '/state'], check=True).stdout == b'first\n'
+        cnt.run(['/bin/sh', '-c', 'echo second >/state'], check=True)
+        assert cnt.cached_run(['/bin/cat', '/state'], check=True).stdout == b'second\n'
+        # an absolute symlink would point to the host, if it was not resolved in the container
+        host_file = tmp_path.joinpath('host_file')
+        host_file.write_text('host data')
+        cnt.run(['/bin/ln', '-sf', str(host_file), '/output'], check=True)
+        with pytest.raises(OSError):
+            cnt.cached_run(command, inputs=['/input'], outputs=['/output'], check=True)
+        assert host_file.read_text() == 'host data'
+
+
+def test_cached_run_needs_a_rootfs_fingerprint(debootstrapped_dir, tmp_path):
+    cache = RunCache(tmp_path.joinpath('cache'))
+    with pytest.raises(ValueError):
+        ContainerContext(debootstrapped_dir, run_cache=cache)
+    with ContainerContext(debootstrapped_dir, run_cache=cache, rootfs_fingerprint='rootfs-v1', read_only_root=True) as cnt:
+        assert cnt.rootfs_fingerprint == 'rootfs-v1'
+        assert cnt.cached_run(['/bin/echo', 'hello'], check=True).stdout == b'hello\n'
+        assert cnt.cached_run(['/bin/echo', 'hello'], check=True).stdout == b'hello\n'
+    assert cache.stats().hits == 1
+
+
+def test_supervisor_detects_pid1_exit(rootfs_for_testing):
+    with Supervisor(fd_budget=100) as supervisor:
+        with ContainerContext(rootfs_for_testing, supervisor=supervisor) as cnt:
+            assert 0 < supervisor.fds_in_use <= 100
+            cnt.run(['/bin/true'], check=True)
+            os.kill(cnt.pid1.pid, signal.SIGKILL)
+            for _ in range(100):
+                if cnt.pid1_exited:
+                    break
+                time.sleep(0.01)
+            with pytest.raises(RuntimeError):
+                cnt.run(['/bin/true'])
+        assert supervisor.fds_in_use == 0
+
+
+def test_supervisor_fd_budget(rootfs_for_testing):
+    with Supervisor(fd_budget=1) as supervisor:
+        with pytest.raises(FdBudgetExceeded):
+            with ContainerContext(rootfs_for_testing, supervisor=supervisor):
+                pass
+
+
+def test_failed_startup_does_not_leak(rootfs_for_testing):
+    fd_count = len(os.listdir('/proc/self/fd'))
+    bind_mounts = [BindMount(Path('/nonexistent'), Path('mnt', 'nonexistent'), False)]
+    for _ in range(3):
+        with pytest.raises(RuntimeError):
+            with ContainerContext(rootfs_for_testing, bind_mounts=list(bind_mounts)):
+                pass
+    assert len(os.listdir('/proc/self/fd')) == fd_count
+    assert not rootfs_for_testing.joinpath('old_root').exists()
+
+
+def test_scheduler_reuses_containers(rootfs_for_testing):
+    command = ['/bin/sh', '-c', 'test -e /run/left_over; echo $?; touch /run/left_over']
+    with Scheduler(cpu_budget=1) as scheduler:
+        futures = [
+            scheduler.submit(rootfs_for_testing, [command], tenant=tenant)
+            for tenant in ('first', 'second', 'first')
+        ]
+        outputs = [future.result()[0].stdout for future in futures]
+        assert outputs[2] == b'0\n', "Consecutive jobs of a tenant should run in the same container"
+        assert outputs[1] == b'1\n', "An other tenant should not see what the previous job left"
+        assert scheduler.stats()['first'].completed == 2
+
+
+def test_top_shows_container_processes(rootfs_for_testing):
+    with ContainerContext(rootfs_for_testing, sample_interval=0.1) as cnt:
+        sleeper = cnt.Popen(['/bin/sleep', '10'])
+        time.sleep(0.5)
+        names = [process.name for process in cnt.top()]
+        assert 'sleep' in names
+        assert cnt.sampler.timeline()[-1].processes == len(names)
+        sleeper.kill()
+        sleeper.wait()
+
+
+def test_mount_propagation_modes(rootfs_for_testing, tmp_path):
+    mount_target = rootfs_for_testing.joinpath('mnt', 'propagated')
+    mount_target.mkdir()
+    tmp_path.joinpath('bind_source').mkdir()
+    bind_mounts = [BindMount(tmp_path.joinpath('bind_source'), Path('bound'), False)]
+    for mode in MOUNT_PROPAGATION_MODES:
+        with ContainerContext(rootfs_for_testing, bind_mounts=list(bind_mounts), mount_propagation=mode) as cnt:
+            with BindMountContext(tmp_path.joinpath('bind_source'), mount_target):
+                result = cnt.run(['/bin/mountpoint', '-q', '/mnt/propagated'])
+            assert (result.returncode == 0) == (mode != MOUNT_PROPAGATION_PRIVATE), \
+                "Host mounts in the rootfs should only propagate in {}".format(mode)
+    with pytest.raises(ValueError):
+        ContainerContext(rootfs_for_testing, mount_propagation='shared')
+
+
+def test_placement_is_inherited(rootfs_for_testing):
+    packer = NumaPacker()
+    placement = Placement(nice=5, scheduler='batch', numa_node=AUTO_NUMA_NODE)
+    with ContainerContext(rootfs_for_testing, placement=placement, numa_packer=packer) as cnt:
+        assert sum(packer.load.values()) == 1
+        for pid in ('1', 'self'):
+            stat_fields = cnt.run(['/bin/cat', '/proc/{}/stat'.format(pid)], check=True, stdout=subprocess.PIPE).stdout.split()
+            assert int(stat_fields[18]) == 5, "The nice level of {} should be set".format(pid)
+        assert cnt.call(os.sched_getscheduler, 0) == os.SCHED_BATCH
+        assert cnt.call(os.sched_getaffinity, 0) == packer.node_cpus[cnt.numa_node]
+    assert sum(packer.load.values()) == 0
+
+
+def test_shared_buffer(rootfs_for_testing):
+    with ContainerContext(rootfs_for_testing) as cnt:
+        buffer = cnt.shared_buffer(4096)
+        buffer.buffer[:5] = b'hello'
+        result = cnt.run(['/bin/head', '-c', '5', buffer.child_path], check=True, stdout=subprocess.PIPE)
+        assert result.stdout == b'hello'
+        proc = cnt.Popen(['/bin/sh', '-c', 'printf world 1<>{}'.format(buffer.child_path)])
+        assert proc.wait() == 0
+        assert bytes(buffer.buffer[:5]) == b'world'
+
+        ring = RingBuffer(cnt.shared_buffer(RingBuffer.HEADER_SIZE + 4096))
+        ring.write_all(b'data' * 10)
+        ring.close_writer()
+        received = cnt.call(lambda path: b''.join(RingBuffer(SharedBuffer.open(path), initialize=False).read_chunks()),
+                            ring.shared_buffer.child_path)
+        assert received == b'data' * 10
+    buffer.close()
+    ring.shared_buffer.close()
+
+
+def test_access_profile_recording_and_prewarm(rootfs_for_testing, tmp_path):
+    store = PrewarmProfileStore(tmp_path.joinpath('profiles'))
+    with ContainerContext(rootfs_for_testing, prewarm_profiles=store, record_access_profile=True) as cnt:
+        cnt.run(['/bin/cat', '/etc/hostname'], check=True, stdout=subprocess.DEVNULL)
+    paths = [path for path, _ in cnt.access_profile.files]
+    assert any(path.endswith('bin/cat') for path in paths)
+    assert not any(path.startswith('/') for path in paths), "Paths should be relative to the rootfs"
+    assert store.load(cnt.rootfs_fingerprint).files == cnt.access_profile.files
+
+    with ContainerContext(rootfs_for_testing, prewarm_profiles=store) as cnt:
+        assert cnt.prewarm_thread is not None
+        cnt.run(['/bin/cat', '/etc/hostname'], check=True, stdout=subprocess.DEVNULL)
+
+
+def test_container_template(rootfs_for_testing):
+    with ContainerTemplate(rootfs_for_testing, spec=ContainerSpec.full()) as template:
+        for _ in range(2):
+            with template.container(report_orphan_exits=True) as cnt:
+                assert 'remount_defaults' in cnt.startup_timings
+                with open('/proc/self/fdinfo/{}'.format(cnt.pid1.pidfd)) as f:
+                    assert 'Pid:\t{}\n'.format(cnt.pid1.pid) in f.read(), "The pidfd should come from the template"
+                assert cnt.call(os.getpid) != 1, "PID1 should be the only process with pid 1"
+                ps_output = cnt.run(['/bin/ps', '-e', '-o', 'pid', '--no-headers'], check=True, stdout=subprocess.PIPE).stdout
+                assert len(ps_output.split()) <= 3, "The container should have its own pid namespace"
+                # the tmpfs mounts are private to every clone
+                assert cnt.run(['/bin/ls', '/tmp/from_clone'], stderr=subprocess.DEVNULL).returncode != 0
+                cnt.run(['/bin/touch', '/tmp/from_clone'], check=True)
+                cnt.run(['/bin/sh', '-c', '/bin/sleep 0.1 & exit 0'], check=True)
+                record = next(cnt.orphan_exits(timeout=10))
+                assert record.argv[0].endswith('sleep')
+        with pytest.raises(ValueError):
+            ContainerContext(rootfs_for_testing, template=template)
+
+
+def test_image_file_as_rootfs(debootstrapped_dir, tmp_path):
+    image = tmp_path.joinpath('rootfs.ext4')
+    subprocess.run(['mkfs.ext4', '-q', '-d', str(debootstrapped_dir), str(image), '2G'], check=True)
+    mounter = ImageMounter(tmp_path.joinpath('images'))
+    with ContainerContext(image, image_mounter=mounter) as first, ContainerContext(image, image_mounter=mounter) as second:
+        assert first.root_dir == second.root_dir, "The image should be mounted only once"
+        assert first.run(['/bin/ls', '/bin/sh'], check=True).returncode == 0
+        assert second.run(['/usr/bin/touch', '/new_file'], stderr=subprocess.DEVNULL).returncode != 0, \
+            "The image should be mounted read-only"
+    assert not mounter.users
+    assert not list(tmp_path.joinpath('images').iterdir()), "The image should be unmounted after the last container"
@@ -0,0 +1,48 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+
+import pytest
+
+from furnace.image import detect_image_type, image_fingerprint
+
+
+def test_detect_image_type(tmp_path):
+    squashfs = tmp_path.joinpath('rootfs.squashfs')
+    squashfs.write_bytes(b'hsqs' + bytes(4092))
+    assert detect_image_type(squashfs) == 'squashfs'
+    ext4 = tmp_path.joinpath('rootfs.ext4')
+    ext4.write_bytes(bytes(1080) + b'\x53\xef' + bytes(3014))
+    assert detect_image_type(ext4) == 'ext4'
+    other = tmp_path.joinpath('rootfs.tar')
+    other.write_bytes(bytes(4096))
+    with pytest.raises(ValueError):
+        detect_image_type(other)
+
+
+def test_image_fingerprint_changes_with_the_image(tmp_path):
+    image = tmp_path.joinpath('rootfs.squashfs')
+    image.write_bytes(b'hsqs' + bytes(4092))
+    fingerprint = image_fingerprint(image)
+    assert image_fingerprint(image) == fingerprint
+    with image.open('ab') as f:
+        f.write(b'more')
+    os.utime(str(image), ns=(0, 0))
+    assert image_fingerprint(image) != fingerprint
@@ -0,0 +1,95 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import socket
+from pathlib import Path
+
+import pytest
+
+from furnace.context import TmpfsUsage
+from furnace.hooks import Hooks, EVENT_READY, EVENT_TEARDOWN, EVENT_PAUSE
+from furnace.metrics import Metric, MetricsRegistry, MetricsSocketServer, ContainerMetrics
+
+
+def test_registry_renders_prometheus_text():
+    registry = MetricsRegistry()
+    registry.counter('test_total', 'A counter').inc(3)
+    histogram = registry.histogram('test_seconds', 'A histogram', buckets=(0.1, 1.0))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+    assert registry.render() == (
+        '# HELP test_seconds A histogram\n'
+        '# TYPE test_seconds histogram\n'
+        'test_seconds_bucket{le="0.1"} 1\n'
+        'test_seconds_bucket{le="1.0"} 2\n'
+        'test_seconds_bucket{le="+Inf"} 3\n'
+        'test_seconds_sum 5.55\n'
+        'test_seconds_count 3\n'
+        '# HELP test_total A counter\n'
+        '# TYPE test_total counter\n'
+        'test_total 3.0\n'
+    )
+    assert registry.counter('test_total', 'A counter') is registry.counter('test_total', 'A counter')
+
+
+def test_metric_needs_render_samples():
+    class Incomplete(Metric):
+        type_name = 'gauge'
+
+    with pytest.raises(TypeError):
+        Incomplete('incomplete', 'A metric without samples')
+
+
+def test_registry_exports_to_textfile_and_socket(tmp_path):
+    registry = MetricsRegistry()
+    registry.gauge('test_gauge', 'A gauge').set(42)
+    registry.write_textfile(tmp_path.joinpath('furnace.prom'))
+    assert 'test_gauge 42.0' in tmp_path.joinpath('furnace.prom').read_text()
+    assert [path.name for path in tmp_path.iterdir()] == ['furnace.prom']
+
+    socket_path = tmp_path.joinpath('metrics.sock')
+    with MetricsSocketServer(registry, socket_path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(str(socket_path))
+            data = b''.join(iter(lambda: client.recv(4096), b''))
+    assert data.decode('utf-8') == registry.render()
+    assert not socket_path.exists()
+
+
+def test_container_metrics_from_events():
+    registry = MetricsRegistry()
+    parent_hooks = Hooks()
+    parent_hooks.add(ContainerMetrics(registry))
+    hooks = Hooks(parent=parent_hooks)
+    assert hooks, "Hooks with sinks in the parent should be active"
+    assert not Hooks(parent=Hooks()), "Hooks without any sinks should be inactive"
+    hooks.emit(EVENT_READY, None, pid=123, duration=0.2)
+    assert 'furnace_containers_active 1.0' in registry.render()
+    hooks.emit(EVENT_PAUSE, None, duration=0.0002, auto=True)
+    hooks.emit(EVENT_TEARDOWN, None, duration=0.1, tmpfs_usage={
+        Path('/dev/shm'): TmpfsUsage(size=2 ** 26, used=2 ** 20, inodes=100, inodes_used=2),
+        Path('/run'): TmpfsUsage(size=2 ** 26, used=2 ** 21, inodes=100, inodes_used=10),
+    })
+    rendered = registry.render()
+    assert 'furnace_containers_active 0.0' in rendered
+    assert 'furnace_container_start_seconds_count 1' in rendered
+    assert 'furnace_container_teardown_seconds_count 1' in rendered
+    assert 'furnace_container_tmpfs_used_bytes_sum 3145728.0' in rendered
+    assert 'furnace_container_freeze_seconds_bucket{le="0.00025"} 1' in rendered
@@ -0,0 +1,151 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import traceback
+from pathlib import Path
+
+from furnace.config import BindMount
+from furnace.libc import unshare, mount, CLONE_NEWNS, MS_REC, MS_PRIVATE
+from furnace.mountplan import BindMountPlan
+from furnace.utils import BindMountContext
+
+
+def run_in_mount_namespace(function, *args):
+    pid = os.fork()
+    if not pid:
+        try:
+            unshare(CLONE_NEWNS)
+            mount(Path("none"), Path("/"), None, MS_REC | MS_PRIVATE, None)
+            function(*args)
+            os._exit(0)
+        except BaseException:
+            traceback.print_exc()
+            sys.stderr.flush()
+            os._exit(1)
+    _, status = os.waitpid(pid, 0)
+    assert status == 0, "The test function failed in the child process"
+
+
+def test_plan_deduplicates_and_sorts_parent_first(tmp_path):
+    source = tmp_path.joinpath('source')
+    source.mkdir()
+    plan = BindMountPlan(tmp_path.joinpath('root'), [
+        BindMount(source, Path('a', 'b', 'c'), False),
+        BindMount(source, Path('/a'), False),
+        BindMount(source, Path('x'), False),
+        BindMount(source, Path('/x'), True),
+    ])
+    assert [bind.destination for bind in plan.binds] == [Path('a'), Path('a', 'b', 'c'), Path('x')]
+    assert plan.binds[-1].readonly, "The last bind mount to the same destination should win"
+    assert plan.cost.duplicates == 1
+    assert plan.cost.readonly_remounts == 1
+
+
+def test_plan_collapses_nested_binds_of_the_same_source(tmp_path):
+    source = tmp_path.joinpath('source')
+    source.joinpath('sub', 'dir').mkdir(parents=True)
+    plan = BindMountPlan(tmp_path.joinpath('root'), [
+        BindMount(source, Path('src'), False),
+        BindMount(source.joinpath('sub'), Path('src', 'sub'), False),
+        BindMount(source.joinpath('sub', 'dir'), Path('src', 'sub', 'dir'), True),
+        BindMount(source.joinpath('sub'), Path('elsewhere'), False),
+    ])
+    assert [bind.destination for bind in plan.binds] == [Path('elsewhere'), Path('src'), Path('src', 'sub', 'dir')]
+    assert not any(bind.recursive for bind in plan.binds), "Plain subdirectories do not need recursive bind mounts"
+    assert plan.cost.collapsed == 1
+
+
+def test_plan_makes_collapsed_binds_of_mountpoints_recursive(tmp_path):
+    source = tmp_path.joinpath('source')
+    source.joinpath('mounted').mkdir(parents=True)
+    other = tmp_path.joinpath('other')
+    other.mkdir()
+
+    def check():
+        with BindMountContext(other, source.joinpath('mounted')):
+            plan = BindMountPlan(tmp_path.joinpath('root'), [
+                BindMount(source, Path('src'), True),
+                BindMount(source.joinpath('mounted'), Path('src', 'mounted'), True),
+            ])
+            assert len(plan.binds) == 1
+            assert plan.binds[0].recursive
+            assert plan.readonly_remounts == [Path('src'), Path('src', 'mounted')]
+
+    run_in_mount_namespace(check)
+
+
+def test_plan_does_not_expose_other_mounts_when_collapsing(tmp_path):
+    source = tmp_path.joinpath('source')
+    source.joinpath('mounted').mkdir(parents=True)
+    source.joinpath('private').mkdir()
+    other = tmp_path.joinpath('other')
+    other.mkdir()
+
+    def check():
+        with BindMountContext(other, source.joinpath('mounted')), BindMountContext(other, source.joinpath('private')):
+            plan = BindMountPlan(tmp_path.joinpath('root'), [
+                BindMount(source, Path('src'), False),
+                BindMount(source.joinpath('mounted'), Path('src', 'mounted'), False),
+            ])
+            assert [bind.destination for bind in plan.binds] == [Path('src'), Path('src', 'mounted')]
+            assert not any(bind.recursive for bind in plan.binds), "/src/private should not be visible"
+            assert plan.cost.collapsed == 0
+
+    run_in_mount_namespace(check)
+
+
+def test_plan_cost_counts_rootfs_writes(tmp_path):
+    root = tmp_path.joinpath('root')
+    root.joinpath('existing').mkdir(parents=True)
+    source = tmp_path.joinpath('source')
+    source.mkdir()
+    bind_mounts = [
+        BindMount(source, Path('existing'), False),
+        BindMount(source, Path('new', 'dir'), False),
+    ]
+    assert BindMountPlan(root, bind_mounts).cost.rootfs_writes == 2
+    skeleton_cost = BindMountPlan(root, bind_mounts, use_skeleton=True).cost
+    assert skeleton_cost.rootfs_writes == 0
+    assert skeleton_cost.skeleton_dirs == 1
+
+
+def test_skeleton_does_not_touch_the_rootfs(tmp_path):
+    root = tmp_path.joinpath('root')
+    root.joinpath('etc').mkdir(parents=True)
+    root.joinpath('etc', 'hostname').write_text('rootfs')
+    root.joinpath('link').symlink_to('etc')
+    source = tmp_path.joinpath('source')
+    source.mkdir()
+    source.joinpath('test_file').write_text('Test data')
+
+    def check():
+        BindMountPlan(root, [
+            BindMount(source, Path('mounted', 'deep'), False),
+            BindMount(source.joinpath('test_file'), Path('etc', 'new', 'file'), True),
+        ], use_skeleton=True).execute()
+        assert root.joinpath('mounted', 'deep', 'test_file').read_text() == 'Test data'
+        assert root.joinpath('etc', 'new', 'file').read_text() == 'Test data'
+        assert root.joinpath('etc', 'hostname').read_text() == 'rootfs'
+        assert os.readlink(str(root.joinpath('link'))) == 'etc'
+
+    run_in_mount_namespace(check)
+    assert sorted(path.name for path in root.iterdir()) == ['etc', 'link']
+    assert [path.name for path in root.joinpath('etc').iterdir()] == ['hostname']
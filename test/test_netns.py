@@ -0,0 +1,64 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import subprocess
+from pathlib import Path
+
+from furnace.libc import is_mount_point, setns, CLONE_NEWNET
+from furnace.netns import NetnsPool, run_in_child
+
+
+def add_dummy_interface(path: Path):
+    fd = os.open(str(path), os.O_RDONLY)
+    setns(fd, CLONE_NEWNET)
+    os.close(fd)
+    return subprocess.run(['ip', 'link', 'add', 'furnace-test', 'type', 'bridge']).returncode == 0
+
+
+def test_netns_pool_recycles_clean_namespaces(tmp_path):
+    with NetnsPool(2, directory=tmp_path) as pool:
+        assert len(pool.free) == 2
+        first = pool.acquire()
+        assert is_mount_point(first)
+        pool.release(first)
+        assert first in pool.free, "A namespace without extra interfaces should be reused"
+        assert pool.acquire() == first
+        pool.release(first)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_netns_pool_destroys_dirty_namespaces(tmp_path):
+    with NetnsPool(1, directory=tmp_path) as pool:
+        netns = pool.acquire()
+        assert run_in_child(add_dummy_interface, netns)
+        pool.release(netns)
+        assert pool.free == []
+        assert not netns.exists()
+
+
+def test_netns_pool_grows_on_demand(tmp_path):
+    with NetnsPool(1, directory=tmp_path) as pool:
+        first = pool.acquire()
+        second = pool.acquire()
+        assert first != second
+        pool.release(second)
+        pool.release(first)
+        assert len(pool.free) == 1
+    assert list(tmp_path.iterdir()) == []
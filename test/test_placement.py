@@ -0,0 +1,74 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import pickle
+
+import pytest
+
+from furnace.placement import Placement, NumaPacker, parse_cpu_list
+
+
+def apply_in_child(placement):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        try:
+            placement.apply()
+            result = (os.sched_getaffinity(0), os.getpriority(os.PRIO_PROCESS, 0), os.sched_getscheduler(0))
+        except BaseException as e:
+            result = e
+        os.write(write_fd, pickle.dumps(result))
+        os._exit(0)
+    os.close(write_fd)
+    with open(read_fd, 'rb') as f:
+        result = pickle.loads(f.read())
+    os.waitpid(pid, 0)
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+
+def test_placement_apply():
+    cpu = min(os.sched_getaffinity(0))
+    placement = Placement(cpus={cpu}, memory_nodes=[0], nice=7, scheduler='batch', io_class='idle').validate()
+    assert apply_in_child(placement) == ({cpu}, 7, os.SCHED_BATCH)
+    assert Placement.from_json(placement.to_json()) == placement
+    with pytest.raises(ValueError):
+        Placement(scheduler='fifo').validate()
+    with pytest.raises(ValueError):
+        Placement(cpus=[]).validate()
+
+
+def test_numa_packer(tmp_path):
+    for node, cpulist in enumerate(['0-3', '4-7,12-15']):
+        tmp_path.joinpath('node{}'.format(node)).mkdir()
+        tmp_path.joinpath('node{}'.format(node), 'cpulist').write_text(cpulist + '\n')
+    assert parse_cpu_list('4-7,12-15\n') == {4, 5, 6, 7, 12, 13, 14, 15}
+    packer = NumaPacker(tmp_path)
+    nodes = [packer.assign() for _ in range(6)]
+    assert nodes.count(1) == 4, "The node with twice the CPUs should get twice the containers"
+    packer.release(1)
+    packer.release(1)
+    assert packer.assign() == 1
+    placement = Placement(cpus=[0, 5, 6], numa_node='auto').on_numa_node(1, packer.node_cpus[1])
+    assert placement.cpus == [5, 6]
+    assert placement.memory_nodes == [1]
+    with pytest.raises(ValueError):
+        Placement(cpus=[0, 1], numa_node=1).on_numa_node(1, packer.node_cpus[1])
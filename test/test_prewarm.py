@@ -0,0 +1,66 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import mmap
+import os
+
+from furnace.prewarm import PrewarmProfile, PrewarmProfileStore, get_cached_ranges, prewarm
+
+
+def test_profile_store(tmp_path):
+    store = PrewarmProfileStore(tmp_path.joinpath('profiles'))
+    profile = PrewarmProfile([('usr/bin/true', [(0, 4096), (8192, 100)]), ('etc/passwd', [(0, 10)])])
+    assert store.load('fingerprint') is None
+    store.save('fingerprint', profile)
+    loaded = store.load('fingerprint')
+    assert loaded.files == profile.files
+    assert loaded.total_bytes == 4096 + 100 + 10
+    assert store.load('other fingerprint') is None
+
+
+def test_cached_ranges_of_written_file(tmp_path):
+    path = tmp_path.joinpath('data')
+    size = 3 * mmap.PAGESIZE + 10
+    path.write_bytes(b'x' * size)
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        # the pages written are in the page cache
+        assert get_cached_ranges(fd, size) == [(0, size)]
+        assert get_cached_ranges(fd, 0) == []
+    finally:
+        os.close(fd)
+
+
+def test_prewarm_skips_missing_files(tmp_path):
+    tmp_path.joinpath('data').write_bytes(b'x' * 10000)
+    profile = PrewarmProfile([('data', [(0, 4096), (8192, 1808)]), ('missing', [(0, 4096)])])
+    assert prewarm(tmp_path, profile, workers=2) == 4096 + 1808
+
+
+def test_prewarm_stays_in_the_rootfs(tmp_path):
+    root_dir = tmp_path.joinpath('root')
+    root_dir.mkdir()
+    tmp_path.joinpath('host_file').write_bytes(b'x' * 4096)
+    root_dir.joinpath('link').symlink_to(str(tmp_path.joinpath('host_file')))
+    profile = PrewarmProfile([
+        (str(tmp_path.joinpath('host_file')), [(0, 4096)]),
+        ('../host_file', [(0, 4096)]),
+        ('link', [(0, 4096)]),
+    ])
+    assert prewarm(root_dir, profile) == 0, "Files outside of the rootfs should not be read"
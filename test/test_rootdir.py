@@ -0,0 +1,75 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import pytest
+
+from furnace.rootdir import RootDirectory
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path.joinpath('root')
+    root.joinpath('etc', 'conf.d').mkdir(parents=True)
+    root.joinpath('etc', 'hostname').write_text('inside\n')
+    root.joinpath('etc', 'conf.d', 'a.conf').write_text('a')
+    tmp_path.joinpath('etc').mkdir()
+    tmp_path.joinpath('etc', 'hostname').write_text('outside\n')
+    # both would point out of the tree if they were resolved on the host
+    root.joinpath('absolute').symlink_to('/etc/hostname')
+    root.joinpath('relative').symlink_to('../../etc/hostname')
+    return root
+
+
+def test_symlinks_are_resolved_in_the_root(tree):
+    with RootDirectory(tree) as root:
+        for path in ('/etc/hostname', 'absolute', '/relative', '/../etc/hostname'):
+            with root.open(path) as f:
+                assert f.read() == 'inside\n', path
+        assert root.stat('/absolute', follow_symlinks=False).st_size == len('/etc/hostname')
+        assert root.exists('/etc/conf.d/a.conf')
+        assert not root.exists('/etc/missing')
+        with pytest.raises(FileNotFoundError):
+            root.stat('/etc/missing')
+
+
+def test_write_list_and_walk(tree):
+    with RootDirectory(tree) as root:
+        with root.open('/etc/conf.d/b.conf', 'wb') as f:
+            f.write(b'b')
+        assert tree.joinpath('etc', 'conf.d', 'b.conf').read_bytes() == b'b'
+        assert sorted(root.listdir('/etc')) == ['conf.d', 'hostname']
+        walked = {dirpath: (sorted(dirnames), sorted(filenames)) for dirpath, dirnames, filenames in root.walk('/')}
+        assert walked == {
+            '/': (['etc'], ['absolute', 'relative']),
+            '/etc': (['conf.d'], ['hostname']),
+            '/etc/conf.d': ([], ['a.conf', 'b.conf']),
+        }
+        assert [dirpath for dirpath, _, _ in root.walk('etc/conf.d')] == ['/etc/conf.d']
+    assert root.fd is None
+
+
+def test_makedirs_stays_in_the_root(tree, tmp_path):
+    tree.joinpath('outside').symlink_to(str(tmp_path))
+    inside = tree.joinpath(str(tmp_path).lstrip('/'))
+    inside.mkdir(parents=True)
+    with RootDirectory(tree) as root:
+        root.makedirs('/outside/created/nested')
+        root.makedirs('/etc/conf.d')
+    assert inside.joinpath('created', 'nested').is_dir()
+    assert not tmp_path.joinpath('created').exists(), "Symlinks should be resolved in the root"
@@ -0,0 +1,53 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import signal
+import time
+
+from furnace.sampler import ProcessTreeSampler, load_dump, read_children
+
+
+def test_sampler_follows_the_process_tree(tmp_path):
+    pid = os.fork()
+    if not pid:
+        # a busy child, with a sleeping grandchild
+        if not os.fork():
+            signal.pause()
+        while True:
+            pass
+    try:
+        with ProcessTreeSampler(os.getpid(), interval=0.05, include_own_children=False) as sampler:
+            time.sleep(0.5)
+        top = sampler.top()
+        assert top[0].pid == pid, "The busy child should be on top"
+        assert top[0].cpu_percent > 20
+        assert len(top) == 3
+        timeline = sampler.timeline()
+        assert len(timeline) > 2
+        assert timeline[-1].processes == 3
+        assert timeline[-1].rss == sum(process.rss for process in top)
+        assert all(process.pid == pid for _, process in sampler.process_timeline(pid))
+        sampler.dump(tmp_path.joinpath('samples.gz'))
+        loaded = load_dump(tmp_path.joinpath('samples.gz'))
+        assert [processes for _, processes in loaded][-1] == sampler.snapshots[-1][1]
+    finally:
+        for child in read_children(pid) + [pid]:
+            os.kill(child, signal.SIGKILL)
+        os.waitpid(pid, 0)
@@ -0,0 +1,125 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import subprocess
+import threading
+import time
+
+import pytest
+
+from furnace.scheduler import Scheduler
+
+
+def dispatch_all(scheduler):
+    # the order the dispatcher would start the jobs in, without running them
+    order = []
+    while True:
+        job = scheduler.next_job()
+        if job is None:
+            return order
+        scheduler.reserve(job)
+        order.append((job.tenant, job.commands[0][0]))
+
+
+def test_scheduler_shares_between_tenants(tmp_path):
+    scheduler = Scheduler(cpu_budget=4)
+    for index in range(10):
+        scheduler.submit(tmp_path, [['burst{}'.format(index)]], tenant='burst')
+    scheduler.submit(tmp_path, [['late']], tenant='other')
+    order = dispatch_all(scheduler)
+    assert len(order) == 4, "Only as many jobs should start as the CPU budget allows"
+    assert ('other', 'late') in order, "A burst of one tenant should not block the others"
+
+
+def test_scheduler_weights_and_priorities(tmp_path):
+    scheduler = Scheduler(cpu_budget=8, memory_budget=None, tenant_weights={'big': 3})
+    for index in range(8):
+        scheduler.submit(tmp_path, [['big{}'.format(index)]], tenant='big')
+        scheduler.submit(tmp_path, [['small{}'.format(index)]], tenant='small', priority=index)
+    order = dispatch_all(scheduler)
+    assert [tenant for tenant, _ in order].count('big') == 6
+    assert [command for tenant, command in order if tenant == 'small'] == ['small7', 'small6']
+
+
+def test_scheduler_budget(tmp_path):
+    scheduler = Scheduler(cpu_budget=4, memory_budget=1000)
+    scheduler.submit(tmp_path, [['first']], memory=600)
+    scheduler.submit(tmp_path, [['second']], memory=600)
+    assert len(dispatch_all(scheduler)) == 1
+    with pytest.raises(ValueError):
+        scheduler.submit(tmp_path, [['huge']], cpu=5)
+
+
+class FakeContainer:
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.exited = threading.Event()
+        self.lock_was_free = None
+
+    def __enter__(self):
+        return self
+
+    def run(self, args, **kwargs):
+        return subprocess.CompletedProcess(args, 0)
+
+    def check_lock(self):
+        if self.scheduler.condition.acquire(timeout=1):
+            self.scheduler.condition.release()
+            self.lock_was_free = True
+        else:
+            self.lock_was_free = False
+
+    def __exit__(self, type, value, traceback):
+        # the lock is reentrant, so it is checked from an other thread
+        checker = threading.Thread(target=self.check_lock)
+        checker.start()
+        checker.join()
+        self.exited.set()
+
+
+def test_scheduler_stops_idle_containers_while_busy(tmp_path, monkeypatch):
+    scheduler = Scheduler(cpu_budget=4, idle_timeout=0.2)
+    monkeypatch.setattr(scheduler, 'get_container', lambda job: FakeContainer(scheduler))
+    idle = FakeContainer(scheduler)
+    scheduler.idle_containers['other'] = [(time.monotonic(), idle)]
+    with scheduler:
+        deadline = time.monotonic() + 10
+        while not idle.exited.wait(0.01) and time.monotonic() < deadline:
+            scheduler.submit(tmp_path, [['true']])
+    assert idle.exited.is_set(), "Idle containers should expire while jobs keep coming"
+    assert idle.lock_was_free, "Containers should be stopped without holding the lock"
+
+
+@pytest.mark.parametrize('share_containers', [False, True])
+def test_scheduler_reuses_containers_within_a_tenant(tmp_path, monkeypatch, share_containers):
+    scheduler = Scheduler(cpu_budget=4, share_containers=share_containers)
+    created = []
+
+    def create_container(root_dir, **kwargs):
+        created.append(FakeContainer(scheduler))
+        return created[-1]
+
+    monkeypatch.setattr('furnace.scheduler.ContainerContext', create_container)
+    with scheduler:
+        for tenant in ['first', 'second', 'first']:
+            scheduler.submit(tmp_path, [['true']], tenant=tenant).result(timeout=10)
+    if share_containers:
+        assert len(created) == 1
+    else:
+        assert len(created) == 2, "Tenants with the same rootfs should not get each other's containers"
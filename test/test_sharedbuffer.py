@@ -0,0 +1,77 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from furnace.sharedbuffer import SharedBuffer, RingBuffer
+
+
+def test_shared_buffer_is_shared_with_children():
+    with SharedBuffer(4096) as buffer:
+        buffer.buffer[:5] = b'hello'
+        script = "import sys; f = open(sys.argv[1], 'r+b'); print(f.read(5).decode()); f.seek(5); f.write(b'world')"
+        result = subprocess.run(
+            [sys.executable, '-c', script, buffer.child_path],
+            pass_fds=[buffer.fd], check=True, stdout=subprocess.PIPE,
+        )
+        assert result.stdout == b'hello\n'
+        assert bytes(buffer.buffer[:10]) == b'helloworld'
+
+
+def test_sealed_shared_buffer_is_read_only():
+    with SharedBuffer(4096) as buffer:
+        buffer.buffer[:4] = b'data'
+        buffer.seal_contents()
+        with pytest.raises(TypeError):
+            buffer.buffer[:4] = b'junk'
+        with pytest.raises(PermissionError):
+            os.pwrite(buffer.fd, b'junk', 0)
+        with SharedBuffer.open(buffer.child_path) as reopened:
+            assert bytes(reopened.buffer[:4]) == b'data'
+
+
+def test_ring_buffer_transfers_more_than_its_capacity():
+    data = os.urandom(1024 * 1024)
+    received = []
+    with SharedBuffer(RingBuffer.HEADER_SIZE + 4096) as buffer:
+        writer = RingBuffer(buffer)
+        reader = RingBuffer(SharedBuffer.open(buffer.child_path), initialize=False)
+
+        def consume():
+            received.extend(reader.read_chunks(chunk_size=1000, timeout=10))
+            reader.shared_buffer.close()
+
+        thread = threading.Thread(target=consume)
+        thread.start()
+        writer.write_all(data, timeout=10)
+        writer.close_writer()
+        thread.join()
+    assert b''.join(received) == data
+    assert max(len(chunk) for chunk in received) <= 1000
+
+
+def test_ring_buffer_needs_room_for_the_header():
+    with SharedBuffer(RingBuffer.HEADER_SIZE) as buffer:
+        with pytest.raises(ValueError):
+            RingBuffer(buffer)
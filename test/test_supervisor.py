@@ -0,0 +1,94 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import queue
+import signal
+
+import pytest
+
+from furnace.libc import pidfd_open, pidfd_send_signal
+from furnace.supervisor import Supervisor, FdBudgetExceeded
+
+
+def start_sleeper():
+    pid = os.fork()
+    if not pid:
+        signal.pause()
+        os._exit(0)
+    return pid
+
+
+def test_supervisor_reports_exits():
+    exits = queue.Queue()
+    pids = [start_sleeper() for _ in range(10)]
+    pidfds = [pidfd_open(pid) for pid in pids]
+    try:
+        with Supervisor() as supervisor:
+            for pid, pidfd in zip(pids, pidfds):
+                supervisor.watch(pidfd, pid, exits.put)
+            pidfd_send_signal(pidfds[3], signal.SIGKILL)
+            assert exits.get(timeout=10) == pids[3]
+            # unwatched processes are not reported
+            supervisor.unwatch(pidfds[5])
+            for pidfd in pidfds:
+                pidfd_send_signal(pidfd, signal.SIGKILL)
+            reported = {exits.get(timeout=10) for _ in range(8)}
+            assert reported == set(pids) - {pids[3], pids[5]}
+            assert exits.empty()
+    finally:
+        for pid, pidfd in zip(pids, pidfds):
+            os.waitpid(pid, 0)
+            os.close(pidfd)
+
+
+def test_supervisor_survives_unwatch_races():
+    exits = queue.Queue()
+    with Supervisor() as supervisor:
+        # like ContainerContext.__exit__: the exit may already be handled by the loop
+        for _ in range(20):
+            pid = start_sleeper()
+            pidfd = pidfd_open(pid)
+            supervisor.watch(pidfd, pid, exits.put)
+            pidfd_send_signal(pidfd, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            supervisor.unwatch(pidfd)
+            os.close(pidfd)
+        pid = start_sleeper()
+        pidfd = pidfd_open(pid)
+        try:
+            supervisor.watch(pidfd, pid, exits.put)
+            pidfd_send_signal(pidfd, signal.SIGKILL)
+            while exits.get(timeout=10) != pid:
+                pass
+        finally:
+            os.waitpid(pid, 0)
+            os.close(pidfd)
+        assert supervisor.thread.is_alive()
+
+
+def test_supervisor_fd_budget():
+    supervisor = Supervisor(fd_budget=10)
+    supervisor.reserve_fds(6)
+    with pytest.raises(FdBudgetExceeded):
+        supervisor.reserve_fds(6)
+    supervisor.reserve_fds(4)
+    supervisor.release_fds(6)
+    supervisor.reserve_fds(6)
+    assert supervisor.fds_in_use == 10
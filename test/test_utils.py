@@ -0,0 +1,62 @@
+#
+# Copyright (c) 2016-2020 Balabit
+#
+# This file is part of Furnace.
+#
+# Furnace is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# Furnace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Furnace.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import pytest
+
+from furnace.libc import MS_NOATIME
+from furnace.utils import OverlayOptions, OverlayfsMountContext
+
+
+def make_overlay_dirs(tmp_path):
+    dirs = [tmp_path.joinpath(name) for name in ('lower', 'upper', 'work', 'mounted')]
+    for directory in dirs:
+        directory.mkdir()
+    dirs[0].joinpath('file').write_text('lower')
+    return dirs
+
+
+def test_overlay_options_to_mount_parameters():
+    context = OverlayfsMountContext(['/lower1', '/lower2'], '/upper', '/work', '/mounted', OverlayOptions(
+        volatile=True, metacopy=True, index=False, xino='auto', noatime=True))
+    fstype, flags, options = context.get_mount_parameters()
+    assert (fstype, flags) == ('overlay', MS_NOATIME)
+    assert options == 'lowerdir=/lower1:/lower2,upperdir=/upper,workdir=/work,volatile,metacopy=on,index=off,xino=auto'
+    assert OverlayfsMountContext([], '/u', '/w', '/m').get_mount_parameters()[1:] == (0, 'lowerdir=,upperdir=/u,workdir=/w')
+    assert OverlayOptions.from_json(OverlayOptions.fast_scratch().to_json()) == OverlayOptions.fast_scratch()
+    with pytest.raises(ValueError):
+        OverlayOptions(metacopy=True, redirect_dir='off').validate()
+    with pytest.raises(ValueError):
+        OverlayOptions(xino='maybe').validate()
+
+
+def test_volatile_overlay_can_be_mounted_again(tmp_path):
+    lower, upper, work, mounted = make_overlay_dirs(tmp_path)
+    for _ in range(2):
+        with OverlayfsMountContext([lower], upper, work, mounted, OverlayOptions.fast_scratch()):
+            mounted.joinpath('file').chmod(0o600)
+            assert mounted.joinpath('file').read_text() == 'lower'
+
+
+def test_overlay_mount_ignores_unsupported_options(tmp_path):
+    lower, upper, work, mounted = make_overlay_dirs(tmp_path)
+    context = OverlayfsMountContext([lower], upper, work, mounted, OverlayOptions(index=False))
+    context.mount_options.append('no_such_option')
+    with context:
+        assert mounted.joinpath('file').read_text() == 'lower'
+    assert context.mount_options == ['index=off']